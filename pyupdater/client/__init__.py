@@ -16,23 +16,26 @@
 from __future__ import unicode_literals
 
 from pyupdater import settings, __version__
-from pyupdater.client.downloader import FileDownloader
+from pyupdater.client.aio import AsyncRunner
+from pyupdater.client.batch import BatchUpdater
+from pyupdater.client.cache import default_cache_dir, DownloadCache
+from pyupdater.client.downloader import FileDownloader, get_http_pool
+from pyupdater.client.mirrors import MirrorSelector
+from pyupdater.client.retry import CircuitBreaker, RetryPolicy
+from pyupdater.client.singleflight import SingleFlight
+from pyupdater.client.throttle import RateLimiter
 from pyupdater.client.updates import AppUpdate, LibUpdate
 from pyupdater.utils import (convert_to_list,
                              EasyAccessDict,
                              get_highest_version,
                              gzip_decompress,
+                             GzipDecompressor,
                              lazy_import,
+                             replace_file,
                              Version)
 from pyupdater.utils.config import TransistionDict
 
 
-@lazy_import
-def gzip():
-    import gzip
-    return gzip
-
-
 @lazy_import
 def json():
     import json
@@ -180,15 +183,98 @@ class Client(object):
         self.public_keys = list(set(self.public_keys))
         # Config option to disable tls cert verification
         self.verify = config.get('VERIFY_SERVER_CERT', True)
+        # Max number of concurrent requests used for full updates
+        self.download_segments = config.get('DOWNLOAD_SEGMENTS',
+                                            settings.DOWNLOAD_SEGMENTS)
+        # Max number of patch downloads & async calls running at once
+        self.max_concurrent_downloads = config.get(
+            'MAX_CONCURRENT_DOWNLOADS', settings.MAX_CONCURRENT_DOWNLOADS)
+        # Max combined size of packages downloaded at once by update_all
+        self.max_bytes_in_flight = config.get('MAX_BYTES_IN_FLIGHT',
+                                              settings.MAX_BYTES_IN_FLIGHT)
+        # Used to pick between patching & a full download
+        self.patch_apply_cost = config.get('PATCH_APPLY_COST',
+                                           settings.PATCH_APPLY_COST)
+        # Caps the combined speed of all downloads. None for no limit
+        self.rate_limiter = RateLimiter(config.get('MAX_DOWNLOAD_BPS'))
+        # Max number of progress events sent to callbacks per second
+        self.progress_rate = config.get('PROGRESS_HOOK_RATE',
+                                        settings.PROGRESS_HOOK_RATE)
+        # Used by all downloads when a request fails
+        self.retry_policy = RetryPolicy(config.get('DOWNLOAD_RETRIES',
+                                                   settings.DOWNLOAD_RETRIES))
+        # Shared so an url failing for one download is skipped
+        # by the others too
+        self.circuit_breaker = CircuitBreaker()
+        # Content addressed cache of downloads shared by all apps
+        # using pyupdater on this machine
+        self.cache = None
+        if config.get('SHARED_CACHE', False) is True:
+            cache_dir = config.get('SHARED_CACHE_DIR')
+            if cache_dir is None:
+                cache_dir = default_cache_dir()
+            max_size = config.get('SHARED_CACHE_MAX_SIZE',
+                                  settings.SHARED_CACHE_MAX_SIZE)
+            self.cache = DownloadCache(cache_dir, max_size)
+        # Lets update objects downloading the same file share
+        # one download
+        self.single_flight = SingleFlight()
+        # Runs the blocking calls behind the *_async methods
+        self.async_runner = AsyncRunner(self.max_concurrent_downloads)
         self.version_file = settings.VERSION_FILE
+        # Holds the ETag & Last-Modified headers of the version file
+        self.version_file_cache_info = settings.VERSION_FILE_CACHE_INFO
+        # Set when the server says the version file didn't change
+        # since the last download
+        self._manifest_not_modified = False
 
         self._setup()
+        # Shared by all downloads to keep connections alive
+        # between requests
+        self.http_pool = get_http_pool(self.verify)
+        # Used to order update urls from fastest to slowest
+        self.mirrors = MirrorSelector(self.update_urls, self.data_dir,
+                                      self.verify, self.http_pool)
+        self.update_urls = self.mirrors.ranked_urls()
         if refresh is True:
             self.refresh()
 
     def refresh(self):
         "Will download and verify your version file."
+        # Making sure we use the fastest url first for all
+        # downloads
+        self.update_urls = self.mirrors.rank()
         self._get_update_manifest()
+        # Keeping what the version file download told us about
+        # the urls
+        self.mirrors.save_stats()
+
+    def refresh_async(self, loop=None):
+        """Same as :meth:`refresh` but doesn't block the event loop.
+        Requires python 3.4+
+
+            await client.refresh_async()
+
+        Kwargs:
+
+            loop (obj): Event loop to use. Defaults to the running event loop
+
+        Returns:
+
+            (obj): asyncio future
+        """
+        return self.async_runner.run(self.refresh, loop=loop)
+
+    def set_max_download_bps(self, rate):
+        """Changes the download speed cap. Downloads already running
+        slow down or speed up right away.
+
+        Args:
+
+            rate (int): Max bytes per second for all downloads combined.
+                        None or 0 for no limit
+        """
+        self.rate_limiter.set_rate(rate)
 
     def update_check(self, name, version):
         """
@@ -212,6 +298,98 @@ class Client(object):
         """
         return self._update_check(name, version)
 
+    def update_check_async(self, name, version, loop=None):
+        """Same as :meth:`update_check` but doesn't block the event loop.
+        Requires python 3.4+
+
+            update = await client.update_check_async('Acme', '1.0.0')
+
+        Args:
+
+            name (str): Name of file to update
+
+            version (str): Current version number of file to update
+
+        Kwargs:
+
+            loop (obj): Event loop to use. Defaults to the running event loop
+
+        Returns:
+
+            (obj): asyncio future. Resolves to the same values
+                   :meth:`update_check` returns
+        """
+        return self.async_runner.run(self._update_check, name, version,
+                                     loop=loop)
+
+    def update_all(self, packages, progress_hooks=None):
+        """Checks for & downloads updates of many packages at once.
+        Downloads run on up to MAX_CONCURRENT_DOWNLOADS threads, as
+        long as their combined size stays under MAX_BYTES_IN_FLIGHT.
+
+            updates, results = client.update_all({'plugin-a': '1.0.0',
+                                                  'plugin-b': '2.1.0'})
+            for name, update in updates.items():
+                if results[name] is True:
+                    update.extract()
+
+        Args:
+
+            packages (dict): name: current version
+
+        Kwargs:
+
+            progress_hooks (list): Called with combined progress of all
+                                   packages. Status dicts also have
+                                   packages_total & packages_done
+
+        Returns:
+
+            (tuple): (updates, results)
+
+                updates (dict): name: update object. None if no update
+
+                results (dict): name: status. Status meanings:
+
+                    True - Download successful
+
+                    False - Download failed
+
+                    None - No update available
+        """
+        # All checks use the version file already in memory
+        updates = {}
+        for name, version in packages.items():
+            updates[name] = self._update_check(name, version)
+        batch = BatchUpdater(updates, self.max_concurrent_downloads,
+                             self.max_bytes_in_flight, progress_hooks,
+                             self.progress_rate)
+        return updates, batch.run()
+
+    def update_all_async(self, packages, progress_hooks=None, loop=None):
+        """Same as :meth:`update_all` but doesn't block the event loop.
+        Requires python 3.4+
+
+            updates, results = await client.update_all_async(packages)
+
+        Args:
+
+            packages (dict): name: current version
+
+        Kwargs:
+
+            progress_hooks (list): Called with combined progress
+
+            loop (obj): Event loop to use. Defaults to the running event loop
+
+        Returns:
+
+            (obj): asyncio future. Resolves to the same values
+                   :meth:`update_all` returns
+        """
+        return self.async_runner.run(self.update_all, packages,
+                                     progress_hooks, loop=loop)
+
     def _update_check(self, name, version):
         self.name = name
         version = Version(version)
@@ -265,6 +443,18 @@ class Client(object):
             'platform': self.platform,
             'app_name': self.app_name,
             'verify': self.verify,
+            'download_segments': self.download_segments,
+            'http_pool': self.http_pool,
+            'max_concurrent_downloads': self.max_concurrent_downloads,
+            'patch_apply_cost': self.patch_apply_cost,
+            'async_runner': self.async_runner,
+            'rate_limiter': self.rate_limiter,
+            'progress_rate': self.progress_rate,
+            'cache': self.cache,
+            'retry_policy': self.retry_policy,
+            'circuit_breaker': self.circuit_breaker,
+            'mirrors': self.mirrors,
+            'single_flight': self.single_flight,
             'progress_hooks': self.progress_hooks,
             }
         # Return update object with which handles downloading,
@@ -312,36 +502,96 @@ class Client(object):
     # Downloading the manifest. If successful also writes it to file-system
     def _download_manifest(self):
         log.info('Downloading online version file')
+        self._manifest_not_modified = False
         try:
             fd = FileDownloader(self.version_file, self.update_urls,
-                                verify=self.verify)
-            data = fd.download_verify_return()
+                                verify=self.verify,
+                                http_pool=self.http_pool,
+                                rate_limiter=self.rate_limiter,
+                                progress_rate=self.progress_rate,
+                                headers=self._get_manifest_headers(),
+                                retry_policy=self.retry_policy,
+                                circuit_breaker=self.circuit_breaker,
+                                mirrors=self.mirrors)
+            # Decompressed while it's being downloaded
+            decompressor = GzipDecompressor()
+            success = fd.download_verify_into(decompressor)
+            if fd.status == 304:
+                log.info('Version file not modified')
+                self._manifest_not_modified = True
+                return None
+            if success is False:
+                raise IOError('No version file data received')
             try:
-                decompressed_data = gzip_decompress(data)
+                decompressed_data = decompressor.getvalue()
             except IOError:
                 log.error('Failed to decompress gzip file')
                 # Will be caught down below. Just logging the error
                 raise
             log.info('Version file download successful')
             # Writing version file to application data directory
-            self._write_manifest_2_filesystem(decompressed_data)
+            self._write_manifest_2_filesystem(decompressor.get_compressed(),
+                                              fd.response_headers)
             return decompressed_data
         except Exception as err:
             log.error('Version file download failed')
             log.debug(str(err), exc_info=True)
             return None
 
-    def _write_manifest_2_filesystem(self, data):
+    def _get_manifest_headers(self):
+        # Conditional request headers for the version file. Only sent
+        # when we have the version file on disk to fall back on.
+        headers = {}
+        with jms_utils.paths.ChDir(self.data_dir):
+            if not os.path.exists(self.version_file) or \
+                    not os.path.exists(self.version_file_cache_info):
+                return headers
+            try:
+                with open(self.version_file_cache_info, 'r') as f:
+                    info = json.load(f)
+            except (IOError, ValueError) as err:
+                log.debug(str(err), exc_info=True)
+                return headers
+        if info.get('etag'):
+            headers['If-None-Match'] = info['etag']
+        if info.get('last_modified'):
+            headers['If-Modified-Since'] = info['last_modified']
+        return headers
+
+    def _write_manifest_2_filesystem(self, data, response_headers=None):
+        # data is the gzipped version file as downloaded. Saved as is
         with jms_utils.paths.ChDir(self.data_dir):
+            # Old headers must never be paired with a new version file
+            if os.path.exists(self.version_file_cache_info):
+                os.remove(self.version_file_cache_info)
             log.debug('Writing version file to disk')
-            with gzip.open(self.version_file, 'wb') as f:
+            temp_file = self.version_file + settings.DOWNLOAD_TEMP_EXT
+            with open(temp_file, 'wb') as f:
                 f.write(data)
+            replace_file(temp_file, self.version_file)
+            if response_headers is None:
+                return
+            info = {'etag': response_headers.get('ETag'),
+                    'last_modified': response_headers.get('Last-Modified')}
+            if info['etag'] or info['last_modified']:
+                with open(self.version_file_cache_info, 'w') as f:
+                    json.dump(info, f)
 
     def _get_update_manifest(self):
         #  Downloads & Verifies version file signature.
         log.info('Loading version file...')
 
         data = self._download_manifest()
+        if data is None and self._manifest_not_modified is True and \
+                self.verified is True:
+            # The version file loaded by the last refresh is still
+            # current & was already parsed & verified
+            log.info('Using already verified version file')
+            return
+
+        # Set again once the new version file loads & verifies
+        self.ready = False
+        self.verified = False
         if data is None:
             # Its ok if this is None. If any exceptions are raised
             # that we can't handle we will just return an empty
@@ -464,8 +714,8 @@ class Client(object):
         # need to add the resouce name to the end of the request.
         for u in _urls:
             if not u.endswith('/'):
-                sanatized_urls.append(u + '/')
-            else:
+                u += '/'
+            # Removing duplicates while keeping the config order
+            if u not in sanatized_urls:
                 sanatized_urls.append(u)
-        # Removing duplicates
-        return list(set(sanatized_urls))
+        return sanatized_urls
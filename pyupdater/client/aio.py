@@ -0,0 +1,210 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+# Helpers behind the *_async client methods.  No async/await syntax
+# is used so the package can still be imported on python 2.  The
+# async methods themselves need python 3.4+.
+from __future__ import unicode_literals
+
+import collections
+import functools
+import logging
+import threading
+
+from pyupdater import settings
+from pyupdater.utils import lazy_import
+
+log = logging.getLogger(__name__)
+
+
+@lazy_import
+def asyncio():
+    import asyncio
+    return asyncio
+
+
+@lazy_import
+def concurrent():
+    import concurrent.futures
+    return concurrent
+
+
+class AsyncRunner(object):
+    """Runs blocking client calls on a thread pool & returns asyncio
+    futures for them.  The thread pool caps how many calls run at once.
+
+    Kwargs:
+
+        max_workers (int): Max number of calls running at the same time
+    """
+
+    def __init__(self, max_workers=settings.MAX_CONCURRENT_DOWNLOADS):
+        self.max_workers = max(1, max_workers)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        # Created on first use so sync only apps never start the
+        # thread pool
+        with self._lock:
+            if self._executor is None:
+                futures = concurrent.futures
+                self._executor = futures.ThreadPoolExecutor(self.max_workers)
+            return self._executor
+
+    def run(self, func, *args, **kwargs):
+        """Runs func on the thread pool
+
+        Args:
+
+            func (func): Blocking callable
+
+            args: Passed to func
+
+        Kwargs:
+
+            loop (obj): Event loop to bind the future to. Defaults to the
+                        running event loop
+
+            kwargs: Passed to func
+
+        Returns:
+
+            (obj): asyncio future with the return value of func
+        """
+        loop = get_loop(kwargs.pop('loop', None))
+        call = functools.partial(func, *args, **kwargs)
+        return loop.run_in_executor(self.executor, call)
+
+    def shutdown(self, wait=True):
+        "Stops the thread pool if it was started"
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+
+class ProgressIterator(object):
+    """Async iterator over progress events.  Meant to be added as a
+    progress hook.  Events can come from any thread & are handed to the
+    event loop awaiting the next one.
+
+        progress = update.progress_async()
+        async for status in progress:
+            print(status['percent_complete'])
+
+    Kwargs:
+
+        loop (obj): Event loop events are delivered on. Defaults to the
+                    running event loop of the coroutine iterating
+    """
+
+    # Put in the queue to end the iteration
+    _END = object()
+
+    def __init__(self, loop=None):
+        self._loop = loop
+        self._events = collections.deque()
+        # Future of the coroutine waiting for an event & its loop
+        self._waiter = None
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def __call__(self, status):
+        self._put_threadsafe(dict(status))
+
+    def close(self):
+        "Ends the iteration once all queued events have been read"
+        if self.closed is False:
+            self.closed = True
+            self._put_threadsafe(self._END)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        # Runs in the coroutine iterating, so the loop is looked up here
+        loop = get_loop(self._loop)
+        future = create_future(loop)
+        with self._lock:
+            if not self._events:
+                self._waiter = (future, loop)
+                return future
+            item = self._events.popleft()
+        self._resolve(future, item)
+        return future
+
+    def _put_threadsafe(self, item):
+        with self._lock:
+            self._events.append(item)
+            waiter = self._waiter
+        if waiter is None:
+            return
+        try:
+            waiter[1].call_soon_threadsafe(self._wake)
+        except RuntimeError:  # pragma: no cover
+            # Event loop is closed.  Nobody is left to read events
+            log.debug('Event loop closed. Dropping progress event')
+
+    def _wake(self):
+        # Always runs on the event loop of the waiting coroutine
+        with self._lock:
+            if self._waiter is None or not self._events:
+                return
+            future = self._waiter[0]
+            self._waiter = None
+            if future.done():
+                return
+            item = self._events.popleft()
+        self._resolve(future, item)
+
+    def _resolve(self, future, item):
+        if item is self._END:
+            # Keeps ending the iteration if __anext__ is called again
+            with self._lock:
+                self._events.appendleft(item)
+            future.set_exception(StopAsyncIteration())
+        else:
+            future.set_result(item)
+
+
+def get_loop(loop=None):
+    """Returns loop or the running event loop. Call from the coroutine
+    that needs the loop. Nothing keeps the loop it returns, so
+    asyncio.get_event_loop is never called outside a running loop
+
+    Kwargs:
+
+        loop (obj): Event loop passed by the caller
+
+    Returns:
+
+        (obj): Event loop
+    """
+    if loop is not None:
+        return loop
+    # Added in python 3.7. Raises RuntimeError if no loop is running
+    if hasattr(asyncio, 'get_running_loop'):
+        return asyncio.get_running_loop()
+    # Returns the running loop when called from a coroutine
+    return asyncio.get_event_loop()  # pragma: no cover
+
+
+def create_future(loop):
+    # loop.create_future was added in python 3.5.2
+    if hasattr(loop, 'create_future'):
+        return loop.create_future()
+    return asyncio.Future(loop=loop)  # pragma: no cover
@@ -0,0 +1,199 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+import six
+
+from pyupdater import settings
+from pyupdater.client.downloader import get_http_pool, release_response
+from pyupdater.client.throttle import ByteBudget
+from pyupdater.utils import get_filename, get_highest_version
+from pyupdater.utils.progress import call_progress_hooks, ProgressDispatcher
+
+log = logging.getLogger(__name__)
+
+
+class BatchUpdater(object):
+    """Downloads updates of many packages on a bounded number of
+    threads. Each package downloads one file over one request at a
+    time, so max_workers caps the requests running. Patch & file
+    downloads only start while their expected size fits in the bytes
+    in flight budget shared by all packages.
+
+    Progress hooks get the combined progress of all packages. Along
+    with the usual keys, status dicts have packages_total &
+    packages_done.
+
+    Args:
+
+        updates (dict): name: update object. Update objects of
+                        packages with no update are None
+
+    Kwargs:
+
+        max_workers (int): Max number of packages downloading at once
+
+        max_bytes_in_flight (int): Max combined size of packages
+                                   downloading at once. None for no limit
+
+        progress_hooks (list): Called with combined progress
+
+        progress_rate (float): Max progress events sent per second
+    """
+
+    def __init__(self, updates, max_workers=settings.MAX_CONCURRENT_DOWNLOADS,
+                 max_bytes_in_flight=None, progress_hooks=None,
+                 progress_rate=settings.PROGRESS_HOOK_RATE):
+        self.updates = updates
+        self.max_workers = max(int(max_workers), 1)
+        self.budget = ByteBudget(max_bytes_in_flight)
+        self.progress_hooks = progress_hooks or []
+        self.progress = ProgressDispatcher(self._call_progress_hooks,
+                                           progress_rate)
+        self._lock = threading.Lock()
+        # name: bytes downloaded so far
+        self._done = {}
+        self._packages_done = 0
+
+    def run(self):
+        """Downloads all updates. Blocks until done
+
+        Returns:
+
+            (dict): name: status. Status meanings:
+
+                True - Download successful
+
+                False - Download failed
+
+                None - No update available
+        """
+        queue = six.moves.queue.Queue()
+        sizes = {}
+        for name, update in self.updates.items():
+            if update is None:
+                continue
+            sizes[name] = _get_update_size(update)
+            queue.put(name)
+        self._sizes = sizes
+        self.progress.start(sum(sizes.values()))
+        results = dict((name, None) for name in self.updates)
+
+        workers = []
+        for _ in range(min(self.max_workers, len(sizes))):
+            t = threading.Thread(target=self._worker, args=(queue, results))
+            t.daemon = True
+            t.start()
+            workers.append(t)
+        for t in workers:
+            t.join()
+        self.progress.finish()
+        return results
+
+    def _worker(self, queue, results):
+        while 1:
+            try:
+                name = queue.get_nowait()
+            except six.moves.queue.Empty:
+                break
+            update = self.updates[name]
+            # Update objects of a client share one list of hooks. The
+            # package hook goes on a copy so other packages don't get
+            # its progress. Package progress is added to the combined
+            # progress
+            hooks = list(update.progress_hooks)
+            hooks.append(_PackageHook(self, name))
+            try:
+                # One request at a time per package keeps the number
+                # of requests under max_workers. Each patch & file
+                # download takes its size from the shared budget
+                results[name] = update.download(
+                    progress_hooks=hooks, download_segments=1,
+                    max_concurrent_downloads=1,
+                    byte_budget=self.budget) is True
+            except Exception as err:
+                log.debug(str(err), exc_info=True)
+                log.error('Failed to download update of {}'.format(name))
+                results[name] = False
+            with self._lock:
+                self._packages_done += 1
+                if results[name] is True:
+                    # Counting the whole package once it's done. Patch
+                    # downloads only report progress in patches
+                    self._done[name] = self._sizes[name]
+                self.progress.update(sum(self._done.values()))
+
+    def _package_progress(self, name, status):
+        # Called from download threads with progress of one package
+        if 'bytes_per_sec' not in status:
+            return
+        with self._lock:
+            self._done[name] = status.get('downloaded', 0)
+            self.progress.update(sum(self._done.values()))
+
+    def _call_progress_hooks(self, data):
+        data['packages_total'] = len(self._sizes)
+        data['packages_done'] = self._packages_done
+        call_progress_hooks(self.progress_hooks, data)
+
+
+class _PackageHook(object):
+    # Progress hook of one package in a batch
+
+    def __init__(self, batch, name):
+        self.batch = batch
+        self.name = name
+
+    def __call__(self, status):
+        self.batch._package_progress(self.name, status)
+
+
+def _get_update_size(update):
+    # Returns expected size of the full update. Taken from the version
+    # file if there, otherwise asked from the server. 0 if not known
+    latest = get_highest_version(update.name, update.platform,
+                                 update.easy_data)
+    size_key = '{}*{}*{}*{}*{}'.format(settings.UPDATES_KEY, update.name,
+                                       latest, update.platform, 'file_size')
+    size = update.easy_data.get(size_key)
+    if size is not None:
+        return int(size)
+    filename = get_filename(update.name, latest, update.platform,
+                            update.easy_data)
+    http_pool = update.http_pool
+    if http_pool is None:
+        http_pool = get_http_pool(update.verify)
+    for url in update.update_urls:
+        try:
+            data = http_pool.urlopen('GET', url + filename,
+                                     headers={'Range': 'bytes=0-0'},
+                                     preload_content=False)
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            continue
+        try:
+            if data.status == 206:
+                return int(data.headers.get('Content-Range').split('/')[1])
+            if data.status == 200:
+                return int(data.headers.get('Content-Length'))
+        except (AttributeError, IndexError, TypeError, ValueError):
+            log.debug('Cannot get size of {}'.format(filename))
+        finally:
+            release_response(data)
+    return 0
@@ -0,0 +1,271 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+
+from pyupdater import settings
+from pyupdater.utils import get_package_hashes, lazy_import, replace_file
+from pyupdater.utils.filelock import FileLock
+
+log = logging.getLogger(__name__)
+
+
+@lazy_import
+def appdirs():
+    import appdirs
+    return appdirs
+
+
+class DownloadCache(object):
+    """Content addressed store of downloaded files. Files are stored
+    by their sha256 hash, so any app on the machine downloading the
+    same bytes can use them. Files are hardlinked in & out of the
+    cache when possible & copied otherwise.
+
+    Every file taken from the cache is checked against its hash, so a
+    damaged or tampered cache is never trusted. When the cache grows
+    past max_size the least recently used files are removed.
+
+    Args:
+
+        path (str): Cache directory. Created if missing
+
+    Kwargs:
+
+        max_size (int): Max size of all cached files in bytes
+    """
+
+    def __init__(self, path, max_size=settings.SHARED_CACHE_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.objects_dir = os.path.join(path, 'objects')
+        if not os.path.exists(self.objects_dir):
+            try:
+                os.makedirs(self.objects_dir)
+            except OSError:  # pragma: no cover
+                # Another process beat us to it
+                if not os.path.isdir(self.objects_dir):
+                    raise
+        # Held while adding & evicting files
+        self.lock = FileLock(os.path.join(path, 'cache.lock'))
+
+    def get(self, file_hash, filename):
+        """Places the cached file with file_hash at filename
+
+        Args:
+
+            file_hash (str): sha256 hash of the file
+
+            filename (str): Where to put the file
+
+        Returns:
+
+            (bool) Meanings:
+
+                True - File was in the cache & verified
+
+                False - Cache miss
+        """
+        cached = self._object_path(file_hash)
+        if not os.path.exists(cached):
+            return False
+        temp = self._temp_name(filename)
+        try:
+            _link_or_copy(cached, temp)
+            # Cache files are only ever replaced, never written to,
+            # so what we got can't change after being checked
+            if get_package_hashes(temp) != file_hash:
+                log.warning('Removing damaged cache file {}'.format(cached))
+                self._remove(cached)
+                os.remove(temp)
+                return False
+            replace_file(temp, filename)
+        except (IOError, OSError) as err:
+            # Most likely evicted by another process
+            log.debug(str(err), exc_info=True)
+            if os.path.exists(temp):
+                os.remove(temp)
+            return False
+        self._touch(cached)
+        log.info('Got {} from shared cache'.format(filename))
+        return True
+
+    def read(self, file_hash):
+        """Returns contents of the cached file with file_hash
+
+        Args:
+
+            file_hash (str): sha256 hash of the file
+
+        Returns:
+
+            (bytes): File data. None on cache miss
+        """
+        cached = self._object_path(file_hash)
+        try:
+            with open(cached, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        if hashlib.sha256(data).hexdigest() != file_hash:
+            log.warning('Removing damaged cache file {}'.format(cached))
+            self._remove(cached)
+            return None
+        self._touch(cached)
+        return data
+
+    def put(self, file_hash, filename):
+        """Adds filename to the cache. The caller must have already
+        verified the file has file_hash
+
+        Args:
+
+            file_hash (str): sha256 hash of the file
+
+            filename (str): File to add
+        """
+        cached = self._object_path(file_hash)
+        if os.path.exists(cached):
+            self._touch(cached)
+            return
+        try:
+            self._makedirs(os.path.dirname(cached))
+            temp = self._temp_name(cached)
+            _link_or_copy(filename, temp)
+            self._commit(temp, cached)
+        except (IOError, OSError) as err:
+            log.warning('Failed to add {} to shared cache'.format(filename))
+            log.debug(str(err), exc_info=True)
+
+    def put_data(self, file_hash, data):
+        """Adds data to the cache. The caller must have already
+        verified data has file_hash
+
+        Args:
+
+            file_hash (str): sha256 hash of data
+
+            data (bytes): File data
+        """
+        cached = self._object_path(file_hash)
+        if os.path.exists(cached):
+            self._touch(cached)
+            return
+        try:
+            self._makedirs(os.path.dirname(cached))
+            temp = self._temp_name(cached)
+            with open(temp, 'wb') as f:
+                f.write(data)
+            self._commit(temp, cached)
+        except (IOError, OSError) as err:
+            log.warning('Failed to add data to shared cache')
+            log.debug(str(err), exc_info=True)
+
+    def size(self):
+        "Returns (int): Size of all cached files in bytes"
+        return sum(size for _, size, _ in self._list_objects())
+
+    def _commit(self, temp, cached):
+        # Moves a fully written temp file into place & makes room.
+        # Lock keeps evictions of concurrent puts from racing.
+        with self.lock:
+            replace_file(temp, cached)
+            self._evict()
+
+    def _evict(self):
+        # Called with self.lock held
+        objects = self._list_objects()
+        total = sum(size for _, size, _ in objects)
+        if total <= self.max_size:
+            return
+        # Oldest access first
+        for path, size, _ in sorted(objects, key=lambda o: o[2]):
+            if total <= self.max_size:
+                break
+            log.debug('Evicting {} from shared cache'.format(path))
+            self._remove(path)
+            total -= size
+
+    def _list_objects(self):
+        # Returns (path, size, last access) of every cached file
+        objects = []
+        for root, dirs, files in os.walk(self.objects_dir):
+            for f in files:
+                if f.endswith(settings.DOWNLOAD_TEMP_EXT):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                objects.append((path, stat.st_size, stat.st_mtime))
+        return objects
+
+    def _object_path(self, file_hash):
+        return os.path.join(self.objects_dir, file_hash[:2], file_hash)
+
+    @staticmethod
+    def _temp_name(filename):
+        # Unique per call so concurrent writers never share a temp file
+        return '{}.{}{}'.format(filename, uuid.uuid4().hex,
+                                settings.DOWNLOAD_TEMP_EXT)
+
+    @staticmethod
+    def _touch(path):
+        # mtime is used as the last access time for lru eviction
+        try:
+            os.utime(path, None)
+        except OSError:  # pragma: no cover
+            pass
+
+    @staticmethod
+    def _makedirs(path):
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:  # pragma: no cover
+                if not os.path.isdir(path):
+                    raise
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:  # pragma: no cover
+            pass
+
+
+def _link_or_copy(src, dst):
+    # Hardlinks save space & time but need the same filesystem
+    if hasattr(os, 'link'):
+        try:
+            os.link(src, dst)
+            return
+        except OSError as err:
+            log.debug('Hardlink failed, copying: {}'.format(err))
+    shutil.copyfile(src, dst)
+
+
+def default_cache_dir():
+    """Returns (str): Cache dir shared by all apps of the current user.
+    Used when no dir is set"""
+    return appdirs.user_cache_dir(settings.SHARED_CACHE_APP_NAME,
+                                  settings.SHARED_CACHE_COMPANY_NAME)
@@ -15,11 +15,21 @@
 # --------------------------------------------------------------------------
 from __future__ import unicode_literals
 
+import hashlib
 from io import BytesIO
+import json
 import logging
+import os
+import sys
+import threading
 import time
 
-from pyupdater.utils import get_hash, lazy_import
+import six
+
+from pyupdater import settings
+from pyupdater.client.retry import CircuitBreaker, RetryPolicy
+from pyupdater.utils import get_package_hashes, lazy_import, replace_file
+from pyupdater.utils.progress import call_progress_hooks, ProgressDispatcher
 
 log = logging.getLogger(__name__)
 
@@ -36,10 +46,70 @@ def urllib3():
     return urllib3
 
 
+def get_http_pool(verify=True):
+    """Creates a connection pool to be shared by all downloads. Reusing
+    the pool keeps connections alive between requests to the same host
+    & saves a tls handshake per file.
+
+    Kwargs:
+
+        verify (bool) Meaning:
+
+            True: Verify https connection
+
+            False: Don't verify https connection
+
+    Returns:
+
+        (obj): urllib3.PoolManager
+    """
+    # Room for a connection per host for every concurrent download
+    kwargs = dict(num_pools=settings.HTTP_POOL_NUM_POOLS,
+                  maxsize=settings.HTTP_POOL_MAXSIZE)
+    if verify is True:
+        return urllib3.PoolManager(cert_reqs=str('CERT_REQUIRED'),
+                                   ca_certs=certifi.where(), **kwargs)
+    return urllib3.PoolManager(**kwargs)
+
+
+def release_response(data):
+    """Gives the connection of a response back to the pool. If the body
+    wasn't read to the end, small bodies are read & dropped. Otherwise
+    the connection is closed, so the next request on it doesn't read
+    what is left of this body.
+
+    Args:
+
+        data (obj): urllib3.HTTPResponse
+    """
+    fp = getattr(data, '_fp', None)
+    if fp is not None and not fp.isclosed():
+        length = getattr(fp, 'length', None)
+        if length is not None and length <= settings.HTTP_DRAIN_MAX_SIZE:
+            try:
+                data.read()
+            except Exception as err:
+                log.debug(str(err), exc_info=True)
+                _close_response(data)
+        else:
+            _close_response(data)
+    data.release_conn()
+
+
+def _close_response(data):
+    data.close()
+    # Older urllib3 only closes the response & would hand the
+    # connection back with the rest of the body still unread
+    connection = getattr(data, '_connection', None)
+    if connection is not None:
+        connection.close()
+
+
 class FileDownloader(object):
-    """The FileDownloader object downloads files to memory and
-    verifies their hash.  If hash is verified data is either
-    written to disk to returned to calling object
+    """The FileDownloader object downloads files and verifies their
+    hash while the data is being received.  Data is either streamed
+    to a temp file on disk, which is moved into place once verified,
+    or kept in memory and returned to the calling object
 
     Args:
 
@@ -56,10 +126,47 @@ class FileDownloader(object):
             True: Verify https connection
 
             False: Don't verify https connection
+
+        http_pool (obj): Connection pool to use. If None a new pool
+                         is created
+
+        rate_limiter (obj): :class:`pyupdater.client.throttle.RateLimiter`
+                            used to cap download speed
+
+        progress_rate (float): Max progress events sent per second
+
+        headers (dict): Extra headers sent with every request
+
+        cache (obj): :class:`pyupdater.client.cache.DownloadCache`
+                     checked before downloading. Only used when
+                     hexdigest is given
+
+        retry_policy (obj): :class:`pyupdater.client.retry.RetryPolicy`
+                            used when a download fails
+
+        circuit_breaker (obj): :class:`pyupdater.client.retry.CircuitBreaker`
+                               used to skip failing urls
+
+        directory (str): Directory the file is written to. Defaults to
+                         the current directory
+
+        cancel (obj): threading.Event. Once set the download stops &
+                      the partial file is kept to resume later
+
+        mirrors (obj): :class:`pyupdater.client.mirrors.MirrorSelector`
+                       told how each request went
     """
     def __init__(self, filename, urls, hexdigest=None, verify=True,
-                 progress_hooks=[]):
+                 progress_hooks=[], http_pool=None, rate_limiter=None,
+                 progress_rate=settings.PROGRESS_HOOK_RATE, headers=None,
+                 cache=None, retry_policy=None, circuit_breaker=None,
+                 directory=None, cancel=None, mirrors=None):
         self.filename = filename
+        # Where the file is written. Downloads running at the same time
+        # can't rely on the current directory, which is process wide
+        self.file_path = filename
+        if directory is not None:
+            self.file_path = os.path.join(directory, filename)
         if isinstance(urls, list) is False:
             self.urls = [urls]
         else:
@@ -70,17 +177,48 @@ class FileDownloader(object):
         self.file_binary_data = None
         self.my_file = BytesIO()
         self.content_length = None
+        # Running hash of all received data.
+        # Set when a download starts
+        self._hasher = None
+        # Url the file is being downloaded from
+        self.url = None
+        self.headers = headers
+        # Status & headers of the last response. Lets callers handle
+        # things like 304 Not Modified
+        self.status = None
+        self.response_headers = {}
         self.progress_hooks = progress_hooks
-        if self.verify is True:
-            self.http_pool = urllib3.PoolManager(cert_reqs=str('CERT_'
-                                                 'REQUIRED'),
-                                                 ca_certs=certifi.where())
-        else:
-            self.http_pool = urllib3.PoolManager()
+        if http_pool is None:
+            http_pool = get_http_pool(self.verify)
+        self.http_pool = http_pool
+        self.rate_limiter = rate_limiter
+        self.progress = ProgressDispatcher(self._call_progress_hooks,
+                                           progress_rate)
+        if hexdigest is None:
+            cache = None
+        self.cache = cache
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker()
+        self.circuit_breaker = circuit_breaker
+        self.cancel = cancel
+        self.mirrors = mirrors
+        # Number of retries & bytes thrown away because a retry
+        # had to start over. Sent to progress hooks
+        self.retries = 0
+        self.wasted_bytes = 0
 
     def download_verify_write(self):
-        """Downloads file then verifies against provided hash
-        If hash verfies then writes data to disk
+        """Downloads file to disk then verifies against provided hash.
+        Data is written to a temp file while being hashed, so memory
+        usage stays the same no matter the size of the file. If hash
+        verifies the temp file is renamed to the final filename.
+
+        If the download gets interrupted the temp file is kept along
+        with a small info file. The next call will continue the
+        download where it left off, if the server supports it.
 
         Returns:
 
@@ -90,19 +228,66 @@ class FileDownloader(object):
 
                 False - Hashes don't match
         """
-        # Downloading data internally
-        self._download_to_memory()
+        if self.cache is not None:
+            if self.cache.get(self.hexdigest, self.file_path):
+                self._cache_hit(os.path.getsize(self.file_path))
+                return True
+        check = self._download_verify_write()
+        if check is True and self.cache is not None:
+            self.cache.put(self.hexdigest, self.file_path)
+        return check
+
+    def _download_verify_write(self):
+        temp_filename = self.file_path + settings.DOWNLOAD_TEMP_EXT
+        info_filename = temp_filename + settings.DOWNLOAD_INFO_EXT
+        offset = self._get_resume_offset(temp_filename, info_filename)
+        complete = False
+        try:
+            if offset > 0:
+                log.info('Resuming download of {} at byte '
+                         '{}'.format(self.filename, offset))
+                hasher = self._hash_partial_file(temp_filename, offset)
+                f = open(temp_filename, 'r+b')
+                f.truncate(offset)
+                f.seek(offset)
+            else:
+                hasher = None
+                f = open(temp_filename, 'wb')
+            with f:
+                complete = self._download(f, offset, hasher,
+                                          info_filename) is True
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+        if complete is False:
+            log.error('Failed to download {}'.format(self.filename))
+            self._keep_partial_file(temp_filename, info_filename)
+            return False
         check = self._check_hash()
-        # Nothing to verify against so return true
-        if check is None:
-            return True
-        if check is True:
-            self._write_to_file()
+        if os.path.exists(info_filename):
+            os.remove(info_filename)
+        # Nothing to verify against or hashes match
+        if check in (None, True):
+            replace_file(temp_filename, self.file_path)
             return True
-        else:
-            del self.file_binary_data
-            del self.my_file
-            return False
+        # Only a file read to the end that fails verification is
+        # thrown away
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        return False
+
+    def _keep_partial_file(self, temp_filename, info_filename):
+        # Keeps what we got so far of a download that didn't finish.
+        # The next call resumes from here. Without a hash we can't
+        # tell it's the same file next time, so it's removed
+        size = 0
+        if os.path.exists(temp_filename):
+            size = os.path.getsize(temp_filename)
+        if self.hexdigest is not None and size > 0:
+            self._write_resume_info(info_filename, size)
+            return
+        for filename in (temp_filename, info_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
 
     def download_verify_return(self):
         """
@@ -118,15 +303,58 @@ class FileDownloader(object):
 
                 None - If any verification didn't pass
         """
+        if self.cache is not None:
+            data = self.cache.read(self.hexdigest)
+            if data is not None:
+                self.file_binary_data = data
+                self._cache_hit(len(data))
+                return data
         self._download_to_memory()
         check = self._check_hash()
         if check is None:
             return self.file_binary_data
         if check is True:
+            if self.cache is not None:
+                self.cache.put_data(self.hexdigest, self.file_binary_data)
             return self.file_binary_data
         else:
             return None
 
+    def download_verify_into(self, sink):
+        """Downloads file into sink, a file like object, while checking
+        it against provided hash. Lets callers process data while it's
+        being received. sink may be truncated back to 0 if a download
+        has to start over. Streamed data isn't added to the cache.
+
+        Args:
+
+            sink (obj): Has write, seek, truncate & flush methods
+
+        Returns:
+
+            (bool) Meanings:
+
+                True - Hashes match or no hash was given during
+                       initialization.
+
+                False - Hashes don't match or no data received
+        """
+        if self.cache is not None:
+            data = self.cache.read(self.hexdigest)
+            if data is not None:
+                sink.write(data)
+                self._cache_hit(len(data))
+                return True
+        if self._download(sink) is not True:
+            return False
+        return self._check_hash() in (None, True)
+
+    def _cache_hit(self, size):
+        # Progress hooks still get told the file is done
+        self.content_length = size
+        self.progress.start(size)
+        self.progress.finish(size)
+
     @staticmethod
     def _best_block_size(elapsed_time, bytes):
         # Returns best block size for current Internet connection speed
@@ -142,122 +370,330 @@ class FileDownloader(object):
         return int(rate)
 
     def _download_to_memory(self):
+        self.my_file = BytesIO()
+        if self._download(self.my_file) is False:
+            return None
+        # Flushing data to prepare to return to caller
+        self.my_file.flush()
+        self.my_file.seek(0)
+        self.file_binary_data = self.my_file.read()
+
+    def _download(self, sink, offset=0, hasher=None, info_filename=None):
+        # Retries with backoff when no url can be reached or the
+        # connection drops. Retries continue from the last block
+        # received, so only a server that can't resume makes us
+        # download the same bytes twice.
+        attempt = 0
+        while 1:
+            if self._cancelled():
+                return False
+            try:
+                return self._stream(sink, offset, hasher, info_filename)
+            except _Interrupted as err:
+                attempt += 1
+                if attempt > self.retry_policy.retries:
+                    if err.exc_info is None:
+                        return False
+                    six.reraise(*err.exc_info)
+                offset, hasher = err.offset, err.hasher
+            self.retries += 1
+            delay = self.retry_policy.delay(attempt)
+            log.info('Retrying download of {} in {:.1f} seconds'.format(
+                     self.filename, delay))
+            if self.cancel is not None:
+                # Wakes up as soon as the download is cancelled
+                self.cancel.wait(delay)
+            else:
+                time.sleep(delay)
+
+    def _cancelled(self):
+        return self.cancel is not None and self.cancel.is_set()
+
+    def _stream(self, sink, offset=0, hasher=None, info_filename=None):
+        # Reads the response block by block. Each block is written to
+        # sink, a file like object, and added to the running hash.
+        #
+        # If offset is passed we request the rest of the file
+        # starting at offset. hasher should already contain the
+        # hash of the first offset bytes. If info_filename is
+        # passed, progress is saved to it every so often so an
+        # interrupted download can be resumed.
+        #
+        # Raises _Interrupted if the download should be retried.
+        # Returns False if the file wasn't modified or the download
+        # was cancelled
+        headers = None
+        if offset > 0:
+            headers = {'Range': 'bytes={}-'.format(offset)}
         # Attempting to correct urls with spaces in them.
         # Forgot when I ran into the error but have tests to
         # ensure it doesn't happen again
-        data = self._create_response()
-        if data is None or data == '':
-            return None
+        data = self._create_response(headers)
+        if data is None:
+            raise _Interrupted(offset, hasher)
+        self.status = data.status
+        self.response_headers = data.headers
+
+        if data.status == 304:
+            log.debug('{} not modified'.format(self.filename))
+            release_response(data)
+            return False
+
+        if offset > 0 and data.status != 206:
+            log.info('Server cannot resume download. Starting over')
+            self.wasted_bytes += offset
+            sink.seek(0)
+            sink.truncate()
+            offset = 0
+            hasher = None
+            # Most likely a 416. Range not satisfiable
+            if data.status != 200:
+                release_response(data)
+                data = self._create_response()
+                if data is None:
+                    raise _Interrupted(offset, hasher)
 
+        if hasher is None:
+            hasher = hashlib.sha256()
+        self._hasher = hasher
+        if info_filename is not None:
+            self._write_resume_info(info_filename, offset)
+        next_checkpoint = offset + settings.DOWNLOAD_CHECKPOINT_SIZE
         # Getting length of file to show progress
-        self.content_length = self._get_content_length(data)
+        self.content_length = self._get_content_length(data) + offset
         # Setting start point to show progress
-        recieved_data = 0
+        recieved_data = offset
+        self.progress.start(self.content_length, offset)
 
-        start_download = time.time()
+        read = self._block_reader(data)
         while 1:
+            if self._cancelled():
+                log.debug('Download of {} cancelled'.format(self.filename))
+                release_response(data)
+                self.progress.finish(recieved_data, 'cancelled')
+                return False
             # Grabbing start time for use with best block size
             start_block = time.time()
-            block = data.read(self.b_size)
+            try:
+                block = read(self._read_size(self.b_size))
+            except Exception as err:
+                log.debug(str(err), exc_info=True)
+                log.warning('Lost connection to {}'.format(self.url))
+                release_response(data)
+                self.circuit_breaker.record_failure(self.url)
+                # Everything up to here is in sink & the hash
+                raise _Interrupted(recieved_data, self._hasher,
+                                   sys.exc_info())
             # Grabbing end time for use with best block size
             end_block = time.time()
             if len(block) == 0:
                 # No more data, get out of this never ending loop!
                 break
+            self._throttle(len(block))
             # Calculating the best block size for the current connection
             # speed
             self.b_size = self._best_block_size(end_block - start_block,
                                                 len(block))
-            log.debug('Block size: %s' % self.b_size)
-            # Saving data to memory
-            # ToDo: Consider writing file to cache to enable resumable
-            #       downloads
-            self.my_file.write(block)
+            sink.write(block)
+            self._hasher.update(block)
             recieved_data += len(block)
-            percent = self._calc_progress_percent(recieved_data,
-                                                  self.content_length)
-            time_left = FileDownloader._calc_eta(start_download, time.time(),
-                                                 self.content_length,
-                                                 recieved_data)
-            status = {'total': self.content_length,
-                      'downloaded': recieved_data,
-                      'status': 'downloading',
-                      'percent_complete': percent,
-                      'time': time_left}
-            self._call_progress_hooks(status)
-
-        # Flushing data to prepare to write to file
-        self.my_file.flush()
-        self.my_file.seek(0)
-        self.file_binary_data = self.my_file.read()
-        status = {'total': self.content_length,
-                  'downloaed': recieved_data,
-                  'status': 'finished',
-                  'time': '00:00'}
-        self._call_progress_hooks(status)
+            if info_filename is not None and recieved_data >= next_checkpoint:
+                # Making sure everything up to the offset we save is
+                # actually on disk
+                sink.flush()
+                self._write_resume_info(info_filename, recieved_data)
+                next_checkpoint = (recieved_data +
+                                   settings.DOWNLOAD_CHECKPOINT_SIZE)
+            self.progress.update(recieved_data)
+
+        # Giving the connection back to the pool to be reused
+        release_response(data)
+        if recieved_data < self._get_expected_length(data, offset):
+            log.warning('Connection to {} closed early'.format(self.url))
+            self.circuit_breaker.record_failure(self.url)
+            raise _Interrupted(recieved_data, self._hasher)
+        self.circuit_breaker.record_success(self.url)
+        self.progress.finish(recieved_data)
         log.debug('Download Complete')
+        return True
+
+    @staticmethod
+    def _block_reader(data):
+        # Returns a function that reads the next block of up to size
+        # bytes from the response.  If the body isn't encoded, blocks
+        # are read straight from the raw response into one reused
+        # buffer & returned as memoryviews, so no bytes object is made
+        # per block. Views are only valid until the next read.
+        fp = getattr(data, '_fp', None)
+        if data.headers.get('content-encoding') or \
+                not hasattr(fp, 'readinto'):
+            # Python 2 httplib has no readinto
+            return data.read
+
+        buf = [bytearray(0)]
+
+        def read(size):
+            if len(buf[0]) < size:
+                # Only grows while the block size is growing
+                buf[0] = bytearray(size)
+            view = memoryview(buf[0])[:size]
+            return view[:fp.readinto(view)]
+        return read
+
+    def _read_size(self, size):
+        # Keeps blocks small enough for the rate limiter to
+        # smooth out the transfer
+        if self.rate_limiter is None:
+            return size
+        return self.rate_limiter.block_size(size)
+
+    def _throttle(self, size):
+        # Blocks while over the download speed cap
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume(size)
 
     # Calling all progress hooks
     def _call_progress_hooks(self, data):
-        log.debug(data)
-        for ph in self.progress_hooks:
-            try:
-                ph(data)
-            except Exception as err:
-                log.debug(str(err), exc_info=True)
-                log.error('Exception in callback: '
-                          '{}'.format(ph.__name__))
+        data['retries'] = self.retries
+        data['wasted_bytes'] = self.wasted_bytes
+        call_progress_hooks(self.progress_hooks, data)
 
     # Creating response object to start download
-    # Attempting to do some error correction for aws s3 urls
-    def _create_response(self):
+    def _create_response(self, headers=None):
+        # Returns a response from the first url that works. Urls the
+        # circuit breaker is skipping are left out. Returns None if
+        # all urls failed
+        if self.headers:
+            _headers = dict(self.headers)
+            _headers.update(headers or {})
+            headers = _headers
         data = None
-        for url in self.urls:
-            file_url = url + self.filename
-            log.debug('Url for request: {}'.format(file_url))
-            try:
-                data = self.http_pool.urlopen('GET', file_url,
-                                              preload_content=False)
-                # Have to catch url with spaces
-                if data.status == 505:
-                    raise urllib3.exceptions.HTTPError
-            except urllib3.exceptions.HTTPError:
-                log.debug('There may be spaces in an S3 url...')
-                file_url = file_url.replace(' ', '+')
-                log.debug('S3 updated url {}'.format(file_url))
+        for url in self.circuit_breaker.filter(self.urls) or self.urls:
+            start = time.time()
+            data = self._open_url(url, headers)
+            if data is not None and \
+                    data.status in settings.DOWNLOAD_RETRY_STATUS:
+                log.debug('Got status {} from {}'.format(data.status, url))
+                release_response(data)
                 data = None
-            except urllib3.exceptions.SSLError:
-                log.error('SSL cert not verified')
-                data = ''
-            except Exception as e:
-                # Catch whatever else comes up and log it
-                # to help fix other http related issues
-                log.error(str(e), exc_info=True)
-                data = ''
-            else:
-                break
-
-            # Try request again with spaces in url replaced with +
             if data is None:
-                # Let's try one more time with the fixed url
-                try:
-                    data = self.http_pool.urlopen('GET', file_url,
-                                                  preload_content=False)
-                except urllib3.exceptions.SSLError:
-                    log.error('SSL cert not verified')
-                except Exception as e:
-                    log.error(str(e), exc_info=True)
-                    self.file_binary_data = None
-                else:
-                    break
+                self.circuit_breaker.record_failure(url)
+                self._mirror_failure(url)
+                continue
+            self._mirror_success(url, time.time() - start)
+            self.url = url
+            break
+        return data
+
+    def _mirror_success(self, url, latency):
+        if self.mirrors is not None:
+            self.mirrors.record_success(url, latency)
+
+    def _mirror_failure(self, url):
+        if self.mirrors is not None:
+            self.mirrors.record_failure(url)
+
+    # Attempting to do some error correction for aws s3 urls
+    def _open_url(self, url, headers):
+        file_url = url + self.filename
+        log.debug('Url for request: {}'.format(file_url))
+        try:
+            data = self.http_pool.urlopen('GET', file_url,
+                                          headers=headers,
+                                          preload_content=False)
+            # Have to catch url with spaces
+            if data.status == 505:
+                release_response(data)
+                raise urllib3.exceptions.HTTPError
+        except urllib3.exceptions.SSLError:
+            log.error('SSL cert not verified')
+            return None
+        except urllib3.exceptions.HTTPError:
+            log.debug('There may be spaces in an S3 url...')
+            file_url = file_url.replace(' ', '+')
+            log.debug('S3 updated url {}'.format(file_url))
+        except Exception as e:
+            # Catch whatever else comes up and log it
+            # to help fix other http related issues
+            log.error(str(e), exc_info=True)
+            return None
+        else:
+            log.debug('Downloading {} from:\n{}'.format(self.filename,
+                                                        file_url))
+            return data
 
+        # Try request again with spaces in url replaced with +
+        try:
+            data = self.http_pool.urlopen('GET', file_url,
+                                          headers=headers,
+                                          preload_content=False)
+        except urllib3.exceptions.SSLError:
+            log.error('SSL cert not verified')
+            return None
+        except Exception as e:
+            log.error(str(e), exc_info=True)
+            return None
         log.debug('Downloading {} from:\n{}'.format(self.filename, file_url))
         return data
 
-    def _write_to_file(self):
-        # Writes download data in memory to disk
-        with open(self.filename, 'wb') as f:
-            f.write(self.file_binary_data)
+    def _read_resume_info(self, temp_filename, info_filename):
+        # Returns the resume info of a partial download. Only if we
+        # are downloading the exact same file as last time. Returns
+        # None if the download should start from scratch.
+        if self.hexdigest is None:
+            return None
+        if not os.path.exists(temp_filename) or \
+                not os.path.exists(info_filename):
+            return None
+        try:
+            with open(info_filename, 'r') as f:
+                info = json.load(f)
+            info['offset'] = int(info['offset'])
+            file_hash = info['file_hash']
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Cannot read resume info')
+            return None
+        if file_hash != self.hexdigest:
+            log.debug('Partial download is of a different file')
+            return None
+        return info
+
+    def _get_resume_offset(self, temp_filename, info_filename):
+        # Returns the offset to resume a download from. Returns 0 if
+        # the download should start from scratch.
+        info = self._read_resume_info(temp_filename, info_filename)
+        if info is None:
+            return 0
+        url = info.get('url')
+        # Ensuring we get the rest of the file from the same place
+        if url in self.urls:
+            self.urls = [url] + [u for u in self.urls if u != url]
+        # Kept in the resume info if no url can be reached
+        self.url = url
+        return min(info['offset'], os.path.getsize(temp_filename))
+
+    def _write_resume_info(self, info_filename, offset, **kwargs):
+        info = {'url': self.url,
+                'file_hash': self.hexdigest,
+                'offset': offset}
+        info.update(kwargs)
+        with open(info_filename, 'w') as f:
+            f.write(json.dumps(info))
+
+    @staticmethod
+    def _hash_partial_file(filename, length):
+        # Returns a hash object fed with the first length bytes of
+        # filename.
+        hasher = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            while length > 0:
+                block = f.read(min(length, settings.DOWNLOAD_CHECKPOINT_SIZE))
+                if len(block) == 0:
+                    break
+                hasher.update(block)
+                length -= len(block)
+        return hasher
 
     def _check_hash(self):
         # Checks hash of downloaded file
@@ -266,44 +702,396 @@ class FileDownloader(object):
             # So just return any data recieved
             log.debug('No hash to verify')
             return None
-        if self.file_binary_data is None:
+        if self._hasher is None:
             # Exit quickly if we got nohting to compare
-            # Also I'm sure we'll get an exception trying to
-            # pass None to get hash :)
             log.debug('Cannot verify file hash - No Data')
             return False
         log.debug('Checking file hash')
         log.debug('Update hash: {}'.format(self.hexdigest))
 
-        file_hash = get_hash(self.file_binary_data)
+        file_hash = self._hasher.hexdigest()
+        log.debug('Hash for downloaded data: {}'.format(file_hash))
         if file_hash == self.hexdigest:
             log.debug('File hash verified')
             return True
         log.debug('Cannot verify file hash')
         return False
 
+    @staticmethod
+    def _get_expected_length(data, offset):
+        # Returns total bytes we should have after reading data. 0 if
+        # not known. Encoded bodies are decoded while read so their
+        # length can't be checked
+        length = data.headers.get('Content-Length')
+        if length is None or data.headers.get('content-encoding'):
+            return 0
+        try:
+            return int(length) + offset
+        except ValueError:
+            return 0
+
     def _get_content_length(self, data):
         content_length = int(data.headers.get("Content-Length", 100001))
         log.debug('Got content length of: %s', content_length)
         return content_length
 
+
+class SegmentedDownloader(FileDownloader):
+    """Downloads a file in segments over concurrent Range requests.
+    Each worker thread sticks to one of the urls and pulls segments
+    from a shared queue, so fast mirrors end up downloading more of
+    the file than slow ones. Segments are written straight into a
+    preallocated temp file & the hash of the whole file is checked
+    once all segments are in.
+
+    Falls back to a regular streaming download when the server
+    doesn't support ranges, the file is too small to be worth
+    splitting or there is a partial download to resume.
+
+    Args:
+
+        filename (str): The name of file to download
+
+        urls (list): List of urls to use for file download
+
+    Kwargs:
+
+        hexdigest (str): The hash of the file to download
+
+        verify (bool) Meaning:
+
+            True: Verify https connection
+
+            False: Don't verify https connection
+
+        http_pool (obj): Connection pool to use. If None a new pool
+                         is created
+
+        segments (int): Max number of concurrent requests
+
+        rate_limiter (obj): :class:`pyupdater.client.throttle.RateLimiter`
+                            used to cap the combined speed of all segments
+
+        progress_rate (float): Max progress events sent per second
+
+        cache (obj): :class:`pyupdater.client.cache.DownloadCache`
+                     checked before downloading
+
+        retry_policy (obj): :class:`pyupdater.client.retry.RetryPolicy`
+                            used when a segment fails
+
+        circuit_breaker (obj): :class:`pyupdater.client.retry.CircuitBreaker`
+                               used to skip failing urls
+
+        directory (str): Directory the file is written to. Defaults to
+                         the current directory
+
+        byte_budget (obj): :class:`pyupdater.client.throttle.ByteBudget`
+                           each segment takes its size from while it
+                           downloads. A regular download takes the size
+                           of the file
+
+        file_size (int): Expected size of the file. Used with
+                         byte_budget. If None it's asked from the server
+
+        mirrors (obj): :class:`pyupdater.client.mirrors.MirrorSelector`
+                       told how each request & segment went
+    """
+    def __init__(self, filename, urls, hexdigest=None, verify=True,
+                 progress_hooks=[], http_pool=None,
+                 segments=settings.DOWNLOAD_SEGMENTS, rate_limiter=None,
+                 progress_rate=settings.PROGRESS_HOOK_RATE, cache=None,
+                 retry_policy=None, circuit_breaker=None, directory=None,
+                 byte_budget=None, file_size=None, mirrors=None):
+        super(SegmentedDownloader, self).__init__(
+            filename, urls, hexdigest, verify, progress_hooks, http_pool,
+            rate_limiter, progress_rate, cache=cache,
+            retry_policy=retry_policy, circuit_breaker=circuit_breaker,
+            directory=directory, mirrors=mirrors)
+        self.segments = max(int(segments), 1)
+        self.byte_budget = byte_budget
+        self.file_size = file_size
+        self._lock = threading.Lock()
+        # Set to True by any worker to stop all other workers
+        self._failed = False
+        # Total bytes received by all workers
+        self._received = 0
+        # Start & end, inclusive, of byte ranges still missing
+        self._pending = {}
+
+    def _download_verify_write(self):
+        # Downloads file in segments to disk then verifies against
+        # provided hash.  If hash verifies the temp file is renamed to
+        # the final filename
+        self._failed = False
+        self._received = 0
+        temp_filename = self.file_path + settings.DOWNLOAD_TEMP_EXT
+        info_filename = temp_filename + settings.DOWNLOAD_INFO_EXT
+        if self.segments < 2 or self.hexdigest is None:
+            return self._download_whole(self.file_size)
+
+        info = self._read_resume_info(temp_filename, info_filename)
+        if info is not None and 'segments' not in info:
+            # Partial download of a regular streaming download
+            return self._download_whole(self.file_size)
+
+        total = self._get_total_size()
+        if total is None or \
+                total < settings.SEGMENTED_DOWNLOAD_MIN_SIZE:
+            # A partial segmented download is resumed from the end of
+            # the bytes it got from the start of the file
+            log.debug('Not using segmented download')
+            return self._download_whole(total or self.file_size)
+
+        ranges = None
+        if info is not None:
+            ranges = self._get_resume_ranges(info, temp_filename, total)
+        self.content_length = total
+        try:
+            if ranges is None:
+                log.info('Downloading {} in segments'.format(self.filename))
+                ranges = [(0, total - 1)]
+                with open(temp_filename, 'wb') as f:
+                    f.truncate(total)
+            else:
+                log.info('Resuming segmented download of {}'.format(
+                         self.filename))
+            self._pending = dict(ranges)
+            self._download_segments(temp_filename, total, info_filename)
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            self._failed = True
+
+        if self._failed is True:
+            log.error('Failed to download {}'.format(self.filename))
+            self._keep_segments(temp_filename, info_filename, total)
+            return False
+
+        log.debug('Checking file hash')
+        file_hash = get_package_hashes(temp_filename)
+        if os.path.exists(info_filename):
+            os.remove(info_filename)
+        if file_hash == self.hexdigest:
+            replace_file(temp_filename, self.file_path)
+            self.progress.finish(total)
+            log.debug('Download Complete')
+            return True
+        log.debug('Cannot verify file hash')
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        return False
+
+    def _download_whole(self, size):
+        # Regular streaming download. Takes size, the expected size of
+        # the file, from the byte budget while it runs
+        if self.byte_budget is None:
+            return super(SegmentedDownloader, self)._download_verify_write()
+        if size is None:
+            size = self._get_total_size()
+        taken = self.byte_budget.acquire(int(size or 0))
+        try:
+            return super(SegmentedDownloader, self)._download_verify_write()
+        finally:
+            self.byte_budget.release(taken)
+
     @staticmethod
-    def _calc_eta(start, now, total, current):
-        # Not currently implemented
-        # Calculates remaining time of download
-        if total is None:
-            return '--:--'
-        dif = now - start
-        if current == 0 or dif < 0.001:  # One millisecond
-            return '--:--'
-        rate = float(current) / dif
-        eta = int((float(total) - float(current)) / rate)
-        (eta_mins, eta_secs) = divmod(eta, 60)
-        if eta_mins > 99:
-            return '--:--'
-        return '%02d:%02d' % (eta_mins, eta_secs)
-
-    def _calc_progress_percent(self, x, y):
-        percent = float(x) / y * 100
-        percent = '%.1f' % percent
-        return percent
+    def _get_resume_ranges(info, temp_filename, total):
+        # Returns the byte ranges a partial segmented download is
+        # missing. None if it doesn't match the file on the server
+        try:
+            ranges = [(int(s), int(e)) for s, e in info['segments']]
+            same_size = int(info['total']) == total
+        except (KeyError, TypeError, ValueError):
+            log.warning('Cannot read resume info')
+            return None
+        if same_size is False or os.path.getsize(temp_filename) != total:
+            log.debug('Partial download is of a different size')
+            return None
+        return ranges
+
+    def _keep_segments(self, temp_filename, info_filename, total):
+        # Keeps the segments we got so far. The info file has the
+        # ranges still missing, which the next call downloads. The
+        # offset is the end of the bytes we got from the start of the
+        # file, so a regular download can resume it too.
+        with self._lock:
+            ranges = sorted(self._pending.items())
+        missing = sum(e - s + 1 for s, e in ranges)
+        if ranges and os.path.exists(temp_filename) and missing < total:
+            self._write_resume_info(info_filename, ranges[0][0],
+                                    total=total,
+                                    segments=[list(r) for r in ranges])
+            return
+        for filename in (temp_filename, info_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _get_total_size(self):
+        # Asks for the first byte of the file. If the server answers
+        # with a partial response we know it supports ranges and we
+        # get the total size of the file.
+        data = self._create_response({'Range': 'bytes=0-0'})
+        if data is None:
+            return None
+        try:
+            if data.status != 206:
+                log.debug('Server does not support ranges')
+                return None
+            content_range = data.headers.get('Content-Range', '')
+            total = int(content_range.split('/')[1])
+        except (IndexError, ValueError):
+            log.debug('Bad Content-Range header')
+            return None
+        finally:
+            release_response(data)
+        log.debug('Got total size of: {}'.format(total))
+        return total
+
+    def _download_segments(self, filename, total, info_filename):
+        segment_size = max(settings.SEGMENTED_DOWNLOAD_MIN_SIZE //
+                           self.segments,
+                           total // (self.segments *
+                                     settings.DOWNLOAD_SEGMENTS_PER_WORKER))
+        segments = six.moves.queue.Queue()
+        pending = {}
+        for first, last in sorted(self._pending.items()):
+            for start in range(first, last + 1, segment_size):
+                end = min(start + segment_size - 1, last)
+                # start, end & number of failed attempts
+                segments.put((start, end, 0))
+                pending[start] = end
+        self._pending = pending
+        self._received = total - sum(e - s + 1 for s, e in pending.items())
+
+        self.progress.start(total, self._received)
+        urls = self.circuit_breaker.filter(self.urls) or self.urls
+        workers = []
+        for i in range(min(self.segments, segments.qsize())):
+            # Spreading workers over all mirrors
+            url = urls[i % len(urls)]
+            t = threading.Thread(target=self._segment_worker,
+                                 args=(url, filename, segments, total,
+                                       info_filename))
+            t.daemon = True
+            t.start()
+            workers.append(t)
+        for t in workers:
+            t.join()
+
+    def _segment_worker(self, url, filename, segments, total, info_filename):
+        with open(filename, 'r+b') as f:
+            while self._failed is False:
+                try:
+                    start, end, attempts = segments.get_nowait()
+                except six.moves.queue.Empty:
+                    break
+                received = 0
+                taken = 0
+                if self.byte_budget is not None:
+                    taken = self.byte_budget.acquire(end - start + 1)
+                try:
+                    received = self._download_segment(url, f, start, end)
+                except Exception as err:
+                    log.debug(str(err), exc_info=True)
+                finally:
+                    if self.byte_budget is not None:
+                        self.byte_budget.release(taken)
+                self._segment_received(f, start, end, received, total,
+                                       info_filename)
+                if received == end - start + 1:
+                    self.circuit_breaker.record_success(url)
+                    continue
+                log.debug('Segment {}-{} failed from {}'.format(
+                          start, end, url))
+                self.circuit_breaker.record_failure(url)
+                self._mirror_failure(url)
+                attempts += 1
+                if attempts > self.retry_policy.retries * len(self.urls):
+                    log.error('Failed to download segment from all urls')
+                    self._failed = True
+                    break
+                with self._lock:
+                    self.retries += 1
+                # Giving the rest of the segment back for another
+                # worker, most likely using another url, to try
+                segments.put((start + received, end, attempts))
+                time.sleep(self.retry_policy.delay(attempts))
+                # Trying the next mirror ourselves
+                url = self._next_url(url)
+
+    def _segment_received(self, f, start, end, received, total,
+                          info_filename):
+        # Marks received bytes of segment start-end as done. Once a
+        # whole segment is in, the ranges still missing are saved so
+        # an interrupted download resumes from there. Data is flushed
+        # first so the info file never has bytes that aren't in the
+        # temp file.
+        if received == 0:
+            return
+        with self._lock:
+            f.flush()
+            del self._pending[start]
+            if start + received <= end:
+                self._pending[start + received] = end
+                return
+            ranges = sorted(self._pending.items())
+            offset = ranges[0][0] if ranges else total
+            self._write_resume_info(info_filename, offset, total=total,
+                                    segments=[list(r) for r in ranges])
+
+    def _next_url(self, url):
+        # Returns the url after url that isn't being skipped
+        urls = self.circuit_breaker.filter(self.urls) or self.urls
+        if url not in urls:
+            return urls[0]
+        return urls[(urls.index(url) + 1) % len(urls)]
+
+    def _download_segment(self, url, f, start, end):
+        # Downloads bytes start-end, inclusive, from url & writes them
+        # to f at the same offset. Returns number of bytes written.
+        # Bytes written before the connection failed count, the
+        # retry only asks for the rest.
+        file_url = url + self.filename
+        headers = {'Range': 'bytes={}-{}'.format(start, end)}
+        request_start = time.time()
+        data = self.http_pool.urlopen('GET', file_url, headers=headers,
+                                      preload_content=False)
+        if data.status != 206:
+            release_response(data)
+            return 0
+        self._mirror_success(url, time.time() - request_start)
+        received = 0
+        position = start
+        length = end - start + 1
+        read = self._block_reader(data)
+        try:
+            while received < length:
+                block = read(self._read_size(min(self.b_size,
+                                                 length - received)))
+                if len(block) == 0:
+                    break
+                self._throttle(len(block))
+                with self._lock:
+                    f.seek(position)
+                    f.write(block)
+                    self._received += len(block)
+                    self.progress.update(self._received)
+                position += len(block)
+                received += len(block)
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+        finally:
+            release_response(data)
+        return received
+
+
+class _Interrupted(Exception):
+    # Raised when a download should be retried. Holds what's
+    # needed to continue where it stopped
+    def __init__(self, offset, hasher, exc_info=None):
+        super(_Interrupted, self).__init__()
+        self.offset = offset
+        self.hasher = hasher
+        # Error that stopped the download. Raised again once out
+        # of retries
+        self.exc_info = exc_info
@@ -0,0 +1,235 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import threading
+import time
+
+from pyupdater import settings
+from pyupdater.client.downloader import get_http_pool, release_response
+from pyupdater.utils import lazy_import, replace_file
+
+log = logging.getLogger(__name__)
+
+
+@lazy_import
+def urllib3():
+    import urllib3
+    return urllib3
+
+
+class MirrorSelector(object):
+    """Ranks update urls by how fast they respond. Urls are probed
+    at the same time and ranked by time to first byte. Downloads
+    report how their requests went too, so the ranking follows real
+    traffic. Urls that failed recently are pushed down the list.
+    Stats are saved to the data dir so the ranking carries over
+    between runs. An url is only probed again once it has had no
+    news for MIRROR_PROBE_INTERVAL seconds.
+
+    Args:
+
+        urls (list): List of update urls
+
+        data_dir (str): Directory to save mirror stats in
+
+    Kwargs:
+
+        verify (bool) Meaning:
+
+            True: Verify https connection
+
+            False: Don't verify https connection
+
+        http_pool (obj): Connection pool to use. If None a new pool
+                         is created
+    """
+
+    def __init__(self, urls, data_dir, verify=True, http_pool=None):
+        self.urls = urls
+        self.stats_file = os.path.join(data_dir, settings.MIRROR_STATS_FILE)
+        self.verify = verify
+        self.stats = self._load_stats()
+        self._lock = threading.Lock()
+        if http_pool is None:
+            http_pool = get_http_pool(self.verify)
+        self.http_pool = http_pool
+
+    def rank(self):
+        """Probes urls with old stats & returns all urls sorted from
+        best to worst
+
+        Returns:
+
+            (list): Update urls
+        """
+        if len(self.urls) > 1:
+            self._probe_all()
+            self.save_stats()
+        ranked = self.ranked_urls()
+        log.debug('Ranked urls: {}'.format(ranked))
+        return ranked
+
+    def ranked_urls(self):
+        """Returns urls sorted from best to worst using the stats
+        we already have. Urls with no stats keep their config order.
+
+        Returns:
+
+            (list): Update urls
+        """
+        order = dict((u, i) for i, u in enumerate(self.urls))
+        return sorted(self.urls, key=lambda u: (self._score(u), order[u]))
+
+    def record_success(self, url, latency):
+        """Updates stats of url after a successful request
+
+        Args:
+
+            url (str): Update url
+
+            latency (float): Seconds until the first byte was received
+        """
+        if url not in self.urls:
+            return
+        with self._lock:
+            stat = self._get_stat(url)
+            if stat['latency'] is None:
+                stat['latency'] = latency
+            else:
+                # Smoothing to not let a single slow request
+                # reorder mirrors
+                weight = settings.MIRROR_LATENCY_WEIGHT
+                stat['latency'] = (weight * latency +
+                                   (1 - weight) * stat['latency'])
+            # Old errors matter less & less
+            stat['errors'] = stat['errors'] / 2.0
+
+    def record_failure(self, url):
+        """Updates stats of url after a failed request
+
+        Args:
+
+            url (str): Update url
+        """
+        if url not in self.urls:
+            return
+        with self._lock:
+            stat = self._get_stat(url)
+            stat['errors'] += 1
+
+    def save_stats(self):
+        "Saves stats to the data dir for the next run"
+        temp_file = self.stats_file + settings.DOWNLOAD_TEMP_EXT
+        try:
+            with self._lock:
+                # Only keeping stats of urls still in use
+                stats = dict((u, s) for u, s in self.stats.items()
+                             if u in self.urls)
+                with open(temp_file, 'w') as f:
+                    f.write(json.dumps(stats))
+            replace_file(temp_file, self.stats_file)
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Cannot save mirror stats')
+
+    def _get_stat(self, url):
+        # Called with self._lock held. Returns stats of url & marks
+        # them as up to date
+        stat = self.stats.setdefault(url, {'latency': None, 'errors': 0})
+        stat['updated'] = time.time()
+        return stat
+
+    def _score(self, url):
+        # Lower is better. Every recent error costs as much as
+        # MIRROR_ERROR_PENALTY seconds of latency.
+        stat = self.stats.get(url)
+        if stat is None:
+            return settings.MIRROR_PROBE_TIMEOUT
+        latency = stat['latency']
+        if latency is None:
+            latency = settings.MIRROR_PROBE_TIMEOUT
+        return latency + stat['errors'] * settings.MIRROR_ERROR_PENALTY
+
+    def _needs_probe(self, url):
+        # Urls with no stats or no news for a while are probed
+        stat = self.stats.get(url)
+        if stat is None:
+            return True
+        try:
+            age = time.time() - float(stat.get('updated', 0))
+        except (TypeError, ValueError):
+            return True
+        return not 0 <= age < settings.MIRROR_PROBE_INTERVAL
+
+    def _probe_all(self):
+        urls = [u for u in self.urls if self._needs_probe(u)]
+        if len(urls) == 0:
+            log.debug('Mirror stats are up to date')
+            return
+        log.debug('Probing update urls')
+        threads = []
+        for url in urls:
+            t = threading.Thread(target=self._probe, args=(url,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+    def _probe(self, url):
+        # Asks for the first byte of the version file & times how
+        # long it takes to get a response
+        file_url = url + settings.VERSION_FILE
+        timeout = urllib3.Timeout(connect=settings.MIRROR_PROBE_TIMEOUT,
+                                  read=settings.MIRROR_PROBE_TIMEOUT)
+        start = time.time()
+        try:
+            data = self.http_pool.urlopen('GET', file_url,
+                                          headers={'Range': 'bytes=0-0'},
+                                          timeout=timeout, retries=False,
+                                          preload_content=False)
+            latency = time.time() - start
+            status = data.status
+            release_response(data)
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.debug('Probe failed: {}'.format(url))
+            self.record_failure(url)
+            return
+        if status >= 400:
+            log.debug('Probe of {} got status {}'.format(url, status))
+            self.record_failure(url)
+        else:
+            log.debug('Probe of {} took {:.3f}s'.format(url, latency))
+            self.record_success(url, latency)
+
+    def _load_stats(self):
+        if not os.path.exists(self.stats_file):
+            return {}
+        try:
+            with open(self.stats_file, 'r') as f:
+                stats = json.load(f)
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Cannot load mirror stats')
+            return {}
+        if not isinstance(stats, dict):
+            return {}
+        return stats
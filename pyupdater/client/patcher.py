@@ -15,24 +15,26 @@
 # --------------------------------------------------------------------------
 from __future__ import unicode_literals
 
+import contextlib
 import logging
+import mmap
+from multiprocessing.pool import ThreadPool
 import os
+import shutil
+import tempfile
+import threading
 
-try:
-    import bsdiff4
-except ImportError:  # pragma: no cover
-    bsdiff4 = None
-
-from pyupdater.client.downloader import FileDownloader
+from pyupdater.client.downloader import FileDownloader, get_http_pool
+from pyupdater.client.planner import patch_cost
 from pyupdater import settings
 from pyupdater.utils import (get_package_hashes,
                              EasyAccessDict,
                              lazy_import,
+                             replace_file,
                              Version)
-from pyupdater.utils.exceptions import PatcherError
-
-if bsdiff4 is None:  # pragma: no cover
-    from pyupdater.utils import bsdiff4_py as bsdiff4
+from pyupdater.utils.diff_engines import get_engine
+from pyupdater.utils.exceptions import PatcherError, VersionError
+from pyupdater.utils.progress import call_progress_hooks, ProgressDispatcher
 
 log = logging.getLogger(__name__)
 
@@ -48,6 +50,23 @@ def jms_utils():
 _platform = jms_utils.system.get_system()
 
 
+def get_patch_folder(update_folder, name):
+    """Returns the folder patches of name are downloaded to. Partial
+    patch downloads are kept there between runs so they resume
+
+    Args:
+
+        update_folder (str): Path to the update folder
+
+        name (str): Name of the package being patched
+
+    Returns:
+
+        (str): Path of the patch folder
+    """
+    return os.path.join(update_folder, settings.PATCH_FOLDER_PREFIX + name)
+
+
 class Patcher(object):
     """Downloads, verifies, and patches binaries
 
@@ -70,6 +89,31 @@ class Patcher(object):
             True: Verify https connection
 
             False: Don't verify https connection
+
+        http_pool (obj): Connection pool shared by all patch downloads
+
+        max_concurrent_downloads (int): Max number of patches downloaded
+                                        at the same time
+
+        rate_limiter (obj): Shared download speed cap
+
+        progress_rate (float): Max progress events sent per second
+
+        cache (obj): Shared download cache checked before downloading
+
+        retry_policy (obj): Used when a patch download fails
+
+        circuit_breaker (obj): Used to skip failing urls
+
+        patch_apply_cost (float): Cost of applying a patch per byte of
+                                  archive. Used to find the cheapest
+                                  patches. None works it out from the
+                                  format of each patch
+
+        byte_budget (obj): :class:`pyupdater.client.throttle.ByteBudget`
+                           each patch download takes its size from
+
+        mirrors (obj): Told how patch download requests went
     """
 
     def __init__(self, **kwargs):
@@ -82,9 +126,36 @@ class Patcher(object):
         self.update_urls = kwargs.get('update_urls', [])
         self.verify = kwargs.get('verify', True)
         self.progress_hooks = kwargs.get('progress_hooks', [])
+        self.http_pool = kwargs.get('http_pool')
+        if self.http_pool is None:
+            self.http_pool = get_http_pool(self.verify)
+        self.max_concurrent_downloads = kwargs.get(
+            'max_concurrent_downloads', settings.MAX_CONCURRENT_DOWNLOADS)
+        self.rate_limiter = kwargs.get('rate_limiter')
+        self.progress_rate = kwargs.get('progress_rate',
+                                        settings.PROGRESS_HOOK_RATE)
+        self.cache = kwargs.get('cache')
+        self.retry_policy = kwargs.get('retry_policy')
+        self.circuit_breaker = kwargs.get('circuit_breaker')
+        self.patch_apply_cost = kwargs.get('patch_apply_cost',
+                                           settings.PATCH_APPLY_COST)
+        self.byte_budget = kwargs.get('byte_budget')
+        self.mirrors = kwargs.get('mirrors')
+        # Progress is counted in patches
+        self.progress = ProgressDispatcher(self._call_progress_hooks,
+                                           self.progress_rate,
+                                           rate_key='patches_per_sec')
         self.patch_data = []
-        self.patch_binary_data = []
-        self.og_binary = None
+        # Patches are downloaded here & kept if patching is interrupted
+        self.patch_folder = None
+        # Temp dir holding patched binaries while patching
+        self.work_dir = None
+        # Set to stop patch downloads still running once one failed
+        self._cancel = threading.Event()
+        # Path of the verified installed archive
+        self.og_binary_path = None
+        # Path of the fully patched binary
+        self.new_binary_path = None
         # ToDo: Update tests with linux archives.
         # Used for testing.
         self.platform = kwargs.get('platform', _platform)
@@ -113,21 +184,26 @@ class Patcher(object):
             log.debug('Cannot find all patches...')
             return False
 
-        # Download and verify patches in 1 go
-        download_check = self._download_verify_patches()
-        if download_check is False:
-            log.debug('Patch check failed...')
-            return False
-
+        # Patches & every patched binary are kept on disk so memory
+        # use doesn't grow with the length of the patch chain
+        self.patch_folder = get_patch_folder(self.update_folder, self.name)
+        if not os.path.exists(self.patch_folder):
+            os.makedirs(self.patch_folder)
+        self.work_dir = tempfile.mkdtemp(prefix=settings.PATCH_TEMP_PREFIX,
+                                         dir=self.update_folder)
         try:
-            self._apply_patches_in_memory()
-        except PatcherError:
-            return False
-        else:
             try:
-                self._write_update_to_disk()
+                self._download_apply_patches()
             except PatcherError:
+                log.debug('Patch check failed...')
                 return False
+            else:
+                try:
+                    self._write_update_to_disk()
+                except PatcherError:
+                    return False
+        finally:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
         # Looks like all is well
         return True
 
@@ -135,126 +211,278 @@ class Patcher(object):
         # Verifies latest downloaded archive against known hash
         log.debug('Checking for current installed binary to patch')
 
-        with jms_utils.paths.ChDir(self.update_folder):
-            if not os.path.exists(self.current_filename):
-                log.debug('Cannot find archive to patch')
-                return False
+        path = os.path.join(self.update_folder, self.current_filename)
+        if not os.path.exists(path):
+            log.debug('Cannot find archive to patch')
+            return False
 
-            installed_file_hash = get_package_hashes(self.current_filename)
-            if self.current_file_hash != installed_file_hash:
-                log.debug('Binary hash mismatch')
-                return False
-            # Read binary into memory to begin patching
-            with open(self.current_filename, 'rb') as f:
-                self.og_binary = f.read()
+        installed_file_hash = get_package_hashes(path)
+        if self.current_file_hash != installed_file_hash:
+            log.debug('Binary hash mismatch')
+            return False
+        self.og_binary_path = path
         log.debug('Binary found and verified')
         return True
 
-    # We will take all versions.  Then append any version
-    # thats greater then the current version to the list
-    # of needed patches.
+    def get_patch_sizes(self):
+        """Returns size of each patch on the cheapest path to the
+        highest version, in the order they're applied. Sizes missing
+        from the version file are None
+
+        Returns:
+
+            (list): Patch sizes. None if there's no way to patch
+        """
+        if self._get_patch_info(self.name) is False:
+            return None
+        return [p['patch_size'] for p in self.patch_data]
+
+    def get_patch_formats(self):
+        """Returns the format of each patch found by
+        :meth:`get_patch_sizes`, in the same order
+
+        Returns:
+
+            (list): Patch formats
+        """
+        return [p['patch_format'] for p in self.patch_data]
+
     def _get_patch_info(self, name):
-        # Taking the list of needed patches and extracting the
-        # patch data from it. If any loop fails, will return False
-        # and start full binary update.
+        # Finds the cheapest way from the installed version to the
+        # highest version through the patches in the version file &
+        # gathers their meta-data. Besides the patch from the version
+        # before it, a version can have skip-ahead patches straight
+        # from older versions. Returns False if there's no way, which
+        # starts a full binary update.
         log.debug('Getting patch meta-data')
-        required_patches = self._get_required_patches(name)
+        self.patch_data = []
+        versions = self._get_required_patches(name)
+        if len(versions) == 0:
+            log.error('Missing required patch meta-data')
+            return False
 
-        for p in required_patches:
-            info = {}
-            platform_key = '{}*{}*{}*{}'.format(settings.UPDATES_KEY, name,
-                                                str(p), self.platform)
-            platform_info = self.star_access_update_data.get(platform_key)
+        patches = []
+        previous = self.current_version
+        for v in versions:
+            patches.append((v, self._get_patches_to(name, v, previous)))
+            previous = v
+        # Bytes are only compared when every patch has its size.
+        # Otherwise the path with the fewest patches wins
+        sized = all(info['patch_size'] is not None
+                    for _, edges in patches for _, info in edges)
+        full_size = self._get_full_size(name, versions[-1])
+
+        # version: (cost, number of patches, source version, patch info)
+        best = {str(self.current_version): (0, 0, None, None)}
+        for v, edges in patches:
+            for source, info in edges:
+                if str(source) not in best:
+                    continue
+                cost, hops = best[str(source)][:2]
+                if sized:
+                    cost += patch_cost(info['patch_size'], full_size,
+                                       self.patch_apply_cost,
+                                       info['patch_format'])
+                key = (cost, hops + 1)
+                if str(v) not in best or key < best[str(v)][:2]:
+                    best[str(v)] = key + (source, info)
+
+        target = str(versions[-1])
+        if target not in best:
+            log.error('Missing required patch meta-data')
+            return False
+        while target != str(self.current_version):
+            _, _, source, info = best[target]
+            self.patch_data.insert(0, info)
+            target = str(source)
+        log.debug('Patching with {} of {} versions'.format(
+            len(self.patch_data), len(versions)))
+        return True
 
+    def _get_patches_to(self, name, version, previous):
+        # Returns (source version, patch info) of every patch making
+        # version. previous is the version before it
+        platform_key = '{}*{}*{}*{}'.format(settings.UPDATES_KEY, name,
+                                            str(version), self.platform)
+        platform_info = self.star_access_update_data.get(platform_key)
+        patches = []
+        if self._can_apply(platform_info):
+            patches.append((previous, self._patch_info(platform_info)))
+        skip_patches = platform_info.get('skip_patches') or {}
+        for base, skip_info in skip_patches.items():
             try:
-                info['patch_name'] = platform_info['patch_name']
-                info['patch_urls'] = self.update_urls
-                info['patch_hash'] = platform_info['patch_hash']
-                self.patch_data.append(info)
-            except Exception as err:  # pragma: no cover
-                log.debug(str(err), exc_info=True)
-                log.error('Missing required patch meta-data')
-                return False
+                base = Version(base)
+            except VersionError:  # pragma: no cover
+                continue
+            if self.current_version <= base < version and \
+                    self._can_apply(skip_info):
+                patches.append((base, self._patch_info(skip_info)))
+        return patches
+
+    @staticmethod
+    def _can_apply(info):
+        # Patches in formats without an engine here are skipped
+        if not info.get('patch_name') or not info.get('patch_hash'):
+            return False
+        patch_format = info.get('patch_format',
+                                settings.LEGACY_PATCH_FORMAT)
+        engine = get_engine(patch_format)
+        if engine is None or engine.can_patch() is False:
+            log.debug('Cannot apply {} patch {}'.format(patch_format,
+                                                        info['patch_name']))
+            return False
         return True
 
+    def _patch_info(self, info):
+        return {'patch_name': info['patch_name'],
+                'patch_urls': self.update_urls,
+                'patch_hash': info['patch_hash'],
+                'patch_size': info.get('patch_size'),
+                'patch_format': info.get('patch_format',
+                                         settings.LEGACY_PATCH_FORMAT)}
+
+    def _get_full_size(self, name, version):
+        # Size of the full archive of version. 0 if not known
+        size_key = '{}*{}*{}*{}*{}'.format(settings.UPDATES_KEY, name,
+                                           str(version), self.platform,
+                                           'file_size')
+        return int(self.star_access_update_data.get(size_key) or 0)
+
     def _get_required_patches(self, name):
-        # Gathers patch name, hash & URL
+        # Returns versions after the installed one, up to the highest
+        # version, that have an archive for this platform. Sorted
         needed_patches = []
         try:
             # Get list of Version objects initialized with keys
             # from update manifest
             version_key = '{}*{}'.format(settings.UPDATES_KEY, name)
             version_info = self.star_access_update_data(version_key)
-            versions = map(Version, version_info.keys())
         except KeyError:  # pragma: no cover
             log.debug('No updates found in updates dict')
-            # Will cause error to be thrown in _get_pacth_info
+            # Will cause _get_patch_info to return False
             # which will cause patch update to return False
-            versions = [1]
+            return needed_patches
 
-        # Ensuring we apply patches in correct order
-        versions = sorted(versions)
+        highest = None
+        if self.highest_version is not None:
+            highest = Version(self.highest_version)
         log.debug('getting required patches')
-        for i in versions:
-            if i > self.current_version:
-                needed_patches.append(i)
-        # Used to guarantee patches are only added once
-        return list(set(needed_patches))
-
-    def _download_verify_patches(self):
-        # Downloads & verifies all patches
-        log.debug('Downloading patches')
-        downloaded = 0
+        for key, info in version_info.items():
+            if not info or self.platform not in info:
+                continue
+            v = Version(key)
+            if v <= self.current_version:
+                continue
+            if highest is not None and v > highest:
+                continue
+            needed_patches.append(v)
+        # Ensuring we apply patches in correct order
+        return sorted(needed_patches)
+
+    def _download_apply_patches(self):
+        # Patches are downloaded at the same time & each one is applied
+        # as soon as it & the patches before it are ready, so applying
+        # a patch overlaps downloading the ones after it. Patches are
+        # always applied in order. Raises PatcherError on failure.
+        log.debug('Downloading & applying patches')
         total = len(self.patch_data)
-        for p in self.patch_data:
-            # Initialize downloader
-            fd = FileDownloader(p['patch_name'], p['patch_urls'],
-                                p['patch_hash'], self.verify)
-
-            # Attempt to download resource
-            data = fd.download_verify_return()
-            if data is not None:
-                self.patch_binary_data.append(data)
+        if total == 0:
+            raise PatcherError('No patches to apply')
+        downloaded = 0
+        self.progress.start(total)
+        workers = max(1, min(self.max_concurrent_downloads, total))
+        self._cancel.clear()
+        pool = ThreadPool(workers)
+        source = self.og_binary_path
+        try:
+            # imap hands back downloads in the order they were given
+            for i, path in enumerate(pool.imap(self._download_patch,
+                                               self.patch_data)):
+                if path is None:
+                    # Since patches are applied sequentially
+                    # we cannot continue successfully
+                    self.progress.finish(downloaded,
+                                         'failed to download all patches')
+                    raise PatcherError('Failed to download all patches')
                 downloaded += 1
-                status = {'total': total,
-                          'downloaed': downloaded,
-                          'status': 'downloading'}
-                self._call_progress_hooks(status)
-            else:
-                # Since patches are applied sequentially
-                # we cannot continue successfully
-                status = {'total': total,
-                          'downloaded': downloaded,
-                          'status': 'failed to download all patches'}
-                self._call_progress_hooks(status)
-                return False
-        status = {'total': total,
-                  'downloaed': downloaded,
-                  'status': 'finished'}
-        self._call_progress_hooks(status)
-        return True
+                self.progress.update(downloaded)
+                try:
+                    source = self._apply_patch(source, path, i)
+                except PatcherError:
+                    self.progress.finish(downloaded,
+                                         'failed to apply patches')
+                    raise
+        finally:
+            # Stops downloads still running if one failed & waits for
+            # them so nothing writes to the patch folder after we return
+            self._cancel.set()
+            pool.close()
+            pool.join()
+        self.progress.finish(downloaded)
+        self.new_binary_path = source
+
+    def _download_patch(self, patch):
+        # Runs in a worker thread. Returns path of the verified patch.
+        # None if the download failed or was cancelled
+        if self._cancel.is_set():
+            return None
+        path = os.path.join(self.patch_folder, patch['patch_name'])
+        # Patches downloaded by an update that failed further down the
+        # chain are reused
+        if os.path.exists(path) and \
+                get_package_hashes(path) == patch['patch_hash']:
+            log.debug('Using downloaded patch {}'.format(path))
+            return path
+        fd = FileDownloader(patch['patch_name'], patch['patch_urls'],
+                            patch['patch_hash'], self.verify,
+                            http_pool=self.http_pool,
+                            rate_limiter=self.rate_limiter,
+                            progress_rate=self.progress_rate,
+                            cache=self.cache,
+                            retry_policy=self.retry_policy,
+                            circuit_breaker=self.circuit_breaker,
+                            directory=self.patch_folder,
+                            cancel=self._cancel,
+                            mirrors=self.mirrors)
+        taken = 0
+        if self.byte_budget is not None:
+            taken = self.byte_budget.acquire(patch['patch_size'] or 0)
+        try:
+            if fd.download_verify_write() is not True:
+                return None
+        finally:
+            if self.byte_budget is not None:
+                self.byte_budget.release(taken)
+        return fd.file_path
 
     def _call_progress_hooks(self, data):
-        for ph in self.progress_hooks:
-            try:
-                ph(data)
-            except Exception as err:
-                log.debug(str(err), exc_info=True)
-                log.error('Exception in callback: '
-                          '{}'.format(ph.__name__))
-
-    def _apply_patches_in_memory(self):
-        # Applies a sequence of patches in memory
-        log.debug('Applying patches')
-        self.new_binary = self.og_binary
-        for i in self.patch_binary_data:
-            try:
-                self.new_binary = bsdiff4.patch(self.new_binary, i)
-                log.debug('Applied patch successfully')
-            except Exception as err:
-                log.debug(err, exc_info=True)
-                log.error(err)
-                raise PatcherError('Patch failed to apply')
+        call_progress_hooks(self.progress_hooks, data)
+
+    def _apply_patch(self, source, patch_path, index):
+        # Applies one patch to the file at source & returns the path of
+        # the patched binary. The source & patch are mapped & the
+        # engine writes the patched binary straight to a temp file,
+        # which is the source of the next patch. Patches & sources are
+        # removed once used.
+        engine = get_engine(self.patch_data[index]['patch_format'])
+        output = os.path.join(self.work_dir, 'patched-{}'.format(index))
+        try:
+            with _map_file(source) as source_data, \
+                    _map_file(patch_path) as patch, \
+                    open(output, 'wb') as f:
+                engine.patch_into(source_data, patch, f)
+            log.debug('Applied patch successfully')
+        except Exception as err:
+            log.debug(err, exc_info=True)
+            log.error(err)
+            if os.path.exists(output):
+                os.remove(output)
+            raise PatcherError('Patch failed to apply')
+        finally:
+            os.remove(patch_path)
+        if source != self.og_binary_path:
+            os.remove(source)
+        return output
 
     def _write_update_to_disk(self):  # pragma: no cover
         # Writes updated binary to disk
@@ -268,27 +496,21 @@ class Patcher(object):
         if filename is None:
             raise PatcherError('Filename missing in version file')
 
-        with jms_utils.paths.ChDir(self.update_folder):
-            try:
-                with open(filename, 'wb') as f:
-                    f.write(self.new_binary)
-                log.debug('Wrote update file')
-            except IOError:
-                # Removes file if it got created
-                if os.path.exists(filename):
-                    os.remove(filename)
-                log.error('Failed to open file for writing')
-                raise PatcherError('Failed to open file for writing')
-            else:
-                file_info = self._current_file_info(self.name,
-                                                    self.highest_version)
-
-                new_file_hash = file_info['file_hash']
-                log.debug('checking file hash match')
-                if new_file_hash != get_package_hashes(filename):
-                    log.error('File hash does not match')
-                    os.remove(filename)
-                    raise PatcherError('Bad hash on patched file')
+        file_info = self._current_file_info(self.name,
+                                            self.highest_version)
+        new_file_hash = file_info['file_hash']
+        log.debug('checking file hash match')
+        if new_file_hash != get_package_hashes(self.new_binary_path):
+            log.error('File hash does not match')
+            raise PatcherError('Bad hash on patched file')
+        try:
+            replace_file(self.new_binary_path,
+                         os.path.join(self.update_folder, filename))
+            log.debug('Wrote update file')
+        except (IOError, OSError) as err:
+            log.debug(err, exc_info=True)
+            log.error('Failed to move update file into place')
+            raise PatcherError('Failed to move update file into place')
 
     def _current_file_info(self, name, version):
         # Returns filename and hash for given name and version
@@ -307,3 +529,18 @@ class Patcher(object):
         info = dict(filename=filename, file_hash=file_hash)
         log.debug('Current file_hash {}'.format(file_hash))
         return info
+
+
+@contextlib.contextmanager
+def _map_file(path):
+    # Maps the file instead of reading it, so the os can page it in
+    # & out as needed. Empty files can't be mapped.
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield data
+            finally:
+                data.close()
+        else:
+            yield b''
@@ -0,0 +1,137 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import logging
+
+from pyupdater import settings
+from pyupdater.utils.diff_engines import DiffEngine, get_engine
+
+log = logging.getLogger(__name__)
+
+
+def get_apply_cost(patch_format, apply_cost=None,
+                   download_speed=settings.PATCH_DOWNLOAD_SPEED):
+    """Cost of applying a patch in bytes per byte of archive. Applying
+    a patch makes the whole archive again however small the patch is,
+    so it takes the time downloading download_speed / apply speed bytes
+    per byte of archive would. The apply speed of each format is
+    measured with tests/benchmarks/bench_patch_apply.py.
+
+    Args:
+
+        patch_format (str): Format of the patch
+
+    Kwargs:
+
+        apply_cost (float): Used instead when not None
+
+        download_speed (int): Expected download speed in bytes a second
+
+    Returns:
+
+        (float): Cost in bytes per byte of archive
+    """
+    if apply_cost is not None:
+        return apply_cost
+    engine = get_engine(patch_format)
+    if engine is None:
+        engine = DiffEngine()
+    return float(download_speed) / engine.apply_speed
+
+
+def patch_cost(patch_size, full_size, apply_cost=None,
+               patch_format=settings.LEGACY_PATCH_FORMAT):
+    """Cost of one patch in bytes. The size of the patch plus the cost
+    of applying it to an archive of full_size bytes. The patcher picks
+    the chain of patches with this cost & :func:`choose_patch_update`
+    compares the chain with a full update using it too, so they always
+    agree.
+
+    Args:
+
+        patch_size (int): Size of the patch
+
+        full_size (int): Size of the full archive of the highest version
+
+    Kwargs:
+
+        apply_cost (float): Bytes a patch costs to apply per byte of
+                            archive. None uses :func:`get_apply_cost`
+
+        patch_format (str): Format of the patch
+
+    Returns:
+
+        (int): Cost in bytes
+    """
+    apply_cost = get_apply_cost(patch_format, apply_cost)
+    return int(patch_size) + int(int(full_size) * apply_cost)
+
+
+def choose_patch_update(name, full_size, patch_sizes, apply_cost=None,
+                        patch_formats=None):
+    """Decides if patching is expected to cost less than downloading
+    the full archive. Costs are counted in bytes. A full update costs
+    the size of the archive. A patch update costs the size of every
+    patch in the chain plus the cost of applying each one, see
+    :func:`patch_cost`.
+
+    When the version file has no sizes patching is chosen, same as
+    before sizes were added.
+
+    Args:
+
+        name (str): Name of the update. Used for logging
+
+        full_size (int): Size of the full archive. None if not known
+
+        patch_sizes (list): Size of each patch in the chain. Sizes
+                            not known are None
+
+    Kwargs:
+
+        apply_cost (float): Bytes a patch costs to apply per byte of
+                            archive. None uses :func:`get_apply_cost`
+
+        patch_formats (list): Format of each patch in the chain.
+                              Defaults to the legacy format
+
+    Returns:
+
+        (bool) Meanings:
+
+            True - Patch
+
+            False - Download the full archive
+    """
+    if full_size is None or None in patch_sizes:
+        log.debug('No sizes in version file for {}. '
+                  'Patching'.format(name))
+        return True
+    full_size = int(full_size)
+    patch_bytes = sum(int(s) for s in patch_sizes)
+    if patch_formats is None:
+        patch_formats = [settings.LEGACY_PATCH_FORMAT] * len(patch_sizes)
+    cost = sum(patch_cost(s, full_size, apply_cost, f)
+               for s, f in zip(patch_sizes, patch_formats))
+    apply_bytes = cost - patch_bytes
+    patch = cost < full_size
+    log.info('Update plan for {}: {} patches, {} patch bytes + {} apply '
+             'bytes vs {} full bytes. Using {}'.format(
+                 name, len(patch_sizes), patch_bytes, apply_bytes,
+                 full_size, 'patches' if patch else 'full update'))
+    return patch
@@ -0,0 +1,166 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import logging
+import random
+import threading
+import time
+
+from pyupdater import settings
+
+log = logging.getLogger(__name__)
+
+
+class RetryPolicy(object):
+    """How often & how long to wait before retrying a failed download.
+    Waits grow exponentially up to max_backoff. With jitter the wait
+    is a random time up to that, so many clients failing at once don't
+    all come back at the same moment.
+
+    Kwargs:
+
+        retries (int): Max number of retries. 0 to never retry
+
+        backoff (float): Seconds waited before the first retry
+
+        max_backoff (float): Max seconds waited before a retry
+
+        jitter (bool) Meaning:
+
+            True: Wait a random time up to the backoff
+
+            False: Wait the full backoff
+    """
+
+    def __init__(self, retries=settings.DOWNLOAD_RETRIES,
+                 backoff=settings.DOWNLOAD_BACKOFF,
+                 max_backoff=settings.DOWNLOAD_MAX_BACKOFF, jitter=True):
+        self.retries = max(int(retries), 0)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        """Returns seconds to wait before a retry
+
+        Args:
+
+            attempt (int): Number of the retry, starting at 1
+
+        Returns:
+
+            (float): Seconds to wait
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        if self.jitter:
+            return random.uniform(0, delay)
+        return delay
+
+
+class CircuitBreaker(object):
+    """Skips update urls that keep failing. After threshold failures
+    in a row an url is skipped for cool_down seconds. Then one request
+    is let through. If it works the url is used again, if not it's
+    skipped for another cool_down. Safe to share between threads &
+    downloads.
+
+    Kwargs:
+
+        threshold (int): Failures in a row before an url is skipped
+
+        cool_down (float): Seconds an url is skipped for
+    """
+
+    def __init__(self, threshold=settings.CIRCUIT_BREAKER_THRESHOLD,
+                 cool_down=settings.CIRCUIT_BREAKER_COOL_DOWN):
+        self.threshold = threshold
+        self.cool_down = cool_down
+        self._lock = threading.Lock()
+        # url: failures in a row
+        self._failures = {}
+        # url: time it started being skipped
+        self._opened = {}
+
+    def allow(self, url):
+        """Returns True if a request to url should be made
+
+        Args:
+
+            url (str): Update url
+
+        Returns:
+
+            (bool): False while url is skipped
+        """
+        with self._lock:
+            opened = self._opened.get(url)
+            if opened is None:
+                return True
+            now = time.time()
+            if now - opened < self.cool_down:
+                return False
+            # Letting one request through. Others keep skipping
+            # the url until it's known if it works again
+            self._opened[url] = now
+            log.debug('Trying skipped url again: {}'.format(url))
+            return True
+
+    def filter(self, urls):
+        """Returns urls that aren't skipped. If all are skipped, all are
+        returned, since trying is better than failing right away
+
+        Args:
+
+            urls (list): Update urls
+
+        Returns:
+
+            (list): Update urls in the same order
+        """
+        allowed = [u for u in urls if self.allow(u)]
+        if len(allowed) == 0:
+            log.debug('All urls are failing. Trying them anyway')
+            return list(urls)
+        return allowed
+
+    def record_success(self, url):
+        """Resets failures of url
+
+        Args:
+
+            url (str): Update url
+        """
+        with self._lock:
+            self._failures.pop(url, None)
+            self._opened.pop(url, None)
+
+    def record_failure(self, url):
+        """Counts a failure of url. Starts skipping the url once
+        threshold is reached
+
+        Args:
+
+            url (str): Update url
+        """
+        with self._lock:
+            failures = self._failures.get(url, 0) + 1
+            self._failures[url] = failures
+            if failures >= self.threshold:
+                if url not in self._opened:
+                    log.warning('Skipping failing url for {} seconds: '
+                                '{}'.format(self.cool_down, url))
+                self._opened[url] = time.time()
@@ -0,0 +1,93 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import logging
+import sys
+import threading
+
+import six
+
+log = logging.getLogger(__name__)
+
+
+class SingleFlight(object):
+    """Runs only one call per key at a time. Callers asking for a key
+    that is already running wait for that call & get its result, or
+    its error, instead of running their own.
+
+        flights = SingleFlight()
+        # From any number of threads. Only one download runs
+        flights.do(('app.tar.gz', file_hash), download)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key: _Call
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """Calls func(*args, **kwargs) unless a call for key is already
+        running, in which case waits for it
+
+        Args:
+
+            key (hashable): Calls with the same key are shared
+
+            func (func): Called if no call for key is running
+
+        Returns:
+
+            (object): Return value of func
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        if leader is False:
+            log.debug('Waiting on running call for {}'.format(key))
+            call.done.wait()
+            if call.exc_info is not None:
+                six.reraise(*call.exc_info)
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            # Callers after this point start a new call
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def running(self, key):
+        "Returns (bool): True if a call for key is running"
+        with self._lock:
+            return key in self._calls
+
+
+class _Call(object):
+    # Result of one call shared with everyone waiting on it
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
@@ -0,0 +1,181 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Longest a reader sleeps before checking the rate again.
+# Keeps rate changes from waiting on a long sleep
+_MAX_SLEEP = 0.1
+
+
+class RateLimiter(object):
+    """Token bucket used to cap download speed. One limiter can be
+    shared by any number of downloads, in any number of threads, to
+    keep their combined speed under the cap.
+
+    Readers take tokens after reading a block. If that leaves the
+    bucket in debt the reader sleeps until the debt is paid off.
+
+    Kwargs:
+
+        rate (int): Max bytes per second. None or 0 for no limit
+
+        burst (int): Max bytes that can be read at once after being
+                     idle. Defaults to one second worth of data
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self._rate = None
+        self._burst = None
+        self._tokens = 0.0
+        self._last = time.time()
+        self.set_rate(rate, burst)
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        self.set_rate(rate)
+
+    def set_rate(self, rate, burst=None):
+        """Changes the cap. Takes effect right away, even for downloads
+        already running
+
+        Args:
+
+            rate (int): Max bytes per second. None or 0 for no limit
+
+        Kwargs:
+
+            burst (int): Max bytes that can be read at once after being
+                         idle. Defaults to one second worth of data
+        """
+        with self._lock:
+            self._refill()
+            if not rate:
+                self._rate = None
+                self._burst = None
+            else:
+                self._rate = float(rate)
+                self._burst = float(burst or rate)
+                self._tokens = min(self._tokens, self._burst)
+            log.debug('Download rate limit: {}'.format(self._rate))
+
+    def block_size(self, size):
+        """Returns size capped so a single read doesn't go far past
+        the burst
+
+        Args:
+
+            size (int): Wanted block size
+
+        Returns:
+
+            (int): Block size to use
+        """
+        burst = self._burst
+        if burst is None:
+            return size
+        return max(1, min(size, int(burst)))
+
+    def consume(self, amount):
+        """Takes amount tokens from the bucket. Blocks until the
+        bucket isn't in debt
+
+        Args:
+
+            amount (int): Number of bytes read
+        """
+        with self._lock:
+            if self._rate is None:
+                return
+            self._refill()
+            self._tokens -= amount
+        while True:
+            with self._lock:
+                if self._rate is None:
+                    return
+                self._refill()
+                if self._tokens >= 0:
+                    return
+                wait = -self._tokens / self._rate
+            time.sleep(min(wait, _MAX_SLEEP))
+
+    def _refill(self):
+        # Called with self._lock held
+        now = time.time()
+        if self._rate is not None:
+            self._tokens = min(self._burst, self._tokens +
+                               (now - self._last) * self._rate)
+        self._last = now
+
+
+class ByteBudget(object):
+    """Caps the combined size of downloads running at once. A download
+    bigger than the whole budget runs once nothing else is running.
+    Safe to share between threads.
+
+    Kwargs:
+
+        max_bytes (int): Max bytes in flight. None or 0 for no limit
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        """Blocks until size bytes fit in the budget
+
+        Args:
+
+            size (int): Expected size of the download
+
+        Returns:
+
+            (int): Bytes taken. Pass to :meth:`release`
+        """
+        if not self.max_bytes:
+            return 0
+        size = min(size, self.max_bytes)
+        with self._cond:
+            while self.in_flight > 0 and \
+                    self.in_flight + size > self.max_bytes:
+                self._cond.wait()
+            self.in_flight += size
+        return size
+
+    def release(self, size):
+        """Gives back bytes taken by :meth:`acquire`
+
+        Args:
+
+            size (int): Bytes taken
+        """
+        if size == 0:
+            return
+        with self._cond:
+            self.in_flight -= size
+            self._cond.notify_all()
@@ -17,16 +17,21 @@ from __future__ import unicode_literals
 
 import threading
 
-from pyupdater.client.downloader import FileDownloader
-from pyupdater.client.patcher import Patcher
+from pyupdater.client.aio import AsyncRunner, create_future, get_loop, \
+    ProgressIterator
+from pyupdater.client.downloader import SegmentedDownloader
+from pyupdater.client.patcher import get_patch_folder, Patcher
+from pyupdater.client.planner import choose_patch_update
+from pyupdater.client.singleflight import SingleFlight
 from pyupdater import settings
 from pyupdater.utils import (get_filename,
-                             get_hash,
                              get_highest_version,
                              get_mac_dot_app_dir,
+                             get_package_hashes,
                              lazy_import,
                              Version)
 from pyupdater.utils.exceptions import ClientError, UtilsError, VersionError
+from pyupdater.utils.filelock import FileLock
 
 
 @lazy_import
@@ -105,6 +110,29 @@ class LibUpdate(object):
         self.update_folder = os.path.join(self.data_dir,
                                           settings.UPDATE_FOLDER)
         self.verify = data.get('verify', True)
+        self.download_segments = data.get('download_segments',
+                                          settings.DOWNLOAD_SEGMENTS)
+        self.http_pool = data.get('http_pool')
+        self.max_concurrent_downloads = data.get(
+            'max_concurrent_downloads', settings.MAX_CONCURRENT_DOWNLOADS)
+        self.patch_apply_cost = data.get('patch_apply_cost',
+                                         settings.PATCH_APPLY_COST)
+        self.rate_limiter = data.get('rate_limiter')
+        self.progress_rate = data.get('progress_rate',
+                                      settings.PROGRESS_HOOK_RATE)
+        self.cache = data.get('cache')
+        self.retry_policy = data.get('retry_policy')
+        self.circuit_breaker = data.get('circuit_breaker')
+        # Told how download requests went. Used to rank update urls
+        self.mirrors = data.get('mirrors')
+        self.async_runner = data.get('async_runner')
+        if self.async_runner is None:
+            self.async_runner = AsyncRunner(self.max_concurrent_downloads)
+        # Shared by all update objects of a client so only one
+        # download of a file runs at a time
+        self.single_flight = data.get('single_flight')
+        if self.single_flight is None:
+            self.single_flight = SingleFlight()
         self.current_app_dir = os.path.dirname(sys.argv[0])
         self.status = False
         # If user is using async download this will be True.
@@ -112,6 +140,9 @@ class LibUpdate(object):
         # until the current download is complete. Which will
         # set this back to False.
         self._is_downloading = False
+        self._state_lock = threading.Lock()
+        self._download_future = None
+        self._progress_iterators = []
 
     def is_downloaded(self):
         """Returns (bool):
@@ -124,23 +155,160 @@ class LibUpdate(object):
             return False
         return self._is_downloaded(self.name)
 
-    def download(self, async=False):
-        if async is True:
-            if self._is_downloading is False:
-                self._is_downloading = True
-                download = threading.Thread(target=self._download)
-                download.start()
+    def download(self, background=False, **kwargs):
+        """Downloads the update
+
+        Kwargs:
+
+            background (bool) Meaning:
+
+                True: Download in a background thread & return right away
+
+                False: Block until the download is finished
+
+            async (bool): Old name of background. Kept for backwards
+                          compatibility
+
+            progress_hooks (list): Called with progress of this
+                                   download in place of the hooks of
+                                   the update object
+
+            download_segments (int): Max concurrent requests of a full
+                                     download
+
+            max_concurrent_downloads (int): Max patches downloaded at
+                                            the same time
+
+            byte_budget (obj): :class:`pyupdater.client.throttle.ByteBudget`
+                               each patch & file download takes its
+                               size from while it runs
+
+        Returns:
+
+            (bool) Meanings:
+
+                True - Download successful
+
+                False - Download failed
+
+                None - Download running in background or another
+                       download is already running
+        """
+        # async is a reserved word on python 3.7+ so it can only be
+        # passed as a keyword
+        background = kwargs.pop('async', background)
+        if self._start_download() is False:
+            return None
+        if background is True:
+            download = threading.Thread(target=self._run_download,
+                                        kwargs=kwargs)
+            download.start()
         else:
-            if self._is_downloading is False:
-                self._is_downloading = True
-                return self._download()
+            return self._run_download(**kwargs)
+
+    def download_async(self, loop=None):
+        """Downloads the update without blocking the event loop.
+        Requires python 3.4+
+
+            status = await update.download_async()
+
+        Kwargs:
+
+            loop (obj): Event loop to use. Defaults to the running event loop
 
-    def _download(self):
+        Returns:
+
+            (obj): asyncio future. Resolves to the same values
+                   :meth:`download` returns
+        """
+        loop = get_loop(loop)
+        future = self._download_future
+        if future is not None and not future.done():
+            # Lets everyone awaiting the update share one download
+            return future
+        if self._start_download() is False:
+            # A sync or background download is already running
+            future = create_future(loop)
+            future.set_result(None)
+            return future
+        self._download_future = self.async_runner.run(self._run_download,
+                                                      loop=loop)
+        return self._download_future
+
+    def progress_async(self, loop=None):
+        """Returns an async iterator of progress events for the next
+        download. The iteration ends when the download finishes.
+        Requires python 3.5+
+
+            progress = update.progress_async()
+            task = update.download_async()
+            async for status in progress:
+                print(status)
+
+        Kwargs:
+
+            loop (obj): Event loop to use. Defaults to the running event loop
+
+        Returns:
+
+            (obj): :class:`pyupdater.client.aio.ProgressIterator`
+        """
+        progress = ProgressIterator(loop)
+        self._progress_iterators.append(progress)
+        self.progress_hooks.append(progress)
+        return progress
+
+    def _start_download(self):
+        # Returns False if a download is already running
+        with self._state_lock:
+            if self._is_downloading is True:
+                return False
+            self._is_downloading = True
+            return True
+
+    def _run_download(self, **kwargs):
+        # kwargs override the hooks & limits of this download only.
+        # Batches pass them since they share update objects with the
+        # client & other threads
+        options = {'progress_hooks': self.progress_hooks,
+                   'download_segments': self.download_segments,
+                   'max_concurrent_downloads': self.max_concurrent_downloads,
+                   'byte_budget': None}
+        options.update(kwargs)
+        try:
+            if self.name is None:
+                return self._download(options)
+            # Other update objects of this client downloading the
+            # same file wait for this download & share its result
+            status = self.single_flight.do(
+                self._get_download_key(),
+                lambda: self._download_exclusive(options))
+            if status is True:
+                self.status = True
+            return status
+        finally:
+            if self.mirrors is not None:
+                self.mirrors.save_stats()
+            self._is_downloading = False
+            # Ends iteration of all async progress iterators
+            # waiting on this download
+            iterators, self._progress_iterators = \
+                self._progress_iterators, []
+            for i in iterators:
+                if i in self.progress_hooks:
+                    self.progress_hooks.remove(i)
+                i.close()
+
+    def _download(self, options):
         """Will download the package update that was referenced
         with check update.
 
         Proxy method for :meth:`_patch_update` & :meth:`_full_update`.
 
+        Args:
+
+            options (dict): Hooks & limits of this download
+
         Returns:
 
             (bool) Meanings:
@@ -156,27 +324,59 @@ class LibUpdate(object):
                 return self.status
             else:
                 log.info('Starting patch download')
-                patch_success = self._patch_update(self.name, self.version)
+                patch_success = self._patch_update(self.name, self.version,
+                                                   options)
                 # Tested elsewhere
                 if patch_success:  # pragma: no cover
                     self.status = True
                     log.info('Patch download successful')
                 else:
-                    log.error('Patch update failed')
+                    # None when a full download is expected to be cheaper
+                    if patch_success is False:
+                        log.error('Patch update failed')
                     log.info('Starting full download')
-                    update_success = self._full_update(self.name)
+                    update_success = self._full_update(self.name, options)
                     if update_success:
                         self.status = True
                         log.info('Full download successful')
                     else:  # pragma: no cover
                         log.error('Full download failed')
+                if self.status is True:
+                    self._remove_patches()
                 # Removes old versions, of update being checked, from
                 # updates folder.  Since we only start patching from
                 # the current binary this shouldn't be a problem.
                 self._remove_old_updates()
-                self._is_downloading = False
                 return self.status
 
+    def _download_exclusive(self, options):
+        # Holds a lock file while downloading so other apps, or other
+        # instances of this app, updating the same name wait instead of
+        # downloading the same file. Once they get the lock the update
+        # is already downloaded & verified.
+        lock_dir = os.path.join(self.data_dir, settings.DOWNLOAD_LOCK_FOLDER)
+        if not os.path.exists(lock_dir):
+            try:
+                os.makedirs(lock_dir)
+            except OSError:  # pragma: no cover
+                # Another process beat us to it
+                if not os.path.isdir(lock_dir):
+                    raise
+        lock_path = os.path.join(lock_dir, '{}.lock'.format(self.name))
+        with FileLock(lock_path):
+            return self._download(options)
+
+    def _get_download_key(self):
+        # Downloads of the same file with the same hash are shared
+        latest = get_highest_version(self.name, self.platform,
+                                     self.easy_data)
+        filename = get_filename(self.name, latest, self.platform,
+                                self.easy_data)
+        hash_key = '{}*{}*{}*{}*{}'.format(self.updates_key, self.name,
+                                           latest, self.platform,
+                                           'file_hash')
+        return filename, self.easy_data.get(hash_key)
+
     def extract(self):
         """Will extract archived update and leave in update folder.
         If updating a lib you can take over from there. If updating
@@ -260,22 +460,21 @@ class LibUpdate(object):
                                            'file_hash')
         _hash = self.easy_data.get(hash_key)
         # Comparing file hashes to ensure security
-        with jms_utils.paths.ChDir(self.update_folder):
-            if not os.path.exists(filename):
-                return False
-            try:
-                with open(filename, 'rb') as f:
-                    data = f.read()
-            except Exception as err:
-                log.debug(err, exc_info=True)
-                return False
-            if _hash == get_hash(data):
-                return True
-            else:
-                return False
+        path = os.path.join(self.update_folder, filename)
+        if not os.path.exists(path):
+            return False
+        try:
+            file_hash = get_package_hashes(path)
+        except Exception as err:
+            log.debug(err, exc_info=True)
+            return False
+        if _hash == file_hash:
+            return True
+        else:
+            return False
 
     # Handles patch updates
-    def _patch_update(self, name, version):  # pragma: no cover
+    def _patch_update(self, name, version, options):  # pragma: no cover
         log.info('Starting patch update')
         filename = get_filename(name, version, self.platform, self.easy_data)
         log.debug('Archive filename: {}'.format(filename))
@@ -297,7 +496,30 @@ class LibUpdate(object):
                     current_version=version, highest_version=latest,
                     update_folder=self.update_folder,
                     update_urls=self.update_urls, verify=self.verify,
-                    progress_hooks=self.progress_hooks)
+                    platform=self.platform,
+                    progress_hooks=options['progress_hooks'],
+                    http_pool=self.http_pool,
+                    max_concurrent_downloads=options[
+                        'max_concurrent_downloads'],
+                    byte_budget=options['byte_budget'],
+                    mirrors=self.mirrors,
+                    rate_limiter=self.rate_limiter,
+                    progress_rate=self.progress_rate,
+                    cache=self.cache,
+                    retry_policy=self.retry_policy,
+                    circuit_breaker=self.circuit_breaker,
+                    patch_apply_cost=self.patch_apply_cost)
+
+        patch_sizes = p.get_patch_sizes()
+        if patch_sizes is None:
+            return False
+        # Patch chains can cost more than the full archive
+        size_key = '{}*{}*{}*{}*{}'.format(self.updates_key, name, latest,
+                                           self.platform, 'file_size')
+        if choose_patch_update(name, self.easy_data.get(size_key),
+                               patch_sizes, self.patch_apply_cost,
+                               p.get_patch_formats()) is False:
+            return None
 
         # Returns True if everything went well
         # If False is returned then we will just do the full
@@ -305,7 +527,7 @@ class LibUpdate(object):
         return p.start()
 
     # Starting full update
-    def _full_update(self, name):
+    def _full_update(self, name, options):
         log.info('Starting full update')
         latest = get_highest_version(name, self.platform, self.easy_data)
 
@@ -315,18 +537,37 @@ class LibUpdate(object):
                                            latest, self.platform,
                                            'file_hash')
         file_hash = self.easy_data.get(hash_key)
+        size_key = '{}*{}*{}*{}*{}'.format(self.updates_key, name,
+                                           latest, self.platform,
+                                           'file_size')
+
+        log.info('Downloading update...')
+        fd = SegmentedDownloader(filename, self.update_urls,
+                                 file_hash, self.verify,
+                                 options['progress_hooks'],
+                                 http_pool=self.http_pool,
+                                 segments=options['download_segments'],
+                                 rate_limiter=self.rate_limiter,
+                                 progress_rate=self.progress_rate,
+                                 cache=self.cache,
+                                 retry_policy=self.retry_policy,
+                                 circuit_breaker=self.circuit_breaker,
+                                 directory=self.update_folder,
+                                 byte_budget=options['byte_budget'],
+                                 file_size=self.easy_data.get(size_key),
+                                 mirrors=self.mirrors)
+        result = fd.download_verify_write()
+        if result:
+            log.info('Download Complete')
+            return True
+        else:  # pragma: no cover
+            log.error('Failed To Download Latest Version')
+            return False
 
-        with jms_utils.paths.ChDir(self.update_folder):
-            log.info('Downloading update...')
-            fd = FileDownloader(filename, self.update_urls,
-                                file_hash, self.verify, self.progress_hooks)
-            result = fd.download_verify_write()
-            if result:
-                log.info('Download Complete')
-                return True
-            else:  # pragma: no cover
-                log.error('Failed To Download Latest Version')
-                return False
+    # Removes patches & partial patch downloads once the update is done
+    def _remove_patches(self):
+        shutil.rmtree(get_patch_folder(self.update_folder, self.name),
+                      ignore_errors=True)
 
     # Removed old update archives
     def _remove_old_updates(self):
@@ -347,21 +588,26 @@ class LibUpdate(object):
             log.warning('Cannot parse version info')
             current_version = Version('0.0.0')
         log.debug('Current verion: {}'.format(str(current_version)))
-        with jms_utils.paths.ChDir(self.update_folder):
-            temp = os.listdir(os.getcwd())
-            for t in temp:
-                try:
-                    old_version = Version(t)
-                except UtilsError:  # pragma: no cover
-                    log.warning('Cannot parse version info')
-                    # Skip file since we can't parse
-                    continue
-                log.debug('Old version: {}'.format(str(old_version)))
-                # Only attempt to remove old files of the one we
-                # are updating
-                if self.name in t and old_version < current_version:
-                    log.info('Removing old update: {}'.format(t))
-                    os.remove(t)
+        temp = os.listdir(self.update_folder)
+        for t in temp:
+            # Partial downloads of old versions get removed as well
+            version_str = t
+            for ext in [settings.DOWNLOAD_INFO_EXT,
+                        settings.DOWNLOAD_TEMP_EXT]:
+                if version_str.endswith(ext):
+                    version_str = version_str[:-len(ext)]
+            try:
+                old_version = Version(version_str)
+            except (UtilsError, VersionError):  # pragma: no cover
+                log.warning('Cannot parse version info')
+                # Skip file since we can't parse
+                continue
+            log.debug('Old version: {}'.format(str(old_version)))
+            # Only attempt to remove old files of the one we
+            # are updating
+            if self.name in t and old_version < current_version:
+                log.info('Removing old update: {}'.format(t))
+                os.remove(os.path.join(self.update_folder, t))
 
 
 class AppUpdate(LibUpdate):
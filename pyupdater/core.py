@@ -65,11 +65,17 @@ class Core(object):
         "Sets up root dir with required PyUpdater folders"
         self.ph.setup()
 
-    def process_packages(self):
+    def process_packages(self, skip_ahead=None):
         """Creates hash for updates & adds information about update to
         version file
+
+        Kwargs:
+
+            skip_ahead (int): Number of older versions, before the
+                              previous one, to make a direct patch from.
+                              Uses SKIP_AHEAD_PATCHES config value if None
         """
-        self.ph.process_packages()
+        self.ph.process_packages(skip_ahead)
 
     def set_uploader(self, requested_uploader):
         """Sets upload destination
@@ -21,17 +21,14 @@ import multiprocessing
 import os
 import shutil
 
-try:  # pragma: no cover
-    import bsdiff4
-except ImportError:  # pragma: no cover
-    bsdiff4 = None
-
 from pyupdater import settings
 from pyupdater.utils import (EasyAccessDict,
                              get_package_hashes as gph,
                              lazy_import,
-                             remove_dot_files
+                             remove_dot_files,
+                             Version
                              )
+from pyupdater.utils.diff_engines import get_engine
 from pyupdater.utils.exceptions import PackageHandlerError
 from pyupdater.utils.package import Package, Patch
 
@@ -77,6 +74,9 @@ class PackageHandler(object):
         else:
             log.info('Patch support disabled')
             self.patch_support = False
+        self.skip_ahead = obj.get('SKIP_AHEAD_PATCHES',
+                                  settings.SKIP_AHEAD_PATCHES)
+        self.patch_format = obj.get('PATCH_FORMAT', settings.PATCH_FORMAT)
         data_dir = obj.get('DATA_DIR', os.getcwd())
         self.db = db
         self.data_dir = os.path.join(data_dir, settings.USER_DATA_FOLDER)
@@ -102,14 +102,22 @@ class PackageHandler(object):
             self.config = self._load_config()
             self.config_loaded = True
 
-    def process_packages(self):
+    def process_packages(self, skip_ahead=None):
         """Gets a list of updates to process.  Adds the name of an
         update to the version file if not already present.  Processes
         all packages.  Updates the version file meta-data. Then writes
         version file back to disk.
+
+        Kwargs:
+
+            skip_ahead (int): Number of older versions, before the
+                              previous one, to make a direct patch from.
+                              Uses SKIP_AHEAD_PATCHES config value if None
         """
         if self.data_dir is None:
             raise PackageHandlerError('Must init first.', expected=True)
+        if skip_ahead is not None:
+            self.skip_ahead = skip_ahead
         package_manifest, patch_manifest = self._get_package_list()
         patches = self._make_patches(patch_manifest)
         self._cleanup(patch_manifest)
@@ -188,6 +196,8 @@ class PackageHandler(object):
 
                 # Add package hash
                 package.file_hash = gph(package.filename)
+                # Lets clients weigh patching against a full download
+                package.file_size = os.path.getsize(package.filename)
                 self.json_data = self._update_file_list(self.json_data,
                                                         package)
 
@@ -213,9 +223,16 @@ class PackageHandler(object):
                                           patch_name=os.path.join(self.new_dir,
                                                                   patch_name),
                                           patch_num=patch_number,
-                                          package=package.filename)
+                                          package=package.filename,
+                                          patch_format=self.patch_format)
+                        # Sources of skip-ahead patches are needed for
+                        # the next ones
+                        if self.skip_ahead > 0:
+                            patch_info['keep_src'] = True
                         # ready for patching
                         patch_manifest.append(patch_info)
+                        patch_manifest += self._skip_ahead_patches(
+                            patch_info, package)
                     else:
                         log.warning('No source file to patch from')
 
@@ -258,6 +275,8 @@ class PackageHandler(object):
             return
         log.info('Cleaning up files directory')
         for p in patch_manifest:
+            if p.get('keep_src') is True:
+                continue
             if os.path.exists(p['src']):
                 basename = os.path.basename(p['src'])
                 log.info('Removing {}'.format(basename))
@@ -276,7 +295,11 @@ class PackageHandler(object):
             cpu_count = 2
 
         pool = multiprocessing.Pool(processes=cpu_count)
-        pool_output = pool.map(_make_patch, patch_manifest)
+        try:
+            pool_output = pool.map(_make_patch, patch_manifest)
+        finally:
+            pool.close()
+            pool.join()
         return pool_output
 
     def _add_patches_to_packages(self, package_manifest, patches):
@@ -294,6 +317,9 @@ class PackageHandler(object):
                 for pm in package_manifest:
                     #
                     if p.dst_filename == pm.filename:
+                        if p.base_version is not None:
+                            self._add_skip_ahead_patch(pm, p)
+                            break
                         pm.patch_info['patch_name'] = \
                             os.path.basename(p.patch_name)
                         # Don't try to get hash on a ghost file
@@ -301,7 +327,10 @@ class PackageHandler(object):
                             p_name = ''
                         else:
                             p_name = gph(p.patch_name)
+                            pm.patch_info['patch_size'] = \
+                                os.path.getsize(p.patch_name)
                         pm.patch_info['patch_hash'] = p_name
+                        pm.patch_info['patch_format'] = p.patch_format
                         # No need to keep searching
                         # We have the info we need for this patch
                         break
@@ -312,6 +341,17 @@ class PackageHandler(object):
                 log.warning('No patches found')
         return package_manifest
 
+    def _add_skip_ahead_patch(self, package, patch):
+        # Skip-ahead patches are listed by the version they patch from
+        if not os.path.exists(patch.patch_name):
+            return
+        skip_patches = package.patch_info.setdefault('skip_patches', {})
+        skip_patches[patch.base_version] = {
+            'patch_name': os.path.basename(patch.patch_name),
+            'patch_hash': gph(patch.patch_name),
+            'patch_size': os.path.getsize(patch.patch_name),
+            'patch_format': patch.patch_format}
+
     def _update_version_file(self, json_data, package_manifest):
         # Updates version file with package meta-data
         log.info('Adding package meta-data to version manifest')
@@ -323,9 +363,18 @@ class PackageHandler(object):
             # Converting info to format compatible for version file
             info = {'file_hash': p.file_hash,
                     'filename': p.filename}
+            if p.file_size is not None:
+                info['file_size'] = p.file_size
             if patch_name and patch_hash:
                 info['patch_name'] = patch_name
                 info['patch_hash'] = patch_hash
+                info['patch_format'] = p.patch_info.get('patch_format')
+                patch_size = p.patch_info.get('patch_size')
+                if patch_size is not None:
+                    info['patch_size'] = patch_size
+            skip_patches = p.patch_info.get('skip_patches')
+            if skip_patches:
+                info['skip_patches'] = skip_patches
 
             version_key = '{}*{}*{}'.format(settings.UPDATES_KEY,
                                             p.name, p.version)
@@ -370,9 +419,13 @@ class PackageHandler(object):
             return
         log.info('Moving packages to deploy folder')
         for p in package_manifest:
-            patch = p.patch_info.get('patch_name')
+            patches = [p.patch_info.get('patch_name')]
+            skip_patches = p.patch_info.get('skip_patches', {})
+            patches += [s['patch_name'] for s in skip_patches.values()]
             with jms_utils.paths.ChDir(self.new_dir):
-                if patch:
+                for patch in patches:
+                    if not patch:
+                        continue
                     if os.path.exists(os.path.join(self.deploy_dir, patch)):
                         os.remove(os.path.join(self.deploy_dir, patch))
                     log.debug('Moving {} to {}'.format(patch,
@@ -410,8 +463,10 @@ class PackageHandler(object):
         # make patch updates
         # Also calculates patch number
         log.info('Checking if patch creation is possible')
-        if bsdiff4 is None:
-            log.warning('Bsdiff is missing. Cannot create patches')
+        engine = get_engine(self.patch_format)
+        if engine is None or engine.can_diff() is False:
+            log.warning('Cannot create {} patches. Unknown format or '
+                        'missing module'.format(self.patch_format))
             return None
         src_file_path = None
         if os.path.exists(self.files_dir):
@@ -452,6 +507,41 @@ class PackageHandler(object):
             return src_file_path, num
         return None
 
+    def _skip_ahead_patches(self, patch_info, package):
+        # Returns patch info of direct patches to package from the
+        # skip_ahead versions before the previous one. Only the archives
+        # still needed for the next skip-ahead patches are kept
+        if self.skip_ahead < 1:
+            return []
+        try:
+            versions = self.json_data[settings.UPDATES_KEY][package.name]
+            latest = self.json_data['latest'][package.name][package.platform]
+        except KeyError:
+            return []
+        older = []
+        for version, platforms in versions.items():
+            if package.platform not in platforms:
+                continue
+            if Version(version) >= Version(latest):
+                continue
+            filename = platforms[package.platform].get('filename')
+            if filename is None:
+                continue
+            src = os.path.join(self.files_dir, filename)
+            if os.path.exists(src):
+                older.append((Version(version), version, src))
+        # Newest first
+        older = sorted(older, key=lambda o: o[0].version_tuple,
+                       reverse=True)[:self.skip_ahead]
+        patches = []
+        for i, (_, version, src) in enumerate(older):
+            info = dict(patch_info, src=src, base_version=version,
+                        keep_src=i < self.skip_ahead - 1)
+            log.info('Found source file to create skip-ahead patch '
+                     'from {}'.format(version))
+            patches.append(info)
+        return patches
+
 
 def _make_patch(patch_info):
     # Does with the name implies. Used with multiprocessing
@@ -461,6 +551,9 @@ def _make_patch(patch_info):
     patch_number = patch_info['patch_num']
     src_path = patch_info['src']
     patch_name += '-' + str(patch_number)
+    if patch.base_version is not None:
+        # Skip-ahead patches also carry the version they patch from
+        patch_name += '-' + patch.base_version
     # Updating with full name - number included
     patch.patch_name = patch_name
     if not os.path.exists(src_path):
@@ -472,7 +565,8 @@ def _make_patch(patch_info):
         if patch.ready is True:
             log.info("Creating patch... "
                      "{}".format(os.path.basename(patch_name)))
-            bsdiff4.file_diff(src_path, patch.dst_path, patch.patch_name)
+            engine = get_engine(patch.patch_format)
+            engine.file_diff(src_path, patch.dst_path, patch.patch_name)
             base_name = os.path.basename(patch_name)
             log.info('Done creating patch... {}'.format(base_name))
         else:
@@ -54,6 +54,138 @@ UPDATES_KEY = 'updates'
 # Folder on client system where updates are stored
 UPDATE_FOLDER = 'update'
 
+# Extension added to files while they're being downloaded
+DOWNLOAD_TEMP_EXT = '.part'
+
+# Prefix of the temp dir in the update folder holding patches &
+# patched binaries while patching
+PATCH_TEMP_PREFIX = 'patching-'
+
+# Prefix of the folder in the update folder patches of a package are
+# downloaded to. Kept between runs so interrupted patch downloads resume
+PATCH_FOLDER_PREFIX = 'patches-'
+
+# Extension added to partial downloads for the file holding the
+# info needed to resume the download
+DOWNLOAD_INFO_EXT = '.json'
+
+# How often, in bytes, resume info is saved during a download
+DOWNLOAD_CHECKPOINT_SIZE = 1024 * 1024
+
+# Default number of concurrent requests used to download full updates
+DOWNLOAD_SEGMENTS = 4
+
+# Number of segments queued per concurrent request.  Lets fast
+# mirrors pick up more segments than slow ones.
+DOWNLOAD_SEGMENTS_PER_WORKER = 4
+
+# Files smaller than this, in bytes, are downloaded in one request
+SEGMENTED_DOWNLOAD_MIN_SIZE = 8 * 1024 * 1024
+
+# Default number of times a failed download is retried
+DOWNLOAD_RETRIES = 3
+
+# Seconds waited before the first retry. Doubles with every retry
+DOWNLOAD_BACKOFF = 0.5
+
+# Max seconds waited between retries
+DOWNLOAD_MAX_BACKOFF = 30
+
+# Response status codes worth retrying, possibly from another url
+DOWNLOAD_RETRY_STATUS = [429, 500, 502, 503, 504]
+
+# Failures in a row before an update url is skipped
+CIRCUIT_BREAKER_THRESHOLD = 3
+
+# Seconds an update url is skipped for after too many failures
+CIRCUIT_BREAKER_COOL_DOWN = 60
+
+# Number of hosts the shared http connection pool keeps connections to
+HTTP_POOL_NUM_POOLS = 10
+
+# Number of connections kept alive per host. Should be at least
+# DOWNLOAD_SEGMENTS
+HTTP_POOL_MAXSIZE = 8
+
+# Responses with at most this many unread bytes are read to the end
+# so their connection can be reused. Bigger ones are closed
+HTTP_DRAIN_MAX_SIZE = 64 * 1024
+
+# File in client data dir where update url stats are saved
+MIRROR_STATS_FILE = 'mirrors.json'
+
+# Seconds to wait for an update url to respond when probing
+MIRROR_PROBE_TIMEOUT = 5
+
+# Seconds added to the score of an update url per recent error
+MIRROR_ERROR_PENALTY = 10
+
+# Weight given to the latest request when updating latency of an url
+MIRROR_LATENCY_WEIGHT = 0.5
+
+# Seconds an url isn't probed again after a probe or download told
+# us how it's doing
+MIRROR_PROBE_INTERVAL = 60 * 60
+
+# Default max number of downloads & async calls running at once
+MAX_CONCURRENT_DOWNLOADS = 4
+
+# Default max combined size, in bytes, of packages downloaded at
+# once by Client.update_all
+MAX_BYTES_IN_FLIGHT = 256 * 1024 * 1024
+
+# Download speed, in bytes a second, the time applying patches takes
+# is weighed against. Kept low since saving bytes is worth some cpu
+# time & a lot of updates are downloaded over slow connections
+PATCH_DOWNLOAD_SPEED = 2 * 1024 * 1024
+
+# Cost of applying a patch, in bytes per byte of archive. None works
+# it out from PATCH_DOWNLOAD_SPEED & the measured apply speed of the
+# patch's format. bsdiff4 patches cost 0.02
+PATCH_APPLY_COST = None
+
+# Default format of patches made by pkg --process. One of the
+# engines in pyupdater.utils.diff_engines
+PATCH_FORMAT = 'bsdiff4'
+
+# Format of patches in version files made before formats were
+# written to it
+LEGACY_PATCH_FORMAT = 'bsdiff4'
+
+# Default zlib compression level of update archives made by
+# pyupdater build
+ARCHIVE_COMPRESS_LEVEL = 9
+
+# Default number of threads compressing tar.gz update archives. None
+# for one per cpu
+ARCHIVE_WORKERS = None
+
+# Bytes of data compressed at once by each thread when making tar.gz
+# update archives. Same as pigz
+ARCHIVE_BLOCK_SIZE = 128 * 1024
+
+# Default number of older versions, before the previous one, that
+# pkg --process makes a direct patch to the new version from
+SKIP_AHEAD_PATCHES = 0
+
+# Max number of progress events sent to callbacks per second
+PROGRESS_HOOK_RATE = 10
+
+# Default max size, in bytes, of the download cache shared between apps
+SHARED_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+
+# Used to get the default shared cache dir from appdirs
+SHARED_CACHE_APP_NAME = 'PyUpdater'
+SHARED_CACHE_COMPANY_NAME = 'Digital Sapphire'
+
+# Folder in client data dir holding lock files that keep apps
+# from downloading the same update at the same time
+DOWNLOAD_LOCK_FOLDER = 'locks'
+
 # Name of version file place in online repo
 VERSION_FILE = 'versions.gz'
 VERSION_FILE_OLD = 'version.json'
+
+# File in client data dir holding the ETag & Last-Modified headers
+# of the last downloaded version file
+VERSION_FILE_CACHE_INFO = 'versions.gz.json'
@@ -25,6 +25,7 @@ import six
 from pyupdater import settings
 from pyupdater.utils import lazy_import, remove_dot_files
 from pyupdater.utils.exceptions import UploaderError, UploaderPluginError
+from pyupdater.utils.progress import call_progress_hooks, ProgressDispatcher
 
 log = logging.getLogger(__name__)
 
@@ -136,10 +137,26 @@ class Uploader(object):
 class BaseUploader(object):
     """Base Uploader.  All uploaders should subclass
     this base class
+
+    Uploaders report progress of the current file by calling
+    self.progress.update(bytes_sent).  Hooks get status dicts at most
+    settings.PROGRESS_HOOK_RATE times a second.
     """
     def __init__(self):
         self.failed_uploads = []
         self.deploy_dir = None
+        self.progress_hooks = []
+        self.progress = ProgressDispatcher(self._call_progress_hooks,
+                                           done_key='uploaded')
+
+    def add_progress_hook(self, cb):
+        """Adds a callback for upload progress
+
+        Args:
+
+            cb (func): Called with a status dict
+        """
+        self.progress_hooks.append(cb)
 
     def init(self, **kwargs):
         """Used to pass file list & any other config options set during
@@ -169,7 +186,7 @@ class BaseUploader(object):
             msg2 = ' - File {} of {}\n'.format(self.files_completed,
                                                self.file_count)
             print(msg + msg2)
-            complete = self.upload_file(f)
+            complete = self._upload_file(f)
             if complete:
                 log.debug('{} uploaded successfully'.format(f))
                 self.files_completed += 1
@@ -199,7 +216,7 @@ class BaseUploader(object):
             msg = '\n\nRetyring: {} - File {} of {}\n'.format(f, count,
                                                               failed_count)
             print(msg)
-            complete = self.upload_file(f)
+            complete = self._upload_file(f)
             if complete:
                 log.debug('{} uploaded on retry'.format(f))
                 count += 1
@@ -215,12 +232,34 @@ class BaseUploader(object):
             print('\nUpload complete')
             return True
 
+    def _upload_file(self, filename):
+        # Wraps upload_file with progress start & finish events
+        self.progress.start(self._get_file_size(filename))
+        complete = self.upload_file(filename)
+        if complete:
+            self.progress.finish(self.progress.total)
+        else:
+            self.progress.finish(status='failed')
+        return complete
+
+    def _call_progress_hooks(self, data):
+        call_progress_hooks(self.progress_hooks, data)
+
+    def _get_file_size(self, filename):
+        if self.deploy_dir is None:
+            return None
+        path = os.path.join(self.deploy_dir, filename)
+        if not os.path.isfile(path):
+            return None
+        return os.path.getsize(path)
+
     def connect(self):
         "Connects to service"
         raise NotImplementedError('Must be implemented in subclass.')
 
     def upload_file(self, filename):
-        """Uploads file to remote repository
+        """Uploads file to remote repository. Should call
+        self.progress.update(bytes_sent) while uploading
 
         Args:
             filename (str): file to upload
@@ -15,7 +15,10 @@
 # --------------------------------------------------------------------------
 from __future__ import unicode_literals
 
+import binascii
+import io
 import logging
+import struct
 import sys
 
 from pyupdater import settings
@@ -23,6 +26,12 @@ from pyupdater.utils.exceptions import UtilsError, VersionError
 
 log = logging.getLogger(__name__)
 
+# Size of chunks read when hashing files on disk
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Size of blocks the pure python bsdiff4 patcher adds at once
+BSDIFF_BLOCK_SIZE = 1024 * 1024
+
 
 def lazy_import(func):
     """Decorator for declaring a lazy import.
@@ -93,24 +102,30 @@ def bz2():
     return bz2
 
 
-@lazy_import
-def gzip():
-    import gzip
-    return gzip
-
-
 @lazy_import
 def hashlib():
     import hashlib
     return hashlib
 
 
+@lazy_import
+def multiprocessing():
+    import multiprocessing
+    return multiprocessing
+
+
 @lazy_import
 def os():
     import os
     return os
 
 
+@lazy_import
+def pgzip():
+    import pyupdater.utils.parallel_gzip
+    return pyupdater.utils.parallel_gzip
+
+
 @lazy_import
 def re():
     import re
@@ -123,12 +138,6 @@ def shutil():
     return shutil
 
 
-@lazy_import
-def StringIO():
-    import StringIO
-    return StringIO
-
-
 @lazy_import
 def subprocess():
     import subprocess
@@ -153,6 +162,12 @@ def zipfile():
     return zipfile
 
 
+@lazy_import
+def zlib():
+    import zlib
+    return zlib
+
+
 @lazy_import
 def jms_utils():
     import jms_utils
@@ -284,7 +299,8 @@ def get_mac_dot_app_dir(directory):
 
 
 def get_package_hashes(filename):
-    """Provides hash of given filename.
+    """Provides hash of given filename. File is read in chunks so
+    memory usage doesn't grow with the size of the file.
 
     Args:
 
@@ -296,10 +312,12 @@ def get_package_hashes(filename):
     """
     log.debug('Getting package hashes')
     filename = os.path.abspath(filename)
+    hasher = hashlib.sha256()
     with open(filename, 'rb') as f:
-        data = f.read()
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            hasher.update(block)
 
-    _hash = hashlib.sha256(data).hexdigest()
+    _hash = hasher.hexdigest()
     log.debug('Hash for file {}: {}'.format(filename, _hash))
     return _hash
 
@@ -316,19 +334,9 @@ def gzip_decompress(data):
 
         (data): Decompressed data
     """
-    compressed_file = StringIO.StringIO()
-    compressed_file.write(data)
-    #
-    # Set the file's current position to the beginning
-    # of the file so that gzip.GzipFile can read
-    # its contents from the top.
-    #
-    compressed_file.seek(0)
-    decompressed_file = gzip.GzipFile(fileobj=compressed_file, mode='rb')
-    data = decompressed_file.read()
-    compressed_file.close()
-    decompressed_file.close()
-    return data
+    decompressor = GzipDecompressor(keep_compressed=False)
+    decompressor.write(data)
+    return decompressor.getvalue()
 
 
 def setup_appname(config):  # pragma: no cover
@@ -473,7 +481,8 @@ def repo_update(config):
     repo_update_remove_attr(config)
 
 
-def make_archive(name, version, target):
+def make_archive(name, version, target, reproducible=False,
+                 compress_level=None, workers=None):
     """Used to make archives of file or dir. Zip on windows and tar.gz
     on all other platforms
 
@@ -484,9 +493,23 @@ def make_archive(name, version, target):
 
         target - name of actual target file or dir.
 
+    Kwargs:
+        reproducible (bool) - Same files always make the same archive.
+                              Members are sorted & their times, owners
+                              & permissions are normalized
+
+        compress_level (int) - zlib compression level. Defaults to
+                               settings.ARCHIVE_COMPRESS_LEVEL
+
+        workers (int) - Number of threads compressing a tar.gz.
+                        Defaults to settings.ARCHIVE_WORKERS or one
+                        per cpu. With one the gzip module compresses
+
     Returns:
          (str) - name of archive
     """
+    if compress_level is None:
+        compress_level = settings.ARCHIVE_COMPRESS_LEVEL
     file_dir = os.path.dirname(os.path.abspath(target))
     filename = '{}-{}-{}'.format(name, jms_utils.system.get_system(), version)
     filename_path = os.path.join(file_dir, filename)
@@ -511,15 +534,23 @@ def make_archive(name, version, target):
     # permissions on nix & mac
     if jms_utils.system.get_system() == 'win':
         ext = '.zip'
-        with zipfile.ZipFile(filename_path + '.zip', 'w') as zf:
-            zf.write(target, temp_file)
+        if reproducible is True:
+            make_reproducible_zip(filename_path + ext, temp_file,
+                                  compress_level)
+        else:
+            with zipfile.ZipFile(filename_path + ext, 'w') as zf:
+                zf.write(target, temp_file)
     else:
         ext = '.tar.gz'
-        if os.path.isfile(target):
-            with tarfile.open(filename_path + '.tar.gz', 'w:gz') as tar:
-                tar.add(target, temp_file)
+        if reproducible is True:
+            make_reproducible_tar_gz(filename_path + ext, temp_file,
+                                     compress_level, workers)
         else:
-            shutil.make_archive(filename, 'gztar', file_dir, temp_file)
+            with open(filename_path + ext, 'wb') as f:
+                with pgzip.open_gzip_writer(f, compress_level,
+                                            workers) as gz:
+                    with tarfile.open(fileobj=gz, mode='w') as tar:
+                        tar.add(target, temp_file)
 
     if os.path.exists(temp_file):
         log.debug('Removing: {}'.format(temp_file))
@@ -532,6 +563,117 @@ def make_archive(name, version, target):
     return output_filename
 
 
+def make_reproducible_tar_gz(filename, target,
+                             compress_level=settings.ARCHIVE_COMPRESS_LEVEL,
+                             workers=None):
+    """Makes a tar.gz of a file or dir that only changes when the
+    contents, names or executable bits of the files change.
+
+    Args:
+
+        filename (str): Path of the archive
+
+        target (str): File or dir to archive. Relative paths are kept
+
+    Kwargs:
+
+        compress_level (int): zlib compression level
+
+        workers (int): Number of threads compressing. Any number but
+                       one makes the same archive. One compresses with
+                       the gzip module, which makes a different one.
+                       Defaults to settings.ARCHIVE_WORKERS or one per
+                       cpu, but at least two
+    """
+    mtime = _get_archive_mtime()
+    if workers is None:
+        # Archives made on machines with one cpu & with many match
+        workers = settings.ARCHIVE_WORKERS or \
+            max(multiprocessing.cpu_count(), 2)
+    with open(filename, 'wb') as f:
+        # No file name & a fixed time in the gzip header
+        with pgzip.open_gzip_writer(f, compress_level, workers,
+                                    mtime=mtime) as gz:
+            with tarfile.open(fileobj=gz, mode='w',
+                              format=tarfile.GNU_FORMAT) as tar:
+                for path in _walk_sorted(target):
+                    info = tar.gettarinfo(path)
+                    info.mtime = mtime
+                    info.mode = _normalize_mode(info.mode)
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = ''
+                    if info.isreg():
+                        with open(path, 'rb') as member:
+                            tar.addfile(info, member)
+                    else:
+                        tar.addfile(info)
+
+
+def make_reproducible_zip(filename, target,
+                          compress_level=settings.ARCHIVE_COMPRESS_LEVEL):
+    """Makes a zip of a file or dir that only changes when the contents,
+    names or executable bits of the files change. The compression level
+    is only used on python 3.7+
+
+    Args:
+
+        filename (str): Path of the archive
+
+        target (str): File or dir to archive. Relative paths are kept
+
+    Kwargs:
+
+        compress_level (int): zlib compression level
+    """
+    kwargs = {}
+    if sys.version_info >= (3, 7):
+        kwargs['compresslevel'] = compress_level
+    # Zip times start at 1980
+    date_time = time.gmtime(max(_get_archive_mtime(), 315532800))[:6]
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED,
+                         **kwargs) as zf:
+        for path in _walk_sorted(target):
+            name = path.replace(os.sep, '/')
+            mode = _normalize_mode(os.lstat(path).st_mode)
+            if os.path.isdir(path):
+                name += '/'
+            info = zipfile.ZipInfo(name, date_time)
+            info.create_system = 3
+            info.external_attr = (mode & 0xFFFF) << 16
+            if os.path.isdir(path):
+                # MS-DOS directory flag
+                info.external_attr |= 0x10
+                zf.writestr(info, b'')
+                continue
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, 'rb') as f:
+                zf.writestr(info, f.read())
+
+
+def _get_archive_mtime():
+    # Time given to every member of reproducible archives. Build
+    # tools set SOURCE_DATE_EPOCH to the time of the last commit
+    return int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+
+
+def _normalize_mode(mode):
+    # Only keeps the file type & if it's executable, so a different
+    # umask or checkout doesn't change the archive
+    if mode & 0o111 or mode & 0o170000 == 0o040000:
+        return mode & 0o170000 | 0o755
+    return mode & 0o170000 | 0o644
+
+
+def _walk_sorted(target):
+    # Yields target & everything under it sorted by name. Links to
+    # dirs aren't followed
+    yield target
+    if os.path.isdir(target) and not os.path.islink(target):
+        for name in sorted(os.listdir(target)):
+            for path in _walk_sorted(os.path.join(target, name)):
+                yield path
+
+
 def parse_platform(name):
     """Parses platfrom name from given string
 
@@ -585,6 +727,26 @@ def remove_dot_files(files):
     return new_list
 
 
+def replace_file(src, dst):
+    """Renames src to dst, replacing dst if it already exists. The
+    rename is atomic on posix systems. On windows dst has to be removed
+    first, which leaves a small window where neither file exists.
+
+    Args:
+
+        src (str): Path of file to move
+
+        dst (str): Path to move file to
+    """
+    log.debug('Moving {} to {}'.format(src, dst))
+    if hasattr(os, 'replace'):  # pragma: no cover
+        os.replace(src, dst)
+        return
+    if sys.platform == 'win32' and os.path.exists(dst):  # pragma: no cover
+        os.remove(dst)
+    os.rename(src, dst)
+
+
 def run(cmd):
     """Logs a command before running it in subprocess.
 
@@ -607,61 +769,174 @@ def _decode_offt(bytes):
     This decodes a signed integer into 8 bytes.  I'd prefer some sort of
     signed vint representation, but this is the format used by bsdiff4.
     """
-    if sys.version_info[0] < 3:
-        bytes = map(ord, bytes)
-    x = bytes[7] & 0x7F
-    for b in xrange(6, -1, -1):
-        x = x * 256 + bytes[b]
-    if bytes[7] & 0x80:
-        x = -x
+    x = struct.unpack(str('<Q'), bytes)[0]
+    if x & _OFFT_SIGN:
+        x = -(x & ~_OFFT_SIGN)
     return x
 
 
+_OFFT_SIGN = 1 << 63
+
+# Set to the numpy module on first use. False if not installed
+_numpy = None
+
+# (size, mask) of the last mask made by _get_even_mask
+_even_mask = (0, 0)
+
+
+def _add_bytes_int(diff, orig):
+    # Adds two equal length byte strings byte by byte, modulo 256.
+    # Both are read as one big int & the bytes at even & odd offsets
+    # are added separately, so a carry only runs into the empty byte
+    # next to it & is masked off. Every step runs in C.
+    size = len(diff)
+    even = _get_even_mask(size)
+    odd = even << 8
+    a = _to_int(diff, size)
+    b = _to_int(orig, size)
+    total = (((a & even) + (b & even)) & even) | \
+        (((a & odd) + (b & odd)) & odd)
+    return _from_int(total, size)
+
+
+def _get_even_mask(size):
+    # Int with the bytes at even offsets set. Most blocks are
+    # BSDIFF_BLOCK_SIZE so the last one made is kept
+    global _even_mask
+    if _even_mask[0] != size:
+        _even_mask = (size, _to_int(b'\x00\xff' * (size // 2 + 1), size))
+    return _even_mask[1]
+
+
+def _add_bytes_numpy(diff, orig):
+    # Same as _add_bytes_int. uint8 math wraps at 256
+    add = _numpy.frombuffer(diff, dtype=_numpy.uint8) + \
+        _numpy.frombuffer(orig, dtype=_numpy.uint8)
+    return add.tobytes()
+
+
+def _get_add_bytes():
+    # Uses numpy when installed. Never required
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    if _numpy is False:
+        return _add_bytes_int
+    return _add_bytes_numpy
+
+
+def _to_int(data, size):
+    # Big endian int of the last size bytes of data
+    data = data[len(data) - size:]
+    if six.PY2:
+        return int(binascii.hexlify(data) or b'0', 16)
+    return int.from_bytes(data, 'big')
+
+
+def _from_int(value, size):
+    if six.PY2:
+        # hex is faster than string formatting on python 2
+        return binascii.unhexlify(hex(value)[2:].rstrip(b'L').zfill(size * 2))
+    return value.to_bytes(size, 'big')
+
+
+def _bsdiff4_patch(source, patch, add_bytes, sink=None):
+    if patch[:7] != b'BSDIFF4':
+        raise ValueError('incorrect magic bsdiff4 header')
+    return _bsdiff4_apply(source, add_bytes, *_read_bsdiff4_patch(patch),
+                          sink=sink)
+
+
+def _encode_offt(x):
+    # Opposite of _decode_offt
+    if x < 0:
+        x = -x | _OFFT_SIGN
+    return struct.pack(str('<Q'), x)
+
+
+def _read_bsdiff4_patch(patch, decompress=None):
+    # Returns new size & the control, diff & extra blocks of a patch
+    # in the bsdiff4 layout. Blocks are compressed with decompress's
+    # format, bz2 by default
+    if decompress is None:
+        decompress = bz2.decompress
+    #  Read the length headers
+    l_bcontrol = _decode_offt(patch[8:16])
+    l_bdiff = _decode_offt(patch[16:24])
+    l_new = _decode_offt(patch[24:32])
+    #  Read the three data blocks
+    e_bcontrol = 32 + l_bcontrol
+    e_bdiff = e_bcontrol + l_bdiff
+    bcontrol = decompress(patch[32:e_bcontrol])
+    bdiff = decompress(patch[e_bcontrol:e_bdiff])
+    bextra = decompress(patch[e_bdiff:])
+    return l_new, bcontrol, bdiff, bextra
+
+
+def _bsdiff4_apply(source, add_bytes, l_new, bcontrol, bdiff, bextra,
+                   sink=None):
+    # bsdiff4 patch algorithm. Output is written to sink, a file like
+    # object, a piece at a time. Without a sink it's returned. Diff
+    # bytes are added to the source bytes a block at a time with
+    # add_bytes.
+    output = sink
+    if output is None:
+        output = io.BytesIO()
+    # Source is sliced instead of wrapped in a file object so
+    # it can be an mmap
+    source_size = len(source)
+    old_pos = new_pos = diff_pos = extra_pos = 0
+    for i in six.moves.range(0, len(bcontrol), 24):
+        x = _decode_offt(bcontrol[i:i + 8])
+        y = _decode_offt(bcontrol[i + 8:i + 16])
+        z = _decode_offt(bcontrol[i + 16:i + 24])
+        if new_pos + x > l_new or diff_pos + x > len(bdiff):
+            raise ValueError('corrupt patch (overflow)')
+        diff_data = bdiff[diff_pos:diff_pos + x]
+        # Bytes past either end of the source are left as is
+        start = min(max(-old_pos, 0), x)
+        end = max(min(source_size - old_pos, x), start)
+        output.write(diff_data[:start])
+        step = BSDIFF_BLOCK_SIZE
+        for j in six.moves.range(start, end, step):
+            k = min(j + step, end)
+            output.write(add_bytes(diff_data[j:k],
+                                   source[old_pos + j:old_pos + k]))
+        output.write(diff_data[end:])
+        diff_pos += x
+        new_pos += x
+        old_pos += x
+
+        if new_pos + y > l_new or extra_pos + y > len(bextra):
+            raise ValueError('corrupt patch (overflow)')
+        output.write(bextra[extra_pos:extra_pos + y])
+        extra_pos += y
+        new_pos += y
+        old_pos += z
+    if new_pos != l_new or diff_pos != len(bdiff) or \
+            extra_pos != len(bextra):
+        raise ValueError('corrupt patch (underflow)')
+    if sink is None:
+        return output.getvalue()
+
+
 class bsdiff4_py(object):
     """Pure-python version of bsdiff4 module that can only patch, not diff.
 
     By providing a pure-python fallback, we don't force frozen apps to
     bundle the bsdiff module in order to make use of patches.  Besides,
     the patch-applying algorithm is very simple.
+
+    Output is the same as bsdiff4.patch. Bytes are added a block at a
+    time, with numpy if installed.
     """
     @staticmethod
-    def patch(source, patch):  # pragma: no cover
-        #  Read the length headers
-        l_bcontrol = _decode_offt(patch[8:16])
-        l_bdiff = _decode_offt(patch[16:24])
-        #  Read the three data blocks
-        e_bcontrol = 32 + l_bcontrol
-        e_bdiff = e_bcontrol + l_bdiff
-        bcontrol = bz2.decompress(patch[32:e_bcontrol])
-        bdiff = bz2.decompress(patch[e_bcontrol:e_bdiff])
-        bextra = bz2.decompress(patch[e_bdiff:])
-        #  Decode the control tuples
-        tcontrol = []
-        for i in xrange(0, len(bcontrol), 24):
-            tcontrol.append((
-                _decode_offt(bcontrol[i:i+8]),
-                _decode_offt(bcontrol[i+8:i+16]),
-                _decode_offt(bcontrol[i+16:i+24]),
-            ))
-        #  Actually do the patching.
-        #  This is the bdiff4 patch algorithm in slow, pure python.
-        source = six.BytesIO(source)
-        result = six.BytesIO()
-        bdiff = six.BytesIO(bdiff)
-        bextra = six.BytesIO(bextra)
-        for (x, y, z) in tcontrol:
-            diff_data = bdiff.read(x)
-            orig_data = source.read(x)
-            if sys.version_info[0] < 3:
-                for i in xrange(len(diff_data)):
-                    result.write(chr((ord(diff_data[i]) +
-                                 ord(orig_data[i])) % 256))
-            else:
-                for i in xrange(len(diff_data)):
-                    result.write(bytes([(diff_data[i] + orig_data[i]) % 256]))
-            result.write(bextra.read(y))
-            source.seek(z, os.SEEK_CUR)
-        return result.getvalue()
+    def patch(source, patch):
+        return _bsdiff4_patch(source, patch, _get_add_bytes())
 
 
 class EasyAccessDict(object):
@@ -719,6 +994,100 @@ class EasyAccessDict(object):
         return str(self.dict)
 
 
+class GzipDecompressor(object):
+    """File like object that decompresses gzip data as it's written.
+    Used as a download sink so data is decompressed while it's being
+    received. Handles files made of more than one gzip member.
+
+        d = GzipDecompressor()
+        for block in blocks:
+            d.write(block)
+        data = d.getvalue()
+
+    Kwargs:
+
+        keep_compressed (bool) Meaning:
+
+            True: Keep a copy of the compressed data.
+                  See :meth:`get_compressed`
+
+            False: Only keep decompressed data
+    """
+
+    def __init__(self, keep_compressed=True):
+        self.keep_compressed = keep_compressed
+        self.truncate()
+
+    def write(self, data):
+        """Decompresses data. Raises IOError on bad data
+
+        Args:
+
+            data (bytes): Next block of gzip data
+        """
+        if isinstance(data, memoryview):
+            # Download blocks can be views of a reused buffer
+            data = data.tobytes()
+        if self.keep_compressed:
+            self._compressed.append(data)
+        try:
+            while len(data) > 0:
+                self._out.append(self._decompressor.decompress(data))
+                data = self._decompressor.unused_data
+                if len(data) > 0:
+                    # Start of the next member
+                    self._decompressor = _gzip_decompressobj()
+        except zlib.error as err:
+            raise IOError('Not a gzip file: {}'.format(err))
+        self._written = True
+
+    def getvalue(self):
+        """Returns (bytes): All decompressed data.
+        Raises IOError if the data ended early"""
+        if self._written is False:
+            raise IOError('No gzip data')
+        if getattr(self._decompressor, 'eof', True) is False:
+            # Python 3 only. On python 2 a cut off file shows
+            # up as bad data later on
+            raise IOError('Gzip data ended early')
+        self._out.append(self._decompressor.flush())
+        data = b''.join(self._out)
+        self._out = [data]
+        return data
+
+    def get_compressed(self):
+        """Returns (bytes): Data as it was written"""
+        return b''.join(self._compressed)
+
+    def seek(self, offset):
+        # Downloads only seek to restart. Anything else would
+        # need the decompressor state at offset
+        if offset != 0:
+            raise IOError('Can only seek to the start')
+
+    def truncate(self, size=0):
+        """Throws away everything written so far
+
+        Kwargs:
+
+            size (int): Must be 0
+        """
+        if size != 0:
+            raise IOError('Can only truncate to 0')
+        self._decompressor = _gzip_decompressobj()
+        self._compressed = []
+        self._out = []
+        self._written = False
+
+    def flush(self):
+        pass
+
+
+def _gzip_decompressobj():
+    # 16 + MAX_WBITS makes zlib expect a gzip header & trailer
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
 class Version(object):
     """Normalizes version strings of different types. Examples
     include 1.2, 1.2.1, 1.2b and 1.1.1b
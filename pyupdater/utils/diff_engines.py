@@ -0,0 +1,1031 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import hashlib
+import io
+import json
+import logging
+import shutil
+import struct
+import tarfile
+import tempfile
+import zipfile
+import zlib
+
+import six
+try:
+    import bsdiff4
+except ImportError:  # pragma: no cover
+    bsdiff4 = None
+try:
+    import lzma
+except ImportError:  # pragma: no cover
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from pyupdater.utils import (_bsdiff4_apply,
+                             _decode_offt,
+                             _encode_offt,
+                             _bsdiff4_patch,
+                             _get_add_bytes,
+                             _read_bsdiff4_patch,
+                             bsdiff4_py)
+from pyupdater.utils.parallel_gzip import BlockCompressor, get_block_info
+
+log = logging.getLogger(__name__)
+
+# name: engine
+_engines = {}
+
+# Bytes of the new file bsdiff4 patches make a second with the bsdiff4
+# c extension & with the pure python patcher. Measured with
+# tests/benchmarks/bench_patch_apply.py & rounded down
+_BSDIFF4_APPLY_SPEED = 100 * 1024 * 1024
+_BSDIFF4_PY_APPLY_SPEED = 15 * 1024 * 1024
+
+# Bytes of the old archive read, copied or inflated at a time when
+# applying archive-delta patches
+_PATCH_CHUNK_SIZE = 1024 * 1024
+
+
+class DiffEngine(object):
+    """Makes & applies patches of one format. To add a format subclass
+    this & pass an instance to :func:`register_engine`. The name is
+    written to the version file with every patch, so clients only use
+    patches they have an engine for.
+    """
+
+    # Patch format written to the version file
+    name = None
+    # Bytes of the new file made a second while applying a patch.
+    # Used to weigh patching against downloading the full archive
+    apply_speed = _BSDIFF4_PY_APPLY_SPEED
+
+    def can_diff(self):
+        "Returns (bool): True if patches can be made here"
+        return True
+
+    def can_patch(self):
+        "Returns (bool): True if patches can be applied here"
+        return True
+
+    def diff(self, source, target):
+        """Makes a patch
+
+        Args:
+
+            source (bytes): Old file
+
+            target (bytes): New file
+
+        Returns:
+
+            (bytes): Patch making target from source
+        """
+        raise NotImplementedError
+
+    def file_diff(self, src_path, dst_path, patch_path):
+        """Makes a patch from files
+
+        Args:
+
+            src_path (str): Old file
+
+            dst_path (str): New file
+
+            patch_path (str): Where to write the patch
+        """
+        with open(src_path, 'rb') as f:
+            source = f.read()
+        with open(dst_path, 'rb') as f:
+            target = f.read()
+        patch = self.diff(source, target)
+        source = target = None
+        with open(patch_path, 'wb') as f:
+            f.write(patch)
+
+    def patch(self, source, patch):
+        """Applies a patch. Raises ValueError if the patch is corrupt
+
+        Args:
+
+            source (bytes): Old file. Can be an mmap
+
+            patch (bytes): Patch made by :meth:`diff`. Can be an mmap
+
+        Returns:
+
+            (bytes): New file
+        """
+        raise NotImplementedError
+
+    def patch_into(self, source, patch, sink):
+        """Applies a patch & writes the new file to sink. Raises
+        ValueError if the patch is corrupt. Engines that can make the
+        new file a piece at a time override this so it's never all in
+        memory
+
+        Args:
+
+            source (bytes): Old file. Can be an mmap
+
+            patch (bytes): Patch made by :meth:`diff`. Can be an mmap
+
+            sink (obj): File like object the new file is written to
+        """
+        sink.write(self.patch(source, patch))
+
+
+class Bsdiff4Engine(DiffEngine):
+    """bsdiff4 patches compressed with bz2. Small patches but slow to
+    make & uses about 17 times the file size of memory while making
+    them. Applied without bsdiff4 installed by a pure python patcher.
+    """
+
+    name = 'bsdiff4'
+
+    @property
+    def apply_speed(self):
+        if bsdiff4 is None:
+            return _BSDIFF4_PY_APPLY_SPEED
+        return _BSDIFF4_APPLY_SPEED
+
+    def can_diff(self):
+        return bsdiff4 is not None
+
+    def diff(self, source, target):
+        return bsdiff4.diff(source, target)
+
+    def file_diff(self, src_path, dst_path, patch_path):
+        bsdiff4.file_diff(src_path, dst_path, patch_path)
+
+    def patch(self, source, patch):
+        if bsdiff4 is None:
+            return bsdiff4_py.patch(source, patch)
+        return bsdiff4.patch(_c_source(source), patch[:])
+
+    def patch_into(self, source, patch, sink):
+        if bsdiff4 is None:
+            _bsdiff4_patch(source, patch, _get_add_bytes(), sink)
+        else:
+            sink.write(self.patch(source, patch))
+
+
+class LzmaBsdiff4Engine(DiffEngine):
+    """bsdiff4 patches compressed with lzma instead of bz2. Big patches
+    come out smaller than bsdiff4 ones. Needs lzma, which is in the standard
+    library on python 3 & in backports.lzma on python 2.
+    """
+
+    name = 'bsdiff4-lzma'
+    magic = b'BSDIFFLZ'
+
+    @property
+    def apply_speed(self):
+        if bsdiff4 is None:
+            return _BSDIFF4_PY_APPLY_SPEED
+        return _BSDIFF4_APPLY_SPEED
+
+    def can_diff(self):
+        return bsdiff4 is not None and lzma is not None
+
+    def can_patch(self):
+        return lzma is not None
+
+    def diff(self, source, target):
+        tcontrol, bdiff, bextra = bsdiff4.core.diff(source, target)
+        bcontrol = b''.join(_encode_offt(x) + _encode_offt(y) +
+                            _encode_offt(z) for x, y, z in tcontrol)
+        bcontrol = self._compress(bcontrol)
+        bdiff = self._compress(bdiff)
+        # Same layout as bsdiff4 patches
+        return b''.join([self.magic, _encode_offt(len(bcontrol)),
+                         _encode_offt(len(bdiff)), _encode_offt(len(target)),
+                         bcontrol, bdiff, self._compress(bextra)])
+
+    @staticmethod
+    def _compress(data):
+        # The .lzma format has a much smaller header than .xz
+        return lzma.compress(data, format=lzma.FORMAT_ALONE)
+
+    def patch(self, source, patch):
+        output = io.BytesIO()
+        self.patch_into(source, patch, output)
+        return output.getvalue()
+
+    def patch_into(self, source, patch, sink):
+        if patch[:8] != self.magic:
+            raise ValueError('incorrect magic bsdiff4-lzma header')
+        try:
+            data = _read_bsdiff4_patch(patch, lzma.decompress)
+        except lzma.LZMAError as err:
+            raise ValueError('corrupt patch ({})'.format(err))
+        if bsdiff4 is None:
+            _bsdiff4_apply(source, _get_add_bytes(), *data, sink=sink)
+            return
+        l_new, bcontrol, bdiff, bextra = data
+        tcontrol = [(_decode_offt(bcontrol[i:i + 8]),
+                     _decode_offt(bcontrol[i + 8:i + 16]),
+                     _decode_offt(bcontrol[i + 16:i + 24]))
+                    for i in range(0, len(bcontrol), 24)]
+        sink.write(bsdiff4.core.patch(_c_source(source), l_new, tcontrol,
+                                      bdiff, bextra))
+
+
+class BlockDeltaEngine(DiffEngine):
+    """rsync style delta. The old file is split into blocks & the new
+    file is made of copies of those blocks plus the bytes not found in
+    them, compressed with zlib. Bigger patches than bsdiff4 but made
+    many times faster with little more memory than both files. Needs
+    no extra modules.
+
+    Runs of equal bytes twice block_size long are always found, at
+    any offset of either file, & most shorter ones are. The new file is
+    looked up every few bytes instead of at every byte, so new data is
+    skipped over quickly.
+
+    Kwargs:
+
+        block_size (int): Shortest match copied from the old file
+    """
+
+    name = 'block-delta'
+    magic = b'PYUBLKD1'
+    apply_speed = 500 * 1024 * 1024
+    # Bytes of a block used to look it up
+    key_size = 32
+
+    def __init__(self, block_size=2048):
+        self.block_size = block_size
+
+    def diff(self, source, target):
+        size = self.block_size
+        key_size = min(self.key_size, size)
+        # The old file is indexed every stride bytes & the new file is
+        # looked up every step bytes. stride is a power of two & step
+        # is odd, so whatever the shift between the files, one of every
+        # stride * step offsets of the new file is looked up at an
+        # indexed offset of the old file
+        stride = 1
+        while stride * 2 <= size // 8:
+            stride *= 2
+        step = max((2 * size - key_size) // stride, 1)
+        if step % 2 == 0:
+            step -= 1
+        # First offset with each key. Matches are grown from the key
+        # & only kept if long enough, so keys only have to be mostly
+        # unique
+        index = {}
+        for k in range(0, len(source) - key_size + 1, stride):
+            index.setdefault(source[k:k + key_size], k)
+
+        ops = []
+        literal = t = 0
+        end = len(target) - key_size
+        while t <= end:
+            k = index.get(target[t:t + key_size])
+            if k is None:
+                t += step
+                continue
+            # Grows the match both ways
+            back = _equal_length(source, k, target, t,
+                                 min(k, t - literal), backward=True)
+            length = _equal_length(source, k, target, t,
+                                   min(len(source) - k, len(target) - t))
+            if back + length < size:
+                t += step
+                continue
+            if t - back > literal:
+                ops.append(self._data_op(target[literal:t - back]))
+            ops.append(struct.pack(str('<cQQ'), b'C', k - back,
+                                   back + length))
+            literal = t + length
+            # Back to looking up offsets that are multiples of step
+            t = -(-literal // step) * step
+        if literal < len(target):
+            ops.append(self._data_op(target[literal:]))
+        return self.magic + struct.pack(str('<Q'), len(target)) + \
+            zlib.compress(b''.join(ops), 9)
+
+    def patch(self, source, patch):
+        output = io.BytesIO()
+        self.patch_into(source, patch, output)
+        return output.getvalue()
+
+    def patch_into(self, source, patch, sink):
+        if patch[:8] != self.magic:
+            raise ValueError('incorrect magic block-delta header')
+        size = struct.unpack(str('<Q'), patch[8:16])[0]
+        try:
+            ops = zlib.decompress(patch[16:])
+        except zlib.error as err:
+            raise ValueError('corrupt patch ({})'.format(err))
+        pos = i = 0
+        try:
+            while i < len(ops):
+                op = ops[i:i + 1]
+                if op == b'C':
+                    offset, length = struct.unpack(str('<QQ'),
+                                                   ops[i + 1:i + 17])
+                    data = source[offset:offset + length]
+                    i += 17
+                elif op == b'D':
+                    length = struct.unpack(str('<Q'), ops[i + 1:i + 9])[0]
+                    data = ops[i + 9:i + 9 + length]
+                    i += 9 + length
+                else:
+                    raise ValueError('corrupt patch (bad op)')
+                if len(data) != length or pos + length > size:
+                    raise ValueError('corrupt patch (overflow)')
+                sink.write(data)
+                pos += length
+        except struct.error:
+            raise ValueError('corrupt patch (cut off)')
+        if pos != size:
+            raise ValueError('corrupt patch (underflow)')
+
+    @staticmethod
+    def _data_op(data):
+        return struct.pack(str('<cQ'), b'D', len(data)) + data
+
+
+class ArchiveDeltaEngine(DiffEngine):
+    """Patches the members of .tar.gz & .zip archives instead of their
+    compressed bytes, where one changed byte reshuffles everything after
+    it. Members the same as in the old archive are copied from it, changed
+    members are diffed with another engine & new members are stored. The
+    patched members are compressed again with the settings found in the
+    new archive, so the patched archive is byte for byte the same & its
+    file_hash verifies.
+
+    The settings are checked by compressing the new archive again while
+    making the patch. Archives that can't be made again the same way,
+    & files that aren't archives, are diffed whole with the other engine.
+    If a client's zlib compresses differently the patched archive fails
+    its hash check & the client downloads the full archive.
+
+    Making a patch holds both archives & their members in memory.
+    Applying one unpacks the members of the old archive to a temp file,
+    so it needs disk space for them but only holds the member being
+    patched in memory. Unchanged members & new data are copied in
+    chunks.
+
+    Kwargs:
+
+        engine (str): Patch format of changed members. Defaults to
+                      bsdiff4 or block-delta if bsdiff4 isn't installed
+    """
+
+    name = 'archive-delta'
+    magic = b'PYUARCD1'
+    # Patched members are compressed again, which is most of the time
+    apply_speed = 3 * 1024 * 1024
+    # Levels tried in order when looking for the one used
+    levels = (9, 6, 1, 2, 3, 4, 5, 7, 8)
+
+    def __init__(self, engine=None):
+        self.engine = engine
+
+    def _get_member_engine(self):
+        if self.engine is not None:
+            return get_engine(self.engine)
+        engine = get_engine('bsdiff4')
+        if engine.can_diff() is False:
+            engine = get_engine('block-delta')
+        return engine
+
+    def diff(self, source, target):
+        engine = self._get_member_engine()
+        container = _get_container(target)
+        patch = None
+        if container is not None and \
+                _get_container(source) == container:
+            writer = _ArchiveWriter(engine)
+            try:
+                if container == 'gzip':
+                    ok = self._diff_gzip(writer, source, target)
+                else:
+                    ok = self._diff_zip(writer, source, target)
+            except ValueError as err:
+                log.debug(err)
+                ok = False
+            if ok is True:
+                patch = writer.get_patch(self.magic, container)
+                # Proves the archive can be made again the same way
+                if self.patch(source, patch) != target:
+                    log.debug('Archive not reproduced. Diffing whole file')
+                    patch = None
+        if patch is None:
+            writer = _ArchiveWriter(engine)
+            writer.diff(0, len(source), source, target)
+            patch = writer.get_patch(self.magic, 'raw')
+        return patch
+
+    def _diff_gzip(self, writer, source, target):
+        gz = _split_gzip(target)
+        if gz is None:
+            return False
+        header, raw, deflated, trailer = gz
+        # Made by ParallelGzipWriter if it has a block size
+        block_size, primed = get_block_info(header) or (0, False)
+        level = _find_deflate_level(raw, deflated, self.levels,
+                                    block_size, primed)
+        if level is None:
+            return False
+        writer.index(*_read_container('gzip', source))
+        writer.literal(header)
+        writer.start(level, block_size, primed)
+        self._add_members(writer, raw, _tar_members(raw))
+        writer.end()
+        writer.literal(trailer)
+        return True
+
+    def _diff_zip(self, writer, source, target):
+        writer.index(*_read_container('zip', source))
+        try:
+            zf = zipfile.ZipFile(io.BytesIO(target))
+            infos = sorted(zf.infolist(), key=lambda i: i.header_offset)
+            pos = 0
+            for info in infos:
+                start = info.header_offset
+                if target[start:start + 4] != b'PK\x03\x04' or start < pos:
+                    return False
+                n, m = struct.unpack(str('<HH'),
+                                     target[start + 26:start + 30])
+                start += 30 + n + m
+                end = start + info.compress_size
+                writer.literal(target[pos:start])
+                data = zf.read(info)
+                compressed = target[start:end]
+                if info.compress_type == zipfile.ZIP_STORED and \
+                        compressed == data:
+                    writer.member(info.filename, data)
+                    pos = end
+                    continue
+                level = None
+                if info.compress_type == zipfile.ZIP_DEFLATED:
+                    level = _find_deflate_level(data, compressed,
+                                                self.levels)
+                if level is None:
+                    writer.literal(compressed)
+                else:
+                    writer.start(level)
+                    writer.member(info.filename, data)
+                    writer.end()
+                pos = end
+        except (zipfile.BadZipfile, RuntimeError, NotImplementedError,
+                zlib.error, struct.error) as err:
+            log.debug('Cannot read zip members: {}'.format(err))
+            return False
+        writer.literal(target[pos:])
+        return True
+
+    @staticmethod
+    def _add_members(writer, data, members):
+        # Members are stored in data at the offsets given. Bytes
+        # between them are tar headers & padding
+        pos = 0
+        for name, offset, size in members:
+            writer.literal(data[pos:offset])
+            writer.member(name, data[offset:offset + size])
+            pos = offset + size
+        writer.literal(data[pos:])
+
+    def patch(self, source, patch):
+        output = io.BytesIO()
+        self.patch_into(source, patch, output)
+        return output.getvalue()
+
+    def patch_into(self, source, patch, sink):
+        if patch[:8] != self.magic:
+            raise ValueError('incorrect magic archive-delta header')
+        try:
+            info_size, ops_size, literal_size = struct.unpack(
+                str('<III'), patch[8:20])
+            pos = 20 + info_size
+            info = json.loads(patch[20:pos].decode('utf-8'))
+            ops = zlib.decompress(patch[pos:pos + ops_size])
+            pos += ops_size
+            literal_pos = pos
+            pos += literal_size
+        except (struct.error, ValueError, zlib.error) as err:
+            raise ValueError('corrupt patch ({})'.format(err))
+        engine = get_engine(info.get('engine'))
+        if engine is None or engine.can_patch() is False:
+            raise ValueError('cannot apply member patches '
+                             '({})'.format(info.get('engine')))
+        if len(ops) % 25 != 0:
+            raise ValueError('corrupt patch (bad ops)')
+        temp, blob, skeleton = self._open_source(info.get('container'),
+                                                 source)
+        try:
+            if info.get('literals') == 'patch':
+                literals = io.BytesIO(engine.patch(
+                    skeleton, patch[literal_pos:literal_pos + literal_size]))
+            else:
+                literals = _ChunkReader(_inflate(patch, literal_pos,
+                                                 literal_pos + literal_size))
+            pos = self._apply_ops(engine, ops, blob, literals, patch, pos,
+                                  sink)
+        except zlib.error as err:
+            raise ValueError('corrupt patch ({})'.format(err))
+        finally:
+            if temp is not None:
+                temp.close()
+        if pos != len(patch):
+            raise ValueError('corrupt patch (cut off)')
+
+    @staticmethod
+    def _open_source(container, source):
+        # Returns (tuple): temp file, uncompressed members of the old
+        # archive joined together & the bytes between members. Members
+        # are unpacked to the temp file & read back when needed. Raw
+        # patches read source itself
+        if container not in ('gzip', 'zip'):
+            return None, source, b''
+        temp = tempfile.TemporaryFile()
+        try:
+            if container == 'gzip':
+                start = _get_gzip_header_size(source)
+                for data in _inflate(source, start, len(source),
+                                     -zlib.MAX_WBITS):
+                    temp.write(data)
+            else:
+                stored = _unpack_zip(source, temp)[1]
+            blob = _FileSlicer(temp)
+            if container == 'gzip':
+                skeleton = _between(blob, [(offset, offset + size)
+                                           for _, offset, size
+                                           in _tar_members(blob)])
+            else:
+                skeleton = _between(source, stored)
+        except zlib.error as err:
+            temp.close()
+            raise ValueError('cannot read gzip file ({})'.format(err))
+        except Exception:
+            temp.close()
+            raise
+        return temp, blob, skeleton
+
+    @staticmethod
+    def _apply_ops(engine, ops, blob, literals, patch, pos, sink):
+        # Writes the new archive to sink. Member patches start at pos
+        # in patch. Returns (int): end of the member patches used
+        stream = None
+        for i in range(0, len(ops), 25):
+            op, a, b, c = struct.unpack(str('<cQQQ'), ops[i:i + 25])
+            if op == b'S':
+                stream = _get_compressor(a, b, c)
+                continue
+            if op == b'E':
+                if stream is None:
+                    raise ValueError('corrupt patch (no stream)')
+                sink.write(stream.flush())
+                stream = None
+                continue
+            if op == b'L':
+                chunks = _read_chunks(literals, a)
+            elif op == b'C':
+                chunks = _read_chunks(_BufferReader(blob, a), b)
+            elif op == b'P':
+                data = b''.join(_read_chunks(_BufferReader(blob, a), b))
+                chunks = [engine.patch(data, patch[pos:pos + c])]
+                pos += c
+            else:
+                raise ValueError('corrupt patch (bad op)')
+            for data in chunks:
+                if stream is not None:
+                    data = stream.compress(data)
+                sink.write(data)
+        if stream is not None:
+            raise ValueError('corrupt patch (cut off)')
+        return pos
+
+
+class _ArchiveWriter(object):
+    # Ops, literal bytes & member patches of an archive-delta patch.
+    # Ops are packed as <cQQQ:
+    #     L length - bytes from literals
+    #     C offset length - bytes of the old members
+    #     P offset length size - old member bytes patched with the
+    #                            next size bytes of member patches
+    #     S level block_size primed - following bytes are deflated
+    #                                 at level, in blocks if block_size
+    #     E - ends deflating
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.ops = []
+        self.literals = []
+        self.patches = []
+        self.blob = b''
+        self.skeleton = b''
+        # name: (offset, size) of old members
+        self.members = {}
+        # sha1 of data: offset of old members
+        self.hashes = {}
+
+    def index(self, blob, members, skeleton):
+        # Old members new ones are looked up in & old bytes between
+        # members literals are diffed with
+        self.blob = blob
+        self.skeleton = skeleton
+        for name, offset, size in members:
+            self.members[name] = (offset, size)
+            digest = hashlib.sha1(blob[offset:offset + size]).digest()
+            self.hashes.setdefault(digest, offset)
+
+    def literal(self, data):
+        if len(data) == 0:
+            return
+        self.literals.append(data)
+        if self.ops and self.ops[-1][0] == b'L':
+            self.ops[-1][1] += len(data)
+        else:
+            self.ops.append([b'L', len(data), 0, 0])
+
+    def start(self, level, block_size=0, primed=False):
+        self.ops.append([b'S', level, block_size, int(primed)])
+
+    def end(self):
+        self.ops.append([b'E', 0, 0, 0])
+
+    def diff(self, offset, size, source, target):
+        self.ops.append([b'P', offset, size, 0])
+        patch = self.engine.diff(source, target)
+        self.ops[-1][3] = len(patch)
+        self.patches.append(patch)
+
+    def member(self, name, data):
+        # Copies, patches or stores a new member
+        offset = self.hashes.get(hashlib.sha1(data).digest())
+        if offset is not None:
+            self.ops.append([b'C', offset, len(data), 0])
+            return
+        if name in self.members and len(data) > 0:
+            offset, size = self.members[name]
+            patch = self.engine.diff(self.blob[offset:offset + size], data)
+            if len(patch) < len(data):
+                self.ops.append([b'P', offset, size, len(patch)])
+                self.patches.append(patch)
+                return
+        self.literal(data)
+
+    def get_patch(self, magic, container):
+        literals = b''.join(self.literals)
+        info = {'container': container, 'engine': self.engine.name,
+                'literals': 'zlib'}
+        compressed = zlib.compress(literals, 9)
+        if self.skeleton:
+            # Headers mostly differ from the old ones by a few bytes
+            patch = self.engine.diff(self.skeleton, literals)
+            if len(patch) < len(compressed):
+                info['literals'] = 'patch'
+                compressed = patch
+        literals = compressed
+        info = json.dumps(info, sort_keys=True).encode('utf-8')
+        ops = zlib.compress(b''.join(struct.pack(str('<cQQQ'), *op)
+                                     for op in self.ops), 9)
+        return b''.join([magic, struct.pack(str('<III'), len(info), len(ops),
+                                            len(literals)),
+                         info, ops, literals] + self.patches)
+
+
+def _c_source(source):
+    # bsdiff4's C extension only takes bytes on python 3, so an
+    # mmap of the old file is read into memory there
+    if six.PY2 or isinstance(source, bytes):
+        return source
+    return source[:]
+
+
+def _get_container(data):
+    # Returns (str): gzip or zip. None for other files
+    if data[:3] == b'\x1f\x8b\x08':
+        return 'gzip'
+    if data[:4] == b'PK\x03\x04':
+        return 'zip'
+    return None
+
+
+def _get_gzip_header_size(data):
+    # Returns (int): size of the header of a gzip file. Raises
+    # ValueError if it can't be read
+    try:
+        flags = bytearray(data[3:4])[0]
+        pos = 10
+        if flags & 4:
+            pos += 2 + struct.unpack(str('<H'), data[pos:pos + 2])[0]
+        for flag in (8, 16):
+            if flags & flag:
+                pos = data.find(b'\x00', pos) + 1
+                if pos == 0:
+                    raise ValueError('cut off gzip header')
+        if flags & 2:
+            pos += 2
+    except (IndexError, struct.error) as err:
+        raise ValueError('cannot read gzip header ({})'.format(err))
+    return pos
+
+
+def _split_gzip(data):
+    # Returns (tuple): header, uncompressed data, deflated data &
+    # trailer of a gzip file with one member. None if it can't be read
+    try:
+        pos = _get_gzip_header_size(data)
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        raw = decompressor.decompress(data[pos:])
+    except (ValueError, zlib.error):
+        return None
+    # Anything past the trailer is another member or junk
+    if len(decompressor.unused_data) != 8:
+        return None
+    return data[:pos], raw, data[pos:-8], data[-8:]
+
+
+def _get_compressor(level, block_size=0, primed=False):
+    # Deflates in one stream or in blocks like ParallelGzipWriter
+    if block_size:
+        return BlockCompressor(level, block_size, primed)
+    return zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+
+def _find_deflate_level(data, deflated, levels, block_size=0, primed=False):
+    # Returns (int): Level deflating data at gives deflated. None if
+    # none do. Output is compared as it's made so most wrong levels
+    # stop after the first chunk.
+    for level in levels:
+        try:
+            compressor = _get_compressor(level, block_size, primed)
+        except ValueError as err:
+            log.debug(err)
+            return None
+        pos = 0
+        chunk = 64 * 1024
+        for i in range(0, len(data), chunk):
+            out = compressor.compress(data[i:i + chunk])
+            if deflated[pos:pos + len(out)] != out:
+                break
+            pos += len(out)
+        else:
+            if deflated[pos:] == compressor.flush():
+                return level
+    return None
+
+
+def _tar_members(data):
+    # Returns (list): name, offset & size of the files in a tar. The
+    # whole file is one member if it isn't a tar
+    members = []
+    try:
+        with tarfile.open(fileobj=_BufferReader(data), mode='r:') as tar:
+            for m in tar:
+                if m.isreg() and not m.issparse():
+                    members.append((m.name, m.offset_data, m.size))
+    except (tarfile.TarError, EOFError) as err:
+        log.debug('Cannot read tar members: {}'.format(err))
+        return [('', 0, len(data))]
+    return members
+
+
+def _read_container(container, data):
+    # Returns (tuple): uncompressed members joined together, list of
+    # name, offset & size of each in them & the bytes between members
+    if container == 'gzip':
+        gz = _split_gzip(data)
+        if gz is None:
+            raise ValueError('cannot read gzip file')
+        blob = gz[1]
+        members = _tar_members(blob)
+        return blob, members, _between(blob, [(offset, offset + size)
+                                              for _, offset, size
+                                              in members])
+    if container == 'zip':
+        return _read_zip(data)
+    return data, [], b''
+
+
+def _read_zip(data):
+    blob = io.BytesIO()
+    members, stored = _unpack_zip(data, blob)
+    return blob.getvalue(), members, _between(data, stored)
+
+
+def _unpack_zip(data, f):
+    # Writes the uncompressed members of a zip, joined together, to f.
+    # Returns (tuple): list of name, offset & size of each in f & list
+    # of start & end of the bytes each was stored in, in data
+    members = []
+    stored = []
+    offset = 0
+    try:
+        zf = zipfile.ZipFile(_BufferReader(data))
+        for info in sorted(zf.infolist(), key=lambda i: i.header_offset):
+            with zf.open(info) as member:
+                shutil.copyfileobj(member, f, _PATCH_CHUNK_SIZE)
+            members.append((info.filename, offset, info.file_size))
+            offset += info.file_size
+            start = info.header_offset
+            n, m = struct.unpack(str('<HH'), data[start + 26:start + 30])
+            start += 30 + n + m
+            stored.append((start, start + info.compress_size))
+    except (zipfile.BadZipfile, RuntimeError, NotImplementedError,
+            zlib.error, struct.error) as err:
+        raise ValueError('cannot read zip members ({})'.format(err))
+    return members, stored
+
+
+def _inflate(data, start, end, wbits=zlib.MAX_WBITS):
+    # Yields data[start:end] inflated, no more than _PATCH_CHUNK_SIZE
+    # bytes at a time whatever the compression ratio. Raises zlib.error
+    decompressor = zlib.decompressobj(wbits)
+    tail = b''
+    while 1:
+        chunk = tail
+        if len(chunk) == 0:
+            chunk = data[start:min(start + _PATCH_CHUNK_SIZE, end)]
+            start += len(chunk)
+        out = decompressor.decompress(chunk, _PATCH_CHUNK_SIZE)
+        tail = decompressor.unconsumed_tail
+        if len(out) > 0:
+            yield out
+        elif len(tail) == len(chunk):
+            # Out of data or past the end of the stream
+            break
+
+
+def _read_chunks(f, length):
+    # Yields the next length bytes of f, a file like object, no more
+    # than _PATCH_CHUNK_SIZE at a time. Raises ValueError if f is
+    # shorter
+    while length > 0:
+        data = f.read(min(length, _PATCH_CHUNK_SIZE))
+        if len(data) == 0:
+            raise ValueError('corrupt patch (overflow)')
+        length -= len(data)
+        yield data
+
+
+class _BufferReader(io.RawIOBase):
+    # Read only file over bytes or a map of a file. Unlike io.BytesIO
+    # the data isn't copied
+
+    def __init__(self, data, offset=0):
+        self._data = data
+        self._pos = offset
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += len(self._data)
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def read(self, size=-1):
+        end = len(self._data)
+        if size is not None and size >= 0:
+            end = min(self._pos + size, end)
+        data = self._data[self._pos:end]
+        self._pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class _FileSlicer(object):
+    # Slices of a file, read from it when taken
+
+    def __init__(self, f):
+        self._f = f
+        f.seek(0, 2)
+        self._size = f.tell()
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self._size)
+        self._f.seek(start)
+        return self._f.read(max(stop - start, 0))
+
+
+class _ChunkReader(object):
+    # File like reads over chunks of bytes
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def read(self, size):
+        parts = [self._buffer]
+        length = len(self._buffer)
+        while length < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        data = b''.join(parts)
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def _between(data, regions):
+    # Returns (bytes): data outside of the sorted (start, end) regions
+    parts = []
+    pos = 0
+    for start, end in regions:
+        parts.append(data[pos:max(start, pos)])
+        pos = max(end, pos)
+    parts.append(data[pos:])
+    return b''.join(parts)
+
+
+def _equal_length(a, i, b, j, limit, backward=False):
+    # Number of equal bytes, at most limit, of a & b going forward
+    # from a[i] & b[j] or backward from the bytes before them. Growing
+    # chunks are compared then the first unequal one is searched, so
+    # long runs are compared in c without copying whole files.
+    def same(start, stop):
+        if backward:
+            return a[i - stop:i - start] == b[j - stop:j - start]
+        return a[i + start:i + stop] == b[j + start:j + stop]
+
+    n = 0
+    step = 64
+    while n < limit:
+        step = min(step, limit - n)
+        if same(n, n + step):
+            n += step
+            step = min(step * 2, 1024 * 1024)
+            continue
+        low, high = 0, step - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            if same(n, n + mid):
+                low = mid
+            else:
+                high = mid - 1
+        return n + low
+    return n
+
+
+def register_engine(engine):
+    """Adds a diff engine. Replaces an engine with the same name
+
+    Args:
+
+        engine (obj): :class:`DiffEngine` instance
+    """
+    _engines[engine.name] = engine
+
+
+def get_engine(name):
+    """Returns (obj): Diff engine of the patch format. None if unknown
+
+    Args:
+
+        name (str): Patch format
+    """
+    return _engines.get(name)
+
+
+def get_patch_formats():
+    "Returns (list): Patch formats that can be applied here"
+    return sorted(name for name, engine in _engines.items()
+                  if engine.can_patch())
+
+
+register_engine(Bsdiff4Engine())
+register_engine(LzmaBsdiff4Engine())
+register_engine(BlockDeltaEngine())
+register_engine(ArchiveDeltaEngine())
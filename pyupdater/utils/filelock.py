@@ -0,0 +1,120 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import errno
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+    import msvcrt
+
+from pyupdater.utils.exceptions import UtilsError
+
+log = logging.getLogger(__name__)
+
+
+class FileLock(object):
+    """Exclusive lock shared between processes through a lock file.
+    Also safe to share between threads of one process.
+
+        with FileLock('/path/to/file.lock'):
+            # Only one process at a time gets here
+
+    Args:
+
+        path (str): Path to lock file. Created if missing
+
+    Kwargs:
+
+        timeout (float): Seconds to wait for the lock. None waits forever
+    """
+
+    # Seconds between attempts to get the lock
+    poll_interval = 0.05
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self._fd = None
+        self._thread_lock = threading.Lock()
+
+    def acquire(self):
+        "Blocks until the lock is held. Raises UtilsError on timeout"
+        start = time.time()
+        if not self._thread_lock.acquire(self.timeout is None):
+            while not self._thread_lock.acquire(False):
+                if time.time() - start > self.timeout:
+                    raise UtilsError('Timed out waiting for lock: '
+                                     '{}'.format(self.path))
+                time.sleep(self.poll_interval)
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            while not _try_lock(fd):
+                if self.timeout is not None and \
+                        time.time() - start > self.timeout:
+                    os.close(fd)
+                    raise UtilsError('Timed out waiting for lock: '
+                                     '{}'.format(self.path))
+                time.sleep(self.poll_interval)
+        except Exception:
+            self._thread_lock.release()
+            raise
+        self._fd = fd
+
+    def release(self):
+        "Releases the lock"
+        fd, self._fd = self._fd, None
+        try:
+            _unlock(fd)
+        finally:
+            os.close(fd)
+            self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _try_lock(fd):
+    # Returns True if the lock was taken
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:  # pragma: no cover
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+    except (IOError, OSError) as err:
+        if err.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK,
+                         errno.EDEADLK):
+            return False
+        raise
+    return True
+
+
+def _unlock(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:  # pragma: no cover
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
@@ -18,6 +18,7 @@ from __future__ import unicode_literals
 import logging
 import os
 
+from pyupdater import settings
 from pyupdater.utils import (parse_platform,
                              Version,
                              )
@@ -38,6 +39,11 @@ class Patch(object):
         self.dst_path = patch_info.get('dst')
         self.patch_name = patch_info.get('patch_name')
         self.dst_filename = patch_info.get('package')
+        # Version patched from. Only set on skip-ahead patches
+        self.base_version = patch_info.get('base_version')
+        # Name of the diff engine making the patch
+        self.patch_format = patch_info.get('patch_format',
+                                           settings.PATCH_FORMAT)
         self.ready = self._check_attrs()
 
     def _check_attrs(self):
@@ -70,6 +76,7 @@ class Package(object):
         self.version = None
         self.filename = filename
         self.file_hash = None
+        self.file_size = None
         self.platform = None
         self.info = dict(status=False, reason='')
         self.patch_info = {}
@@ -0,0 +1,321 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import collections
+import gzip
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import struct
+import sys
+import time
+import zlib
+
+from pyupdater import settings
+
+# Bytes of the block before a block it's primed with. Size of the
+# deflate window
+DICTIONARY_SIZE = 32 * 1024
+
+# Gzip extra field id & layout of the block size & if blocks are primed
+EXTRA_ID = b'PB'
+EXTRA_FORMAT = str('<IB')
+
+# zlib only takes a dictionary to compress with on python 3.3+
+CAN_PRIME = sys.version_info >= (3, 3)
+
+
+def open_gzip_writer(fileobj, compress_level=settings.ARCHIVE_COMPRESS_LEVEL,
+                     workers=None, mtime=None):
+    """Returns a gzip file writer. A :class:`ParallelGzipWriter` when
+    more than one thread compresses. With one the gzip module is used,
+    since blocks compressed one after the other are slower than one
+    deflate stream & make a slightly bigger file. The file object
+    passed in isn't closed.
+
+    Args:
+
+        fileobj (obj): File object the gzip file is written to
+
+    Kwargs:
+
+        compress_level (int): zlib compression level
+
+        workers (int): Number of threads compressing. Defaults to
+                       settings.ARCHIVE_WORKERS or one per cpu
+
+        mtime (int): Time in the gzip header. Defaults to now
+
+    Returns:
+
+        (obj): File like object
+    """
+    if workers is None:
+        workers = settings.ARCHIVE_WORKERS or cpu_count()
+    if workers > 1:
+        return ParallelGzipWriter(fileobj, compress_level, workers,
+                                  mtime=mtime)
+    # No file name in the header, same as ParallelGzipWriter
+    return gzip.GzipFile(filename='', mode='wb',
+                         compresslevel=compress_level, fileobj=fileobj,
+                         mtime=mtime)
+
+
+class ParallelGzipWriter(object):
+    """Gzip file writer that compresses blocks of the data on many
+    threads at once, like pigz. zlib lets go of the GIL while it
+    compresses so blocks really are compressed at the same time.
+
+    Each block is deflated on its own, primed with the end of the block
+    before it so the archive is only slightly bigger than one deflated
+    in one go, & ends on a byte boundary so the blocks join into one
+    standard deflate stream. Any gzip reader, tarfile included, can
+    read it. The output doesn't depend on the number of workers.
+
+    Block size & if blocks are primed are kept in the extra field of
+    the gzip header, so the archive-delta patch format can make the
+    same archive again. The file object passed in isn't closed.
+
+        with open('app.tar.gz', 'wb') as f:
+            with ParallelGzipWriter(f) as gz:
+                with tarfile.open(fileobj=gz, mode='w') as tar:
+                    tar.add('app')
+
+    Args:
+
+        fileobj (obj): File object the gzip file is written to
+
+    Kwargs:
+
+        compress_level (int): zlib compression level
+
+        workers (int): Number of threads compressing. Defaults to
+                       settings.ARCHIVE_WORKERS or one per cpu
+
+        block_size (int): Bytes of data compressed as one block
+
+        mtime (int): Time in the gzip header. Defaults to now
+    """
+
+    def __init__(self, fileobj, compress_level=settings.ARCHIVE_COMPRESS_LEVEL,
+                 workers=None, block_size=settings.ARCHIVE_BLOCK_SIZE,
+                 mtime=None):
+        if workers is None:
+            workers = settings.ARCHIVE_WORKERS or cpu_count()
+        if mtime is None:
+            mtime = int(time.time())
+        self.fileobj = fileobj
+        self.compress_level = compress_level
+        self.block_size = block_size
+        self.workers = max(1, workers)
+        self._pool = ThreadPool(self.workers)
+        # Blocks being compressed, oldest first
+        self._pending = collections.deque()
+        self._buffer = []
+        self._buffered = 0
+        self._dictionary = b''
+        self._crc = 0
+        self._size = 0
+        self.closed = False
+        self._write_header(mtime)
+
+    def _write_header(self, mtime):
+        if self.compress_level == 9:
+            xfl = 2
+        elif self.compress_level == 1:
+            xfl = 4
+        else:
+            xfl = 0
+        extra = EXTRA_ID + struct.pack(str('<H'),
+                                       struct.calcsize(EXTRA_FORMAT))
+        extra += struct.pack(EXTRA_FORMAT, self.block_size, CAN_PRIME)
+        # FEXTRA flag & unknown os, same os byte as the gzip module
+        self.fileobj.write(b'\x1f\x8b\x08\x04' +
+                           struct.pack(str('<IBBH'), mtime, xfl, 255,
+                                       len(extra)) + extra)
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed file')
+        if not data:
+            return
+        data = bytes(data)
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            data = b''.join(self._buffer)
+            end = len(data) - len(data) % self.block_size
+            for i in range(0, end, self.block_size):
+                self._compress(data[i:i + self.block_size], False)
+            self._buffer = [data[end:]]
+            self._buffered = len(data) - end
+
+    def tell(self):
+        "Returns (int): Bytes of data written so far"
+        return self._size
+
+    def _compress(self, block, last):
+        dictionary = self._dictionary
+        self._dictionary = block[-DICTIONARY_SIZE:]
+        self._pending.append(self._pool.apply_async(
+            compress_block, (block, self.compress_level, dictionary, last)))
+        # Keeps a few blocks per worker in memory
+        while len(self._pending) > self.workers * 2:
+            self.fileobj.write(self._pending.popleft().get())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._compress(b''.join(self._buffer), True)
+            self._buffer = []
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().get())
+            self.fileobj.write(struct.pack(str('<II'),
+                                           self._crc & 0xffffffff,
+                                           self._size & 0xffffffff))
+        finally:
+            self._pool.close()
+            self._pool.join()
+
+    def flush(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BlockCompressor(object):
+    """Deflates data in blocks the same way as
+    :class:`ParallelGzipWriter`, on one thread. Used to make archives
+    again when patching. Same methods as zlib compress objects.
+
+    Args:
+
+        compress_level (int): zlib compression level
+
+        block_size (int): Bytes of data compressed as one block
+
+        primed (bool): Prime blocks with the block before them
+    """
+
+    def __init__(self, compress_level, block_size, primed=CAN_PRIME):
+        if primed and not CAN_PRIME:
+            raise ValueError('cannot prime blocks on this python')
+        self.compress_level = compress_level
+        self.block_size = block_size
+        self.primed = primed
+        self._buffer = []
+        self._buffered = 0
+        self._dictionary = b''
+
+    def compress(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        # Keeps the last full block until it's known if it's the last
+        if self._buffered <= self.block_size:
+            return b''
+        data = b''.join(self._buffer)
+        output = []
+        pos = 0
+        while len(data) - pos > self.block_size:
+            output.append(self._block(data[pos:pos + self.block_size],
+                                      False))
+            pos += self.block_size
+        self._buffer = [data[pos:]]
+        self._buffered = len(data) - pos
+        return b''.join(output)
+
+    def flush(self):
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        # Full blocks are never the last one
+        if len(data) == self.block_size:
+            return self._block(data, False) + self._block(b'', True)
+        return self._block(data, True)
+
+    def _block(self, block, last):
+        dictionary = self._dictionary if self.primed else b''
+        self._dictionary = block[-DICTIONARY_SIZE:]
+        return compress_block(block, self.compress_level, dictionary, last)
+
+
+def compress_block(data, compress_level, dictionary=b'', last=False):
+    """Deflates one block
+
+    Args:
+
+        data (bytes): Data of the block
+
+        compress_level (int): zlib compression level
+
+    Kwargs:
+
+        dictionary (bytes): Data before the block to prime with.
+                            Ignored on python 2
+
+        last (bool): Ends the deflate stream
+
+    Returns:
+
+        (bytes): Raw deflate data. Ends on a byte boundary
+    """
+    if dictionary and CAN_PRIME:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS, 8,
+                                      zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS)
+    flush = zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    return compressor.compress(data) + compressor.flush(flush)
+
+
+def get_block_info(header):
+    """Reads the block size of a gzip file made by
+    :class:`ParallelGzipWriter`
+
+    Args:
+
+        header (bytes): Gzip header
+
+    Returns:
+
+        (tuple): Block size & if blocks are primed. None if the
+                 header isn't from a ParallelGzipWriter
+    """
+    if len(header) < 12 or not bytearray(header[3:4])[0] & 4:
+        return None
+    size = struct.unpack(str('<H'), header[10:12])[0]
+    extra = header[12:12 + size]
+    # Extra field is a list of id, length & data
+    pos = 0
+    while pos + 4 <= len(extra):
+        length = struct.unpack(str('<H'), extra[pos + 2:pos + 4])[0]
+        data = extra[pos + 4:pos + 4 + length]
+        if extra[pos:pos + 2] == EXTRA_ID and \
+                len(data) == struct.calcsize(EXTRA_FORMAT):
+            block_size, primed = struct.unpack(EXTRA_FORMAT, data)
+            return block_size, bool(primed)
+        pos += 4 + length
+    return None
@@ -0,0 +1,193 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from pyupdater import settings
+
+log = logging.getLogger(__name__)
+
+
+class ProgressDispatcher(object):
+    """Turns a stream of progress updates into status dicts sent at
+    most rate times a second.  Updates in between are dropped, only the
+    latest counts.  The final status is always sent.
+
+    Status dicts have the following keys
+
+        total (int): Total units. None if not known
+
+        <done_key> (int): Units done so far
+
+        status (str): downloading, finished etc.
+
+        <rate_key> (float): Units per second
+
+        eta (float): Seconds left. None if not known
+
+        percent_complete (str): Kept for older callbacks
+
+        time (str): eta as mm:ss. Kept for older callbacks
+
+    Args:
+
+        send (func): Called with each status dict
+
+    Kwargs:
+
+        rate (float): Max status dicts sent per second. 0 sends all
+
+        done_key (str): Key for units done
+
+        rate_key (str): Key for units per second
+    """
+
+    def __init__(self, send, rate=settings.PROGRESS_HOOK_RATE,
+                 done_key='downloaded', rate_key='bytes_per_sec'):
+        self.send = send
+        self.interval = 1.0 / rate if rate else 0
+        self.done_key = done_key
+        self.rate_key = rate_key
+        self.start()
+
+    def start(self, total=None, offset=0):
+        """Starts timing a new transfer
+
+        Kwargs:
+
+            total (int): Total units. None if not known
+
+            offset (int): Units already done before this transfer.
+                          Not counted towards the speed
+        """
+        self.total = total
+        self.offset = offset
+        self.done = offset
+        self.started = time.time()
+        self._next = 0
+
+    def update(self, done, status='downloading'):
+        """Sends a status dict if enough time has passed since the last one
+
+        Args:
+
+            done (int): Units done so far
+
+        Kwargs:
+
+            status (str): Current status
+        """
+        self.done = done
+        now = time.time()
+        if now < self._next:
+            return
+        self._next = now + self.interval
+        self.send(self.status(done, status, now))
+
+    def finish(self, done=None, status='finished'):
+        """Always sends a status dict
+
+        Kwargs:
+
+            done (int): Units done. Defaults to the last update
+
+            status (str): Final status
+        """
+        if done is None:
+            done = self.done
+        self.done = done
+        self._next = 0
+        self.send(self.status(done, status))
+
+    def status(self, done, status, now=None):
+        """Returns status dict
+
+        Args:
+
+            done (int): Units done so far
+
+            status (str): Current status
+
+        Kwargs:
+
+            now (float): Current time
+
+        Returns:
+
+            (dict): Status
+        """
+        if now is None:
+            now = time.time()
+        elapsed = now - self.started
+        per_sec = 0.0
+        if elapsed > 0.001:
+            per_sec = (done - self.offset) / elapsed
+        eta = None
+        if status == 'finished':
+            eta = 0.0
+        elif self.total is not None and per_sec > 0:
+            eta = max(self.total - done, 0) / per_sec
+        percent = '--'
+        if self.total:
+            percent = '%.1f' % (float(done) / self.total * 100)
+        return {'total': self.total,
+                self.done_key: done,
+                'status': status,
+                self.rate_key: per_sec,
+                'eta': eta,
+                'percent_complete': percent,
+                'time': format_eta(eta)}
+
+
+def call_progress_hooks(hooks, status):
+    """Calls every hook with status. Errors in hooks are logged
+    & otherwise ignored
+
+    Args:
+
+        hooks (list): Callables
+
+        status (dict): Status passed to each hook
+    """
+    log.debug(status)
+    for ph in hooks:
+        try:
+            ph(status)
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.error('Exception in callback: '
+                      '{}'.format(getattr(ph, '__name__', repr(ph))))
+
+
+def format_eta(eta):
+    """Returns eta as mm:ss
+
+    Args:
+
+        eta (float): Seconds left. None if not known
+
+    Returns:
+
+        (str): mm:ss or --:-- if not known or over 99 minutes
+    """
+    if eta is None:
+        return '--:--'
+    (eta_mins, eta_secs) = divmod(int(eta), 60)
+    if eta_mins > 99:
+        return '--:--'
+    return '%02d:%02d' % (eta_mins, eta_secs)
@@ -191,7 +191,7 @@ def pkg(args):
 
     if args.process is True:
         log.info('Processing packages...')
-        pyu.process_packages()
+        pyu.process_packages(args.skip_ahead)
         log.info('Processing packages complete')
     if args.sign is True:
         log.info('Signing packages...')
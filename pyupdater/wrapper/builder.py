@@ -255,7 +255,10 @@ class Builder(object):
             log.debug('Version: {}'.format(version))
 
             # Time for some archive creation!
-            file_name = make_archive(name, version, app_name)
+            file_name = make_archive(name, version, app_name,
+                                     reproducible=args.reproducible,
+                                     compress_level=args.compress_level,
+                                     workers=args.compress_workers)
             log.debug('Archive name: {}'.format(file_name))
             if args.keep is False:
                 if os.path.exists(temp_name):
@@ -87,6 +87,19 @@ def add_build_parser(subparsers):
                                          'or spec file',
                                          usage='%(prog)s <script> [opts]')
     _build_make_spec_commom(build_parser)
+    build_parser.add_argument('--reproducible', action='store_true',
+                              help='Make the same archive every time the '
+                              'same files are built. Smaller patches '
+                              'between builds')
+    build_parser.add_argument('--compress-level', type=int,
+                              dest='compress_level',
+                              help='zlib compression level of the archive. '
+                              'Default 9')
+    build_parser.add_argument('--compress-workers', type=int,
+                              dest='compress_workers',
+                              help='Number of threads compressing the '
+                              'archive. 1 uses the gzip module. Default '
+                              'one per cpu')
 
 
 def add_make_spec_parser(subparsers):
@@ -144,6 +157,11 @@ def add_package_parser(subparsers):
                                 help='Adds update metadata to version file',
                                 action='store_true', dest='process')
 
+    package_parser.add_argument('--skip-ahead', help='Also make direct '
+                                'patches from this many versions before '
+                                'the previous one. Used with --process',
+                                type=int, dest='skip_ahead')
+
     package_parser.add_argument('-S', '--sign', help='Sign version file',
                                 action='store_true', dest='sign')
 
@@ -0,0 +1,135 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+"""Compares patches between consecutive builds archived the default
+way & with make_reproducible_tar_gz. Every build writes all its files
+again, so times change even for files that didn't. Reports as json if
+rebuilding the same files gives the same archive & the patch size of
+each engine between builds.
+
+Defaults to building the pyupdater package.
+
+    $ python tests/benchmarks/bench_archive_builds.py
+    $ python tests/benchmarks/bench_archive_builds.py --app-dir dist/app \\
+          --changes 20
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+import pyupdater
+from pyupdater.utils import make_reproducible_tar_gz
+from pyupdater.utils.diff_engines import get_engine
+
+ENGINES = ['bsdiff4', 'block-delta', 'archive-delta']
+
+
+def build(app_dir, build_dir, changed):
+    # Copies app_dir like a new build. Files in changed get new bytes
+    if os.path.exists(build_dir):
+        shutil.rmtree(build_dir)
+    shutil.copytree(app_dir, build_dir,
+                    ignore=shutil.ignore_patterns('*.pyc', '__pycache__'))
+    files = []
+    for root, _, filenames in os.walk(build_dir):
+        files += [os.path.join(root, f) for f in filenames]
+    for path in sorted(files):
+        if os.path.relpath(path, build_dir) in changed:
+            with open(path, 'ab') as f:
+                f.write(b'\n# Changed in the new build\n')
+        # Written by this build
+        os.utime(path, None)
+    return sorted(os.path.relpath(p, build_dir) for p in files)
+
+
+def archive(mode, build_dir, path):
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(build_dir))
+    try:
+        name = os.path.basename(build_dir)
+        if mode == 'reproducible':
+            make_reproducible_tar_gz(path, name)
+        else:
+            # Same as make_archive without reproducible
+            with tarfile.open(path, 'w:gz') as tar:
+                tar.add(name)
+    finally:
+        os.chdir(cwd)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def run(mode, app_dir, work_dir, changes, engines):
+    build_dir = os.path.join(work_dir, 'app')
+    files = build(app_dir, build_dir, [])
+    first = archive(mode, build_dir, os.path.join(work_dir, 'first'))
+    # Build times differ by at least a second
+    time.sleep(1.1)
+    build(app_dir, build_dir, [])
+    same = archive(mode, build_dir, os.path.join(work_dir, 'same'))
+    step = max(len(files) // max(changes, 1), 1)
+    build(app_dir, build_dir, files[::step][:changes])
+    changed = archive(mode, build_dir, os.path.join(work_dir, 'changed'))
+    result = {'mode': mode,
+              'archive_size': len(first),
+              'rebuild_identical': (hashlib.sha256(first).digest() ==
+                                    hashlib.sha256(same).digest())}
+    for name in engines:
+        engine = get_engine(name)
+        if engine is None or not engine.can_diff():
+            continue
+        result[name + '_same_patch_size'] = len(engine.diff(first, same))
+        result[name + '_patch_size'] = len(engine.diff(first, changed))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--app-dir',
+                        default=os.path.dirname(pyupdater.__file__),
+                        help='Directory to build')
+    parser.add_argument('--changes', type=int, default=5,
+                        help='Files changed in the next build')
+    parser.add_argument('--engines', nargs='+', default=ENGINES)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        results = [run(mode, args.app_dir, work_dir, args.changes,
+                       args.engines)
+                   for mode in ['default', 'reproducible']]
+        for result in results:
+            print(json.dumps(result))
+        reduction = {}
+        for name in args.engines:
+            key = name + '_patch_size'
+            if key in results[0]:
+                reduction[name] = round(
+                    1 - float(results[1][key]) / results[0][key], 4)
+        print(json.dumps({'patch_size_reduction': reduction}))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
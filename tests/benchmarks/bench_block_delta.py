@@ -0,0 +1,80 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+"""Times making block-delta patches of releases that are mostly new
+data, the slowest case for finding matches. Reports diff time & patch
+size as json. The time of compressing the new data, which any patch
+has to carry, is reported on its own.
+
+    $ python tests/benchmarks/bench_block_delta.py --size 64 --new 0.9
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os
+import time
+import zlib
+
+from helpers import mutate
+
+from pyupdater.utils.diff_engines import get_engine
+
+MB = 1024 * 1024
+
+
+def make_release(size, new):
+    # Old file & a new one with new share of it new data. The rest is
+    # moved around old data
+    source = os.urandom(size)
+    kept = int(size * (1 - new))
+    half = kept // 2
+    target = os.urandom(size - kept)
+    target = source[-half:] + target[:len(target) // 2] + \
+        mutate(source[:kept - half]) + target[len(target) // 2:]
+    return source, target
+
+
+def run(size, new):
+    source, target = make_release(size, new)
+    engine = get_engine('block-delta')
+    start = time.time()
+    patch = engine.diff(source, target)
+    diff_time = time.time() - start
+    start = time.time()
+    zlib.compress(target[:int(size * new)], 9)
+    compress_time = time.time() - start
+    return {'size': size, 'new': new,
+            'diff_time': round(diff_time, 4),
+            'compress_time': round(compress_time, 4),
+            'mb_per_sec': round(len(target) / MB / diff_time, 1),
+            'patch_size': len(patch),
+            'identical': engine.patch(source, patch) == target}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=float, nargs='+', default=[8, 32],
+                        help='Release sizes in MB')
+    parser.add_argument('--new', type=float, default=0.9,
+                        help='Share of the new release that is new data')
+    args = parser.parse_args()
+    for size in args.size:
+        print(json.dumps(run(int(size * MB), args.new)))
+
+
+if __name__ == '__main__':
+    main()
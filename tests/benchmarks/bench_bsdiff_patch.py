@@ -0,0 +1,143 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+"""Compares applying a patch with the bsdiff4 c extension, the old
+pure python patcher adding one byte at a time & the pure python
+patcher adding whole blocks, with big ints & with numpy if installed.
+Reports wall & cpu time & checks every output matches bsdiff4.
+
+The old patcher runs at a few MB a second, so skip it for big sizes.
+
+    $ python tests/benchmarks/bench_bsdiff_patch.py --size 16
+    $ python tests/benchmarks/bench_bsdiff_patch.py --size 128 --skip-old
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import bz2
+import io
+import json
+import os
+import sys
+import time
+
+import bsdiff4
+import six
+
+from helpers import mutate
+
+from pyupdater.utils import (_add_bytes_int,
+                             _add_bytes_numpy,
+                             _bsdiff4_patch,
+                             _decode_offt,
+                             _get_add_bytes)
+
+MB = 1024 * 1024
+
+
+def _old_patch(source, patch):
+    # Patcher before adding whole blocks
+    l_bcontrol = _decode_offt(patch[8:16])
+    l_bdiff = _decode_offt(patch[16:24])
+    e_bcontrol = 32 + l_bcontrol
+    e_bdiff = e_bcontrol + l_bdiff
+    bcontrol = bz2.decompress(patch[32:e_bcontrol])
+    bdiff = bz2.decompress(patch[e_bcontrol:e_bdiff])
+    bextra = bz2.decompress(patch[e_bdiff:])
+    tcontrol = []
+    for i in six.moves.range(0, len(bcontrol), 24):
+        tcontrol.append((
+            _decode_offt(bcontrol[i:i+8]),
+            _decode_offt(bcontrol[i+8:i+16]),
+            _decode_offt(bcontrol[i+16:i+24]),
+        ))
+    pos = 0
+    result = io.BytesIO()
+    bdiff = io.BytesIO(bdiff)
+    bextra = io.BytesIO(bextra)
+    for (x, y, z) in tcontrol:
+        diff_data = bdiff.read(x)
+        orig_data = source[pos:pos + x]
+        pos += x
+        if sys.version_info[0] < 3:
+            for i in six.moves.range(len(diff_data)):
+                result.write(chr((ord(diff_data[i]) +
+                             ord(orig_data[i])) % 256))
+        else:
+            for i in six.moves.range(len(diff_data)):
+                result.write(bytes([(diff_data[i] + orig_data[i]) % 256]))
+        result.write(bextra.read(y))
+        pos += z
+    return result.getvalue()
+
+
+def make_release(size, changes):
+    # Source, patch & patched bytes of a fake release
+    source = os.urandom(size)
+    target = mutate(source, changes)
+    # New code in the middle gives the patch extra bytes
+    middle = size // 2
+    target = target[:middle] + os.urandom(size // 100) + target[middle:]
+    return source, bsdiff4.diff(source, target), target
+
+
+def run(name, func, source, patch, expected):
+    start_cpu = sum(os.times()[:2])
+    start = time.time()
+    output = func(source, patch)
+    wall = time.time() - start
+    cpu = sum(os.times()[:2]) - start_cpu
+    rate = None
+    if wall > 0:
+        rate = round(len(expected) / MB / wall, 2)
+    return {'implementation': name,
+            'wall_time': round(wall, 4),
+            'cpu_time': round(cpu, 4),
+            'mb_per_sec': rate,
+            'identical': output == expected}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=float, default=4,
+                        help='Source size in MB')
+    parser.add_argument('--changes', type=int, default=1000,
+                        help='Bytes changed in the new release')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--skip-old', action='store_true',
+                        help="Don't run the byte at a time patcher")
+    args = parser.parse_args()
+
+    implementations = [('bsdiff4', bsdiff4.patch)]
+    if not args.skip_old:
+        implementations.append(('old_python', _old_patch))
+    implementations.append(('python_int', lambda s, p: _bsdiff4_patch(
+        s, p, _add_bytes_int)))
+    if _get_add_bytes() is _add_bytes_numpy:
+        implementations.append(('python_numpy', lambda s, p: _bsdiff4_patch(
+            s, p, _add_bytes_numpy)))
+
+    source, patch, target = make_release(int(args.size * MB), args.changes)
+    print(json.dumps({'source_size': len(source),
+                      'patch_size': len(patch),
+                      'numpy': _get_add_bytes() is _add_bytes_numpy}))
+    for _ in range(args.rounds):
+        for name, func in implementations:
+            print(json.dumps(run(name, func, source, patch, target)))
+
+
+if __name__ == '__main__':
+    main()
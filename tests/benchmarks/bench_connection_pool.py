@@ -0,0 +1,74 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+"""Compares downloading a chain of patches with a connection pool per
+patch against one pool shared by all patches.  New connections to the
+local server are delayed to stand in for tls handshakes.
+
+    $ python tests/benchmarks/bench_connection_pool.py --patches 10
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import hashlib
+import json
+import os
+import time
+
+from helpers import BenchServer, write_file
+
+from pyupdater.client.downloader import FileDownloader, get_http_pool
+
+
+def run(server, patches, shared):
+    server.reset_stats()
+    http_pool = get_http_pool(verify=False) if shared else None
+    start = time.time()
+    for name, file_hash in patches:
+        fd = FileDownloader(name, server.url, file_hash, verify=False,
+                            http_pool=http_pool)
+        assert fd.download_verify_return() is not None
+    return {'mode': 'shared pool' if shared else 'pool per patch',
+            'patches': len(patches),
+            'handshakes': server.connections,
+            'requests': server.requests,
+            'wall_time': round(time.time() - start, 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--patches', type=int, default=10)
+    parser.add_argument('--patch-size', type=int, default=64 * 1024)
+    parser.add_argument('--handshake-delay', type=float, default=0.05,
+                        help='Seconds added to every new connection')
+    args = parser.parse_args()
+
+    server = BenchServer(handshake_delay=args.handshake_delay).start()
+    patches = []
+    for i in range(args.patches):
+        data = os.urandom(args.patch_size)
+        name = 'app-mac-patch-{}'.format(100 + i)
+        write_file(server.root, name, data)
+        patches.append((name, hashlib.sha256(data).hexdigest()))
+    try:
+        for shared in [False, True]:
+            print(json.dumps(run(server, patches, shared)))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
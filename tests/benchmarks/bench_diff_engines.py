@@ -0,0 +1,164 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+"""Compares the diff engines on two releases of an app. Reports patch
+size & time & peak rss of making & of applying the patch as json.
+Patches are made & applied in a new process each so peak rss is only
+the engine's. Patches are applied like the patcher does, with the old
+archive & patch mapped & the new archive written to a file.
+
+Pass two real update archives, or a directory to build them from. The
+new release edits a few files & adds one. Defaults to the pyupdater
+package.
+
+    $ python tests/benchmarks/bench_diff_engines.py --old app-1.0.zip \\
+          --new app-1.1.zip
+    $ python tests/benchmarks/bench_diff_engines.py --app-dir dist/app \\
+          --archive-format gztar
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import filecmp
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import pyupdater
+from pyupdater.client.patcher import _map_file
+from pyupdater.utils.diff_engines import get_engine
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+ENGINES = ['bsdiff4', 'bsdiff4-lzma', 'block-delta', 'archive-delta']
+
+
+def make_releases(app_dir, work_dir, archive_format, changes):
+    # Archives of app_dir & of a copy with a few files changed
+    old_dir = os.path.join(work_dir, 'old', 'app')
+    new_dir = os.path.join(work_dir, 'new', 'app')
+    ignore = shutil.ignore_patterns('*.pyc', '__pycache__')
+    shutil.copytree(app_dir, old_dir, ignore=ignore)
+    shutil.copytree(app_dir, new_dir, ignore=ignore)
+    files = []
+    for root, _, filenames in os.walk(new_dir):
+        files += [os.path.join(root, f) for f in filenames]
+    files.sort()
+    step = max(len(files) // max(changes, 1), 1)
+    for path in files[::step][:changes]:
+        with open(path, 'ab') as f:
+            f.write(b'\n# Changed in the new release\n')
+    with open(os.path.join(new_dir, 'new_module.py'), 'wb') as f:
+        f.write(b'VALUE = 1\n' * 100)
+    old = shutil.make_archive(os.path.join(work_dir, 'app-old'),
+                              archive_format, os.path.dirname(old_dir))
+    new = shutil.make_archive(os.path.join(work_dir, 'app-new'),
+                              archive_format, os.path.dirname(new_dir))
+    return old, new
+
+
+def _peak_rss():
+    if resource is None:  # pragma: no cover
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on linux, bytes on mac
+    if not os.uname()[0] == 'Darwin':
+        peak *= 1024
+    return peak
+
+
+def _make_patch(name, old, new, patch_path):
+    # Runs in its own process
+    start = time.time()
+    get_engine(name).file_diff(old, new, patch_path)
+    return time.time() - start, _peak_rss()
+
+
+def _apply_patch(name, old, patch_path, output_path):
+    # Runs in its own process
+    start = time.time()
+    with _map_file(old) as source, _map_file(patch_path) as patch, \
+            open(output_path, 'wb') as f:
+        get_engine(name).patch_into(source, patch, f)
+    return time.time() - start, _peak_rss()
+
+
+def _in_process(func, args):
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run(name, old, new, work_dir):
+    engine = get_engine(name)
+    result = {'engine': name}
+    if engine is None or not engine.can_diff():
+        result['skipped'] = 'cannot make patches here'
+        return result
+    patch_path = os.path.join(work_dir, 'patch-' + name)
+    output_path = os.path.join(work_dir, 'output-' + name)
+    diff_time, diff_rss = _in_process(_make_patch,
+                                      (name, old, new, patch_path))
+    apply_time, apply_rss = _in_process(_apply_patch, (name, old, patch_path,
+                                                       output_path))
+    result.update({'patch_size': os.path.getsize(patch_path),
+                   'diff_time': round(diff_time, 4),
+                   'diff_peak_rss': diff_rss,
+                   'apply_time': round(apply_time, 4),
+                   'apply_peak_rss': apply_rss,
+                   'identical': filecmp.cmp(output_path, new, shallow=False)})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--old', help='Archive of the old release')
+    parser.add_argument('--new', help='Archive of the new release')
+    parser.add_argument('--app-dir',
+                        default=os.path.dirname(pyupdater.__file__),
+                        help='Directory to build releases from')
+    parser.add_argument('--archive-format', default='zip',
+                        choices=['zip', 'gztar'])
+    parser.add_argument('--changes', type=int, default=5,
+                        help='Files changed in the new release')
+    parser.add_argument('--engines', nargs='+', default=ENGINES)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        old, new = args.old, args.new
+        if old is None or new is None:
+            old, new = make_releases(args.app_dir, work_dir,
+                                     args.archive_format, args.changes)
+        print(json.dumps({'old_size': os.path.getsize(old),
+                          'new_size': os.path.getsize(new)}))
+        for name in args.engines:
+            print(json.dumps(run(name, old, new, work_dir)))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+"""Compares loading a big version file the old way, download to memory,
+decompress through a file object & gzip it again to save it, against
+decompressing while downloading & saving the downloaded bytes as is.
+
+    $ python tests/benchmarks/bench_manifest.py --versions 5000
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from helpers import BenchServer, write_file
+
+from pyupdater.client.downloader import FileDownloader
+from pyupdater.utils import GzipDecompressor
+
+
+def make_manifest(packages, versions):
+    updates = {}
+    latest = {}
+    for p in range(packages):
+        name = 'package{}'.format(p)
+        updates[name] = {}
+        for v in range(versions):
+            version = '{}.{}.{}'.format(v // 100, v % 100, 0)
+            info = {}
+            for plat in ['mac', 'win', 'nix64']:
+                filename = '{}-{}-{}.tar.gz'.format(name, plat, version)
+                info[plat] = {
+                    'filename': filename,
+                    'file_hash': hashlib.sha256(
+                        filename.encode('utf-8')).hexdigest(),
+                    'patch_name': filename + '-patch',
+                    'patch_hash': hashlib.sha256(
+                        version.encode('utf-8')).hexdigest()}
+            updates[name][version] = info
+        latest[name] = dict((plat, version) for plat in info)
+    data = json.dumps({'updates': updates, 'latest': latest,
+                       'sigs': ['x' * 88]}, sort_keys=True)
+    f = io.BytesIO()
+    with gzip.GzipFile(fileobj=f, mode='wb') as g:
+        g.write(data.encode('utf-8'))
+    return f.getvalue()
+
+
+def _old_gzip_decompress(data):
+    compressed_file = io.BytesIO()
+    compressed_file.write(data)
+    compressed_file.seek(0)
+    decompressed_file = gzip.GzipFile(fileobj=compressed_file, mode='rb')
+    data = decompressed_file.read()
+    compressed_file.close()
+    decompressed_file.close()
+    return data
+
+
+def load_old(url):
+    fd = FileDownloader('versions.gz', url, verify=False)
+    data = _old_gzip_decompress(fd.download_verify_return())
+    with gzip.open('versions.gz', 'wb') as f:
+        f.write(data)
+    return data
+
+
+def load_new(url):
+    fd = FileDownloader('versions.gz', url, verify=False)
+    decompressor = GzipDecompressor()
+    assert fd.download_verify_into(decompressor) is True
+    data = decompressor.getvalue()
+    with open('versions.gz', 'wb') as f:
+        f.write(decompressor.get_compressed())
+    return data
+
+
+def run(url, mode, trace_memory):
+    load = load_new if mode == 'stream' else load_old
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    tracemalloc = None
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    try:
+        start_cpu = sum(os.times()[:2])
+        start = time.time()
+        data = load(url)
+        wall = time.time() - start
+        cpu = sum(os.times()[:2]) - start_cpu
+        saved = os.path.getsize('versions.gz')
+    finally:
+        peak = None
+        if tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {'mode': mode,
+            'manifest_size': len(data),
+            'saved_size': saved,
+            'wall_time': round(wall, 4),
+            'cpu_time': round(cpu, 4),
+            'peak_traced_memory': peak}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packages', type=int, default=5)
+    parser.add_argument('--versions', type=int, default=2000,
+                        help='Versions per package')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Report peak python memory. Python 3 only')
+    args = parser.parse_args()
+
+    server = BenchServer().start()
+    compressed = make_manifest(args.packages, args.versions)
+    write_file(server.root, 'versions.gz', compressed)
+    print(json.dumps({'compressed_size': len(compressed)}))
+    try:
+        for _ in range(args.rounds):
+            for mode in ['old', 'stream']:
+                print(json.dumps(run(server.url, mode, args.trace_memory)))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+"""Compares compressing with the gzip module & ParallelGzipWriter with
+different numbers of workers. Reports wall time, MB a second & size as
+json & checks the gzip module reads every output back. The writer
+archives are made with, open_gzip_writer, is run with one worker,
+where it uses the gzip module.
+
+Data is half random & half repeated, about as compressible as a
+PyInstaller bundle. Or pass a real archive to compress its contents.
+
+    $ python tests/benchmarks/bench_parallel_gzip.py --size 64
+    $ python tests/benchmarks/bench_parallel_gzip.py --file app.tar \\
+          --workers 1 8 32
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import time
+
+from pyupdater.utils.parallel_gzip import (open_gzip_writer,
+                                           ParallelGzipWriter)
+
+MB = 1024 * 1024
+
+
+def make_data(size):
+    text = b'PyInstaller bundle ' * 108
+    data = b''.join(os.urandom(2048) + text
+                    for _ in range(size // 4096 + 1))
+    return data[:size]
+
+
+def run(name, data, level, workers=None):
+    f = io.BytesIO()
+    start = time.time()
+    if workers is None:
+        with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=level) as gz:
+            gz.write(data)
+    else:
+        if name == 'parallel':
+            writer = ParallelGzipWriter(f, level, workers)
+        else:
+            writer = open_gzip_writer(f, level, workers)
+        with writer as gz:
+            for i in range(0, len(data), MB):
+                gz.write(data[i:i + MB])
+    wall = time.time() - start
+    compressed = f.getvalue()
+    output = gzip.GzipFile(fileobj=io.BytesIO(compressed)).read()
+    rate = None
+    if wall > 0:
+        rate = round(len(data) / MB / wall, 2)
+    return {'writer': name,
+            'workers': workers,
+            'wall_time': round(wall, 4),
+            'mb_per_sec': rate,
+            'size': len(compressed),
+            'identical': output == data}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=float, default=32,
+                        help='Data size in MB')
+    parser.add_argument('--file', help='Compress this file instead')
+    parser.add_argument('--level', type=int, default=9)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    if args.file is not None:
+        with open(args.file, 'rb') as f:
+            data = f.read()
+    else:
+        data = make_data(int(args.size * MB))
+    print(json.dumps({'data_size': len(data),
+                      'cpus': multiprocessing.cpu_count()}))
+    print(json.dumps(run('gzip', data, args.level)))
+    print(json.dumps(run('open_gzip_writer', data, args.level, 1)))
+    for workers in args.workers:
+        print(json.dumps(run('parallel', data, args.level, workers)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+"""Measures how long applying one patch of a chain takes per byte of
+archive, the way the patcher does it: source & patch mapped & the new
+archive written to a temp file. Reports the PATCH_APPLY_COST that
+matches a download speed, which is download speed over apply speed.
+
+Patches only change a few bytes, so the time is what every hop of a
+chain costs no matter how small its patch is.
+
+    $ python tests/benchmarks/bench_patch_apply.py --size 64
+    $ python tests/benchmarks/bench_patch_apply.py --size 64 \\
+          --download-speed 2 --engines bsdiff4 block-delta
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from helpers import mutate
+
+from pyupdater.client.patcher import _map_file
+from pyupdater.utils.diff_engines import get_engine
+
+MB = 1024 * 1024
+
+
+def make_chain(work_dir, size, patches, changes, engine):
+    # Writes release 0 & a patch to each release after it. Returns
+    # the path of release 0 & of every patch
+    data = os.urandom(size)
+    source = os.path.join(work_dir, 'release-0')
+    with open(source, 'wb') as f:
+        f.write(data)
+    paths = []
+    for i in range(1, patches + 1):
+        new = mutate(data, changes)
+        path = os.path.join(work_dir, 'patch-{}'.format(i))
+        with open(path, 'wb') as f:
+            f.write(engine.diff(data, new))
+        paths.append(path)
+        data = new
+    return source, paths
+
+
+def run(name, size, patches, changes, download_speed, work_dir):
+    engine = get_engine(name)
+    result = {'engine': name, 'size': size, 'patches': patches}
+    if engine is None or not engine.can_diff():
+        result['skipped'] = 'cannot make patches here'
+        return result
+    source, paths = make_chain(work_dir, size, patches, changes, engine)
+    times = []
+    for i, path in enumerate(paths):
+        output = os.path.join(work_dir, 'patched-{}'.format(i))
+        start = time.time()
+        with _map_file(source) as source_data, \
+                _map_file(path) as patch, open(output, 'wb') as f:
+            engine.patch_into(source_data, patch, f)
+        times.append(time.time() - start)
+        source = output
+    # Median hop. The first one pays for reading release 0 from disk
+    hop = sorted(times)[len(times) // 2]
+    apply_speed = size / MB / hop
+    result.update({'patch_size': os.path.getsize(paths[-1]),
+                   'seconds_per_patch': round(hop, 4),
+                   'apply_mb_per_sec': round(apply_speed, 1),
+                   'download_mb_per_sec': download_speed,
+                   'apply_cost': round(download_speed / apply_speed, 4)})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=float, default=32,
+                        help='Archive size in MB')
+    parser.add_argument('--patches', type=int, default=5,
+                        help='Length of the patch chain')
+    parser.add_argument('--changes', type=int, default=16,
+                        help='Bytes changed by each patch')
+    parser.add_argument('--download-speed', type=float, default=10,
+                        help='Download speed in MB a second')
+    parser.add_argument('--engines', nargs='+', default=['bsdiff4'])
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        for name in args.engines:
+            print(json.dumps(run(name, int(args.size * MB), args.patches,
+                                 args.changes, args.download_speed,
+                                 work_dir)))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
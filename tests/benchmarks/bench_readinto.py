@@ -0,0 +1,129 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+"""Compares the download loop reading a new bytes object per block
+against reading into one reused buffer.  Reports block allocations &
+cpu time of the downloading thread per GB.  Python 2 has no readinto
+on http responses so both modes read bytes there.
+
+    $ python tests/benchmarks/bench_readinto.py --size-mb 256
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from helpers import BenchServer, write_file
+
+from pyupdater.client.downloader import FileDownloader
+
+GB = 1024 * 1024 * 1024
+
+
+def _cpu_time():
+    # Leaves out the cpu used by the server threads when possible
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+    return sum(os.times()[:2])
+
+
+class CountingDownloader(FileDownloader):
+    # Counts bytes objects made by the download loop
+
+    use_readinto = True
+    allocations = 0
+
+    def _block_reader(self, data):
+        if self.use_readinto:
+            read = FileDownloader._block_reader(data)
+        else:
+            read = data.read
+
+        def counting_read(size):
+            block = read(size)
+            if isinstance(block, bytes):
+                CountingDownloader.allocations += 1
+            return block
+        return counting_read
+
+
+def run(server, name, file_hash, size, use_readinto, trace_memory):
+    CountingDownloader.use_readinto = use_readinto
+    CountingDownloader.allocations = 0
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    tracemalloc = None
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    try:
+        start_cpu = _cpu_time()
+        start = time.time()
+        fd = CountingDownloader(name, server.url, file_hash, verify=False)
+        assert fd.download_verify_write() is True
+        wall = time.time() - start
+        cpu = _cpu_time() - start_cpu
+    finally:
+        peak = None
+        if tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    scale = float(GB) / size
+    return {'mode': 'readinto' if use_readinto else 'read',
+            'size': size,
+            'block_allocations': CountingDownloader.allocations,
+            'block_allocations_per_gb': int(CountingDownloader.allocations *
+                                            scale),
+            'cpu_seconds_per_gb': round(cpu * scale, 3),
+            'wall_time': round(wall, 3),
+            'peak_traced_memory': peak}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Report peak python memory. Python 3 only. '
+                             'Slows down both modes')
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    server = BenchServer().start()
+    data = os.urandom(size)
+    name = 'app-mac-1.0.0.tar.gz'
+    write_file(server.root, name, data)
+    file_hash = hashlib.sha256(data).hexdigest()
+    del data
+    try:
+        for _ in range(args.rounds):
+            for use_readinto in [False, True]:
+                print(json.dumps(run(server, name, file_hash, size,
+                                     use_readinto, args.trace_memory)))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
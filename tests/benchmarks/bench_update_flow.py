@@ -0,0 +1,288 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+"""Runs the whole client update flow, refresh, update_check, download
+& extract, against a generated repo on a local server & reports wall
+time, cpu time, peak rss, bytes sent by the server & syscalls of each
+phase as json. The server runs in its own process so only the client
+is measured. Latency, bandwidth caps & failed requests can be added to
+stand in for real networks.
+
+Full mode downloads the latest archive. Patch mode installs an older
+archive first so the update is patched from it.
+
+    $ python tests/benchmarks/bench_update_flow.py --size 64 --versions 20
+    $ python tests/benchmarks/bench_update_flow.py --mode patch --patches 4
+    $ python tests/benchmarks/bench_update_flow.py --latency 0.05 \\
+          --bandwidth 10485760 --fail-rate 0.1 --seed 1
+
+Archives are built in memory, so big sizes need free memory to match.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+import bsdiff4
+import ed25519
+import six
+
+from helpers import BenchServerProcess, mutate, write_file
+
+from pyupdater.client import Client
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+NAME = 'lib'
+PLATFORM = 'mac'
+MB = 1024 * 1024
+
+
+def version_string(i, internal=True):
+    # Version files use the internal form, which adds the release
+    # channel, 2 for stable, & its number
+    version = '1.{}.0'.format(i)
+    if internal:
+        version += '.2.0'
+    return version
+
+
+def make_archive(data):
+    # Stored so archive sizes match --size & patches stay small
+    f = six.BytesIO()
+    with zipfile.ZipFile(f, 'w', zipfile.ZIP_STORED) as z:
+        z.writestr(NAME, data)
+    return f.getvalue()
+
+
+def make_repo(root, size, versions, patches):
+    """Writes archives, patches & a signed version file to root
+
+    Returns:
+
+        (tuple): public key & {version: archive filename}
+    """
+    updates = {}
+    filenames = {}
+    data = os.urandom(size)
+    previous = None
+    first_patch = versions - patches
+    for i in range(versions):
+        version = version_string(i)
+        if i > 0:
+            data = mutate(data)
+        archive = make_archive(data)
+        filename = '{}-{}-{}.zip'.format(NAME, PLATFORM,
+                                         version_string(i, False))
+        write_file(root, filename, archive)
+        filenames[version] = filename
+        info = {'filename': filename,
+                'file_hash': hashlib.sha256(archive).hexdigest(),
+                'file_size': len(archive)}
+        if i >= first_patch and previous is not None:
+            patch = bsdiff4.diff(previous, archive)
+            patch_name = '{}-{}-{}'.format(NAME, PLATFORM, i)
+            write_file(root, patch_name, patch)
+            info['patch_name'] = patch_name
+            info['patch_hash'] = hashlib.sha256(patch).hexdigest()
+            info['patch_size'] = len(patch)
+        updates[version] = {PLATFORM: info}
+        previous = archive
+
+    version_data = {'updates': {NAME: updates},
+                    'latest': {NAME: {PLATFORM: version_string(
+                        versions - 1)}}}
+    signing_key, verifying_key = ed25519.create_keypair()
+    data = json.dumps(version_data, sort_keys=True)
+    sig = signing_key.sign(six.b(data), encoding='base64')
+    version_data['sigs'] = [sig.decode('ascii')]
+    with gzip.open(os.path.join(root, 'versions.gz'), 'wb') as f:
+        f.write(json.dumps(version_data).encode('utf-8'))
+    public_key = verifying_key.to_ascii(encoding='base64').decode('ascii')
+    return public_key, filenames
+
+
+class PhaseMeter(object):
+    # Takes resource readings of this process around each phase
+
+    def __init__(self, server):
+        self.server = server
+        self.report = []
+
+    def measure(self, phase, func, *args):
+        before = self._snapshot()
+        start = time.time()
+        result = func(*args)
+        wall = time.time() - start
+        after = self._snapshot()
+        entry = {'phase': phase, 'wall_time': round(wall, 4)}
+        for key in before:
+            if key == 'peak_rss':
+                entry[key] = after[key]
+            elif before[key] is None:
+                entry[key] = None
+            else:
+                entry[key] = after[key] - before[key]
+        entry['cpu_time'] = round(entry['cpu_time'], 4)
+        self.report.append(entry)
+        return result
+
+    def _snapshot(self):
+        snap = {'cpu_time': sum(os.times()[:2])}
+        snap.update(_rusage())
+        snap.update(_io_counters())
+        stats = self.server.stats()
+        snap['bytes_sent'] = stats['bytes_sent']
+        snap['requests'] = stats['requests']
+        snap['failed_requests'] = stats['failures']
+        return snap
+
+
+def _rusage():
+    if resource is None:  # pragma: no cover
+        return {'peak_rss': None, 'context_switches': None}
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # Kilobytes on linux, bytes on mac
+    peak = usage.ru_maxrss
+    if not os.uname()[0] == 'Darwin':
+        peak *= 1024
+    return {'peak_rss': peak,
+            'context_switches': usage.ru_nvcsw + usage.ru_nivcsw}
+
+
+def _io_counters():
+    # Read & write syscalls, which covers socket & file io.
+    # Only on linux
+    counters = {'read_syscalls': None, 'write_syscalls': None}
+    try:
+        with open('/proc/self/io') as f:
+            lines = f.read().splitlines()
+    except (IOError, OSError):
+        return counters
+    for line in lines:
+        key, value = line.split(':')
+        if key == 'syscr':
+            counters['read_syscalls'] = int(value)
+        elif key == 'syscw':
+            counters['write_syscalls'] = int(value)
+    return counters
+
+
+def run(server, public_key, filenames, args):
+    data_dir = tempfile.mkdtemp()
+    installed = args.versions - 1 - args.patches
+    if args.mode == 'full':
+        installed = 0
+
+    class Config(object):
+        APP_NAME = 'bench'
+        COMPANY_NAME = 'Bench LLC'
+        PUBLIC_KEYS = [public_key]
+        UPDATE_URLS = [server.url]
+        DATA_DIR = data_dir
+        VERIFY_SERVER_CERT = False
+        DOWNLOAD_SEGMENTS = args.segments
+        MAX_DOWNLOAD_BPS = args.max_bps
+
+    meter = PhaseMeter(server)
+    try:
+        client = Client(Config(), refresh=False, test=True)
+        if args.mode == 'patch':
+            # Archive of the installed version to patch from
+            shutil.copy(os.path.join(args.root,
+                                     filenames[version_string(installed)]),
+                        client.update_folder)
+        meter.measure('refresh', client.refresh)
+        update = meter.measure('update_check', client.update_check, NAME,
+                               version_string(installed, False))
+        downloaded = False
+        if update is not None:
+            downloaded = meter.measure('download', update.download)
+        if downloaded is True:
+            meter.measure('extract', update.extract)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return {'mode': args.mode,
+            'installed': version_string(installed, False),
+            'update_found': update is not None,
+            'downloaded': downloaded is True,
+            'phases': meter.report}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['full', 'patch'], default='full')
+    parser.add_argument('--size', type=float, default=16,
+                        help='Archive size in MB')
+    parser.add_argument('--versions', type=int, default=10)
+    parser.add_argument('--patches', type=int, default=3,
+                        help='Number of newest versions with a patch')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--segments', type=int, default=4,
+                        help='DOWNLOAD_SEGMENTS of the client')
+    parser.add_argument('--max-bps', type=int, default=None,
+                        help='MAX_DOWNLOAD_BPS of the client')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds before the server answers')
+    parser.add_argument('--bandwidth', type=int, default=None,
+                        help='Server bytes per second per connection')
+    parser.add_argument('--fail-rate', type=float, default=0,
+                        help='Chance a request gets a 503 or is cut off')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    args.patches = max(0, min(args.patches, args.versions - 1))
+
+    args.root = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        # Built in another process to keep it out of the peak rss
+        pool = multiprocessing.Pool(1)
+        public_key, filenames = pool.apply(make_repo, (args.root,
+                                                       int(args.size * MB),
+                                                       args.versions,
+                                                       args.patches))
+        pool.close()
+        pool.join()
+        print(json.dumps({'archive_size': int(args.size * MB),
+                          'versions': args.versions,
+                          'patches': args.patches,
+                          'build_time': round(time.time() - start, 4)}))
+        server = BenchServerProcess(root=args.root, latency=args.latency,
+                                    bandwidth=args.bandwidth,
+                                    fail_rate=args.fail_rate,
+                                    seed=args.seed).start()
+        try:
+            for _ in range(args.rounds):
+                print(json.dumps(run(server, public_key, filenames, args)))
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(args.root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
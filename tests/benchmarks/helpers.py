@@ -0,0 +1,248 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+
+# Making pyupdater importable when ran from a source checkout
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir, os.pardir)))
+
+# Path that returns server stats as json. Not counted in the stats
+STATS_PATH = '/__stats__'
+
+
+class BenchServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local http server used by benchmarks. Serves files from root.
+
+    Kwargs:
+
+        handshake_delay (float): Seconds slept on every new connection.
+                                 Stands in for the cost of a tls
+                                 handshake.
+
+        latency (float): Seconds slept before answering every request
+
+        bandwidth (int): Max bytes per second sent on each connection.
+                         None for no limit
+
+        fail_rate (float): Chance, 0 to 1, a request fails. Failed
+                           requests either get a 503 or are cut off
+                           half way through the body
+
+        seed (int): Seed for picking failed requests
+
+        root (str): Directory to serve. Defaults to a new temp dir that
+                    is removed on stop
+    """
+    daemon_threads = True
+
+    def __init__(self, handshake_delay=0, latency=0, bandwidth=None,
+                 fail_rate=0, seed=None, root=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           _BenchRequestHandler)
+        self._own_root = root is None
+        self.root = root or tempfile.mkdtemp()
+        self.url = 'http://127.0.0.1:{}/'.format(self.server_address[1])
+        self.handshake_delay = handshake_delay
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fail_rate = fail_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.connections = 0
+            self.requests = 0
+            self.bytes_sent = 0
+            self.failures = 0
+
+    def add_stat(self, name, value):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def stats(self):
+        with self._lock:
+            return {'connections': self.connections,
+                    'requests': self.requests,
+                    'bytes_sent': self.bytes_sent,
+                    'failures': self.failures}
+
+    def pick_failure(self):
+        # Returns None, '503' or 'cut'
+        with self._lock:
+            if self._random.random() >= self.fail_rate:
+                return None
+            self.failures += 1
+            return self._random.choice(['503', 'cut'])
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._own_root:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class _BenchRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Bytes written at a time
+    chunk_size = 64 * 1024
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.add_stat('connections', 1)
+        if self.server.handshake_delay:
+            time.sleep(self.server.handshake_delay)
+
+    def do_GET(self):
+        if self.path == STATS_PATH:
+            body = json.dumps(self.server.stats()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.server.add_stat('requests', 1)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        path = os.path.join(self.server.root, self.path.lstrip('/'))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        failure = self.server.pick_failure()
+        if failure == '503':
+            self.send_error(503)
+            return
+        total = os.path.getsize(path)
+        start = 0
+        end = total - 1
+        range_header = self.headers.get('Range')
+        if range_header is not None:
+            start, end = range_header.split('=')[1].split('-')
+            start = int(start)
+            end = int(end) if end else total - 1
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes {}-{}/{}'.format(start, end, total))
+        else:
+            self.send_response(200)
+        length = end - start + 1
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        if failure == 'cut':
+            length //= 2
+            self.close_connection = True
+        with open(path, 'rb') as f:
+            f.seek(start)
+            self._send(f, length)
+
+    def _send(self, f, length):
+        # Streams length bytes of f, keeping under the bandwidth cap
+        bandwidth = self.server.bandwidth
+        started = time.time()
+        sent = 0
+        while sent < length:
+            block = f.read(min(self.chunk_size, length - sent))
+            if len(block) == 0:
+                break
+            self.wfile.write(block)
+            sent += len(block)
+            self.server.add_stat('bytes_sent', len(block))
+            if bandwidth:
+                ahead = sent / float(bandwidth) - (time.time() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(queue, kwargs):
+    # Runs in the server process
+    server = BenchServer(**kwargs)
+    queue.put(server.url)
+    server.serve_forever()
+
+
+class BenchServerProcess(object):
+    """Runs a :class:`BenchServer` in its own process so it doesn't
+    add to the cpu, memory & syscalls of the process being measured.
+    Takes the same kwargs as BenchServer. Pass root to serve files
+    from a directory that already exists.
+    """
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.url = None
+        self._process = None
+
+    def start(self):
+        queue = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=_serve,
+                                                args=(queue, self.kwargs))
+        self._process.daemon = True
+        self._process.start()
+        self.url = queue.get(timeout=30)
+        return self
+
+    def stats(self):
+        """Returns (dict): connections, requests, bytes_sent & failures
+        since the server started"""
+        from six.moves.urllib.request import urlopen
+        return json.loads(urlopen(self.url.rstrip('/') + STATS_PATH)
+                          .read().decode('utf-8'))
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
+
+
+def write_file(directory, filename, data):
+    with open(os.path.join(directory, filename), 'wb') as f:
+        f.write(data)
+
+
+def mutate(data, changes=16):
+    """Returns a copy of data with a few random bytes changed. Used to
+    fake a new release of an app"""
+    data = bytearray(data)
+    for _ in range(changes):
+        i = ord(os.urandom(1)) * len(data) // 256
+        data[i] = ord(os.urandom(1))
+    return bytes(data)
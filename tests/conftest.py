@@ -1,5 +1,16 @@
+import email.utils
+import gzip
+import hashlib
+import json
 import os
+import shutil
 import tempfile
+import threading
+import time
+
+import ed25519
+import six
+from six.moves import BaseHTTPServer, socketserver
 
 from pyupdater import PyUpdater
 from pyupdater.client import Client
@@ -43,3 +54,175 @@ def pyu():
     t_config.DATA_DIR = os.getcwd()
     pyu = PyUpdater(t_config)
     return pyu
+
+
+class _ThreadedHTTPServer(socketserver.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping connections is expected during tests
+        pass
+
+
+class _FileRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Serves files from server.root. Supports single byte ranges
+    # unless server.ranges is False & conditional requests.
+    # Statuses in server.errors are sent, one per request, before
+    # files are served. Byte counts in server.cuts are how much of
+    # the body is sent, one per request, before the connection drops.
+    # server.delays has delays of single paths, overriding server.delay
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        delay = self.server.delays.get(self.path, self.server.delay)
+        if delay:
+            time.sleep(delay)
+        if self.server.errors:
+            self.send_error(self.server.errors.pop(0))
+            return
+        path = os.path.join(self.server.root, self.path.lstrip('/'))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        etag = '"{}"'.format(hashlib.sha256(data).hexdigest())
+        last_modified = email.utils.formatdate(os.path.getmtime(path),
+                                               usegmt=True)
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match == etag or (if_none_match is None and
+                                     self.headers.get('If-Modified-Since') ==
+                                     last_modified):
+            self.server.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        total = len(data)
+        range_header = self.headers.get('Range')
+        if range_header is not None and self.server.ranges is True:
+            start, end = range_header.split('=')[1].split('-')
+            start = int(start)
+            end = int(end) if end else total - 1
+            if start >= total:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(total))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            data = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes {}-{}/{}'.format(start, end, total))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.server.cuts:
+            self.wfile.write(data[:self.server.cuts.pop(0)])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def _start_http_server(request):
+    server = _ThreadedHTTPServer(('127.0.0.1', 0), _FileRequestHandler)
+    server.root = tempfile.mkdtemp()
+    server.ranges = True
+    server.delay = 0
+    server.delays = {}
+    server.requests = []
+    server.connections = 0
+    server.not_modified = 0
+    server.errors = []
+    server.cuts = []
+    server.url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+    def fin():
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(server.root, ignore_errors=True)
+    request.addfinalizer(fin)
+    return server
+
+
+@pytest.fixture
+def http_server(request):
+    """Local http server. Files placed in server.root are served
+    from server.url. Set server.delay to slow down responses"""
+    return _start_http_server(request)
+
+
+@pytest.fixture
+def served_file(http_server):
+    """Random 300KB app.tar.gz served by http_server. Returns its
+    sha256 hash & data"""
+    data = os.urandom(1024 * 300)
+    with open(os.path.join(http_server.root, 'app.tar.gz'), 'wb') as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest(), data
+
+
+@pytest.fixture
+def http_server2(request):
+    """Second local http server. Used as a mirror of http_server"""
+    return _start_http_server(request)
+
+
+class _UpdateServer(object):
+    # Publishes signed version files on a local http server & makes
+    # clients that trust them
+
+    def __init__(self, server):
+        self.server = server
+        self.url = server.url
+        self.signing_key, verifying_key = ed25519.create_keypair()
+        self.public_key = verifying_key.to_ascii(encoding='base64')
+        self.public_key = self.public_key.decode('ascii')
+
+    def publish(self, version_data):
+        version_data = dict(version_data)
+        data = json.dumps(version_data, sort_keys=True)
+        sig = self.signing_key.sign(six.b(data), encoding='base64')
+        version_data['sigs'] = [sig.decode('ascii')]
+        path = os.path.join(self.server.root, 'versions.gz')
+        with gzip.open(path, 'wb') as f:
+            f.write(json.dumps(version_data).encode('utf-8'))
+
+    def client(self, **config):
+        class Config(object):
+            APP_NAME = 'jms'
+            COMPANY_NAME = 'JMS LLC'
+            PUBLIC_KEYS = [self.public_key]
+            UPDATE_URLS = [self.url]
+            DATA_DIR = os.getcwd()
+            VERIFY_SERVER_CERT = False
+        for k, v in config.items():
+            setattr(Config, k, v)
+        return Client(Config(), refresh=True, test=True)
+
+
+@pytest.fixture
+def update_server(http_server):
+    """Local update server with a signed version file. Use
+    update_server.publish to change the version file &
+    update_server.client to get a client using the server"""
+    server = _UpdateServer(http_server)
+    server.publish({'updates': {}, 'latest': {}})
+    return server
@@ -0,0 +1,153 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from pyupdater.client.aio import AsyncRunner, get_loop, ProgressIterator
+from pyupdater.client.updates import LibUpdate
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 5),
+                                reason='asyncio api requires python 3.5+')
+
+
+@pytest.fixture
+def loop():
+    import asyncio
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def _drain(loop, progress):
+    # Same as "async for" without the python 3 only syntax
+    events = []
+    while True:
+        try:
+            events.append(loop.run_until_complete(progress.__anext__()))
+        except StopAsyncIteration:
+            return events
+
+
+class TestProgressIterator(object):
+
+    def test_events_from_threads(self, loop):
+        progress = ProgressIterator(loop)
+
+        def worker():
+            for i in range(5):
+                progress({'downloaded': i})
+            progress.close()
+
+        t = threading.Thread(target=worker)
+        t.start()
+        events = _drain(loop, progress)
+        t.join()
+        assert [e['downloaded'] for e in events] == list(range(5))
+        # Stays exhausted
+        with pytest.raises(StopAsyncIteration):
+            loop.run_until_complete(progress.__anext__())
+
+    def test_running_loop(self, loop):
+        progress = ProgressIterator()
+        futures = []
+        # Called while the loop runs, same as from a coroutine
+        loop.call_soon(lambda: futures.append(progress.__anext__()))
+        loop.call_soon(loop.stop)
+        loop.run_forever()
+        progress({'downloaded': 1})
+        assert loop.run_until_complete(futures[0]) == {'downloaded': 1}
+        if sys.version_info >= (3, 7):
+            # No loop is looked up outside a running one
+            with pytest.raises(RuntimeError):
+                get_loop()
+
+
+class TestAsyncRunner(object):
+
+    def test_result(self, loop):
+        runner = AsyncRunner(2)
+        future = runner.run(sum, [1, 2, 3], loop=loop)
+        assert loop.run_until_complete(future) == 6
+        runner.shutdown()
+
+    def test_concurrency_limit(self, loop):
+        import asyncio
+        runner = AsyncRunner(2)
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+
+        def job():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+
+        futures = [runner.run(job, loop=loop) for _ in range(6)]
+        loop.run_until_complete(asyncio.gather(*futures))
+        assert peak[0] == 2
+        runner.shutdown()
+
+
+@pytest.mark.usefixtures('cleandir')
+class TestDownloadAsync(object):
+
+    def _update(self, result=True):
+        update = LibUpdate({'data_dir': os.getcwd(), 'progress_hooks': [],
+                            'max_concurrent_downloads': 2})
+        calls = []
+
+        def _download():
+            calls.append(1)
+            update._call_hooks_for_test({'status': 'downloading'})
+            time.sleep(0.05)
+            update._is_downloading = False
+            return result
+
+        def _call_hooks(status):
+            for hook in update.progress_hooks:
+                hook(status)
+
+        update._download = _download
+        update._call_hooks_for_test = _call_hooks
+        return update, calls
+
+    def test_download_async(self, loop):
+        update, calls = self._update()
+        progress = update.progress_async(loop)
+        first = update.download_async(loop)
+        # Awaiting twice shares the running download
+        assert update.download_async(loop) is first
+        assert loop.run_until_complete(first) is True
+        assert len(calls) == 1
+        assert _drain(loop, progress) == [{'status': 'downloading'}]
+        # Iterator is removed from the hooks once the download is done
+        assert update.progress_hooks == []
+
+    def test_download_async_while_downloading(self, loop):
+        update, calls = self._update()
+        update._is_downloading = True
+        future = update.download_async(loop)
+        assert loop.run_until_complete(future) is None
+        assert calls == []
@@ -0,0 +1,124 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+from pyupdater.client.cache import DownloadCache
+from pyupdater.client.downloader import FileDownloader, SegmentedDownloader
+
+
+def _write(filename, data):
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestDownloadCache(object):
+
+    def test_put_get(self):
+        file_hash = _write('app.tar.gz', b'app data')
+        cache = DownloadCache('cache')
+        assert cache.get(file_hash, 'copy.tar.gz') is False
+        cache.put(file_hash, 'app.tar.gz')
+        assert cache.get(file_hash, 'copy.tar.gz') is True
+        with open('copy.tar.gz', 'rb') as f:
+            assert f.read() == b'app data'
+        assert cache.read(file_hash) == b'app data'
+        assert cache.size() == len(b'app data')
+
+    def test_damaged_file_removed(self):
+        file_hash = _write('app.tar.gz', b'app data')
+        cache = DownloadCache('cache')
+        cache.put(file_hash, 'app.tar.gz')
+        cached = cache._object_path(file_hash)
+        # Replaced, not written to, so the original isn't touched
+        os.remove(cached)
+        _write(cached, b'bad data')
+        assert cache.get(file_hash, 'copy.tar.gz') is False
+        assert os.path.exists('copy.tar.gz') is False
+        assert os.path.exists(cached) is False
+        _write(cached, b'bad data')
+        assert cache.read(file_hash) is None
+        assert os.path.exists(cached) is False
+
+    def test_lru_eviction(self):
+        cache = DownloadCache('cache', max_size=25)
+        hashes = []
+        for i in range(3):
+            data = '{}'.format(i).encode() * 10
+            file_hash = hashlib.sha256(data).hexdigest()
+            cache.put_data(file_hash, data)
+            hashes.append(file_hash)
+            # Makes sure mtimes differ
+            stamp = time.time() - 100 + i
+            os.utime(cache._object_path(file_hash), (stamp, stamp))
+            if i == 1:
+                # Using the first file makes the second one the oldest
+                assert cache.read(hashes[0]) is not None
+        assert cache.size() <= 25
+        assert cache.read(hashes[0]) is not None
+        assert cache.read(hashes[1]) is None
+        assert cache.read(hashes[2]) is not None
+
+    def test_concurrent_puts(self):
+        cache = DownloadCache('cache', max_size=1024 * 30)
+        blobs = [os.urandom(1024 * 4) for _ in range(20)]
+        hashes = [hashlib.sha256(b).hexdigest() for b in blobs]
+
+        def worker():
+            for file_hash, data in zip(hashes, blobs):
+                cache.put_data(file_hash, data)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert cache.size() <= 1024 * 30
+        for file_hash, data in zip(hashes, blobs):
+            assert cache.read(file_hash) in (None, data)
+        # No temp files left behind
+        for root, dirs, files in os.walk(cache.objects_dir):
+            for f in files:
+                assert f in hashes
+
+    def test_download_uses_cache(self, http_server, served_file):
+        file_hash, data = served_file
+        cache = DownloadCache('cache')
+        fd = SegmentedDownloader('app.tar.gz', http_server.url, file_hash,
+                                 cache=cache)
+        assert fd.download_verify_write() is True
+        count = len(http_server.requests)
+
+        # Another app downloading the same file
+        os.mkdir('other')
+        events = []
+        fd = FileDownloader(os.path.join('other', 'app.tar.gz'),
+                            http_server.url, file_hash, cache=cache,
+                            progress_hooks=[events.append])
+        assert fd.download_verify_write() is True
+        assert fd.download_verify_return() == data
+        assert len(http_server.requests) == count
+        assert events[-1]['status'] == 'finished'
+        with open(os.path.join('other', 'app.tar.gz'), 'rb') as f:
+            assert f.read() == data
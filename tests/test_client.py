@@ -16,16 +16,32 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import gzip
+import hashlib
 import json
 import os
 import shutil
+import threading
 import time
 
+import bsdiff4
 from jms_utils.system import get_system
 from jms_utils.paths import ChDir
 import pytest
 
+from pyupdater import settings
 from pyupdater.client import Client
+from pyupdater.client.batch import BatchUpdater
+from pyupdater.client.downloader import SegmentedDownloader
+from pyupdater.client.patcher import get_patch_folder, Patcher
+from pyupdater.client.planner import (choose_patch_update,
+                                      get_apply_cost,
+                                      patch_cost)
+from pyupdater.client.singleflight import SingleFlight
+from pyupdater.client.throttle import ByteBudget
+from pyupdater.utils import diff_engines
+from pyupdater.utils.diff_engines import get_engine
+from pyupdater.utils.filelock import FileLock
 from tconfig import TConfig
 
 
@@ -241,3 +257,674 @@ class TestExtract(object):
                     shutil.rmtree(f, ignore_errors=True)
         if get_system() != 'win':
             assert update.extract() is False
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestManifestCache(object):
+
+    def test_not_modified(self, update_server):
+        client = update_server.client()
+        assert client.verified is True
+        assert os.path.exists(settings.VERSION_FILE_CACHE_INFO)
+        json_data = client.json_data
+        client.refresh()
+        headers = update_server.server.requests[-1][1]
+        assert 'if-none-match' in headers
+        assert 'if-modified-since' in headers
+        assert update_server.server.not_modified == 1
+        # Kept the already verified version file
+        assert client.json_data is json_data
+        assert client.verified is True
+
+    def test_modified(self, update_server):
+        client = update_server.client()
+        update_server.publish({'updates': {}, 'latest': {'new': 1}})
+        client.refresh()
+        assert update_server.server.not_modified == 0
+        assert client.verified is True
+        assert client.json_data['latest'] == {'new': 1}
+
+    def test_not_modified_new_client(self, update_server):
+        update_server.client()
+        # Loads & verifies the version file already on disk
+        client = update_server.client()
+        assert update_server.server.not_modified == 1
+        assert client.ready is True
+        assert client.verified is True
+        assert 'updates' in client.json_data
+
+    def test_saved_as_downloaded(self, update_server):
+        update_server.client()
+        path = os.path.join(update_server.server.root, settings.VERSION_FILE)
+        with open(path, 'rb') as f:
+            served = f.read()
+        with open(settings.VERSION_FILE, 'rb') as f:
+            assert f.read() == served
+
+    def test_no_version_file_on_disk(self, update_server):
+        update_server.client()
+        os.remove(settings.VERSION_FILE)
+        client = update_server.client()
+        assert 'if-none-match' not in update_server.server.requests[-1][1]
+        assert update_server.server.not_modified == 0
+        assert client.verified is True
+
+    def test_bad_version_file(self, update_server):
+        client = update_server.client()
+        assert client.verified is True
+        path = os.path.join(update_server.server.root, 'versions.gz')
+        with gzip.open(path, 'wb') as f:
+            f.write(json.dumps({'updates': {}, 'latest': {},
+                                'sigs': ['bad']}).encode('utf-8'))
+        client.refresh()
+        assert client.verified is False
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestSingleFlight(object):
+
+    @pytest.fixture
+    def lib_update(self, update_server):
+        data = os.urandom(1024 * 100)
+        filename = 'lib-mac-1.0.1.tar.gz'
+        with open(os.path.join(update_server.server.root, filename),
+                  'wb') as f:
+            f.write(data)
+        update_server.publish({
+            'updates': {'lib': {'1.0.1': {'mac': {
+                'filename': filename,
+                'file_hash': hashlib.sha256(data).hexdigest()}}}},
+            'latest': {'lib': {'mac': '1.0.1'}}})
+        return filename, data
+
+    def _file_requests(self, update_server, filename):
+        return [r for r in update_server.server.requests
+                if r[0] == '/' + filename]
+
+    def test_shared_call(self):
+        flights = SingleFlight()
+        calls = []
+        results = []
+
+        def func():
+            calls.append(1)
+            time.sleep(0.2)
+            return len(calls)
+
+        threads = [threading.Thread(
+            target=lambda: results.append(flights.do('key', func)))
+            for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert calls == [1]
+        assert results == [1] * 5
+        # Finished calls aren't reused
+        assert flights.do('key', func) == 2
+
+    def test_shared_error(self):
+        flights = SingleFlight()
+        errors = []
+
+        def func():
+            time.sleep(0.2)
+            raise ValueError('failed')
+
+        def call():
+            try:
+                flights.do('key', func)
+            except ValueError as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(errors) == 3
+        assert flights.running('key') is False
+
+    def test_concurrent_updates(self, update_server, lib_update):
+        filename, data = lib_update
+        client = update_server.client()
+        updates = [client.update_check('lib', '1.0.0') for _ in range(3)]
+        update_server.server.delay = 0.2
+        threads = [threading.Thread(target=u.download) for u in updates]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert all(u.status is True for u in updates)
+        # Size check & the download itself
+        assert len(self._file_requests(update_server, filename)) == 2
+        with open(os.path.join(client.update_folder, filename), 'rb') as f:
+            assert f.read() == data
+
+    def test_other_process_downloading(self, update_server, lib_update):
+        filename, data = lib_update
+        client = update_server.client()
+        update = client.update_check('lib', '1.0.0')
+        lock_path = os.path.join(client.data_dir,
+                                 settings.DOWNLOAD_LOCK_FOLDER, 'lib.lock')
+        os.makedirs(os.path.dirname(lock_path))
+        # Separate lock object acts like another process
+        with FileLock(lock_path):
+            update.download(background=True)
+            time.sleep(0.3)
+            assert self._file_requests(update_server, filename) == []
+            with open(os.path.join(client.update_folder, filename),
+                      'wb') as f:
+                f.write(data)
+        for _ in range(100):
+            if update.is_downloaded() is True:
+                break
+            time.sleep(0.05)
+        assert update.status is True
+        assert self._file_requests(update_server, filename) == []
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestBatch(object):
+
+    @pytest.fixture
+    def libs(self, update_server):
+        files = {}
+        updates = {}
+        latest = {}
+        for name, size in [('liba', 1024 * 50), ('libb', 1024 * 80),
+                           ('libc', 1024 * 20)]:
+            data = os.urandom(size)
+            filename = '{}-mac-1.0.1.tar.gz'.format(name)
+            with open(os.path.join(update_server.server.root, filename),
+                      'wb') as f:
+                f.write(data)
+            files[name] = (filename, data)
+            updates[name] = {'1.0.1': {'mac': {
+                'filename': filename,
+                'file_hash': hashlib.sha256(data).hexdigest()}}}
+            latest[name] = {'mac': '1.0.1'}
+        update_server.publish({'updates': updates, 'latest': latest})
+        return files
+
+    def test_update_all(self, update_server, libs):
+        client = update_server.client()
+        events = []
+        updates, results = client.update_all({'liba': '1.0.0',
+                                              'libb': '1.0.0',
+                                              'libc': '1.0.1',
+                                              'missing': '1.0.0'},
+                                             progress_hooks=[events.append])
+        assert results == {'liba': True, 'libb': True, 'libc': None,
+                           'missing': None}
+        assert updates['libc'] is None
+        assert updates['liba'].is_downloaded() is True
+        for name in ['liba', 'libb']:
+            filename, data = libs[name]
+            with open(os.path.join(client.update_folder, filename),
+                      'rb') as f:
+                assert f.read() == data
+        assert events[-1]['status'] == 'finished'
+        assert events[-1]['packages_total'] == 2
+        assert events[-1]['packages_done'] == 2
+        assert events[-1]['total'] == 1024 * 130
+        assert events[-1]['downloaded'] == 1024 * 130
+
+    def test_update_all_limits(self, update_server, libs, monkeypatch):
+        client = update_server.client()
+        events = []
+        client.add_call_back(events.append)
+        updates = dict((name, client.update_check(name, '1.0.0'))
+                       for name in ['liba', 'libb'])
+        segments = []
+        download = SegmentedDownloader.download_verify_write
+
+        def download_verify_write(fd):
+            segments.append(fd.segments)
+            # Hooks & limits of the batch aren't set on the update
+            # objects, which other threads may be using
+            for update in updates.values():
+                assert update.progress_hooks is client.progress_hooks
+                assert update.download_segments == \
+                    settings.DOWNLOAD_SEGMENTS
+            return download(fd)
+
+        monkeypatch.setattr(SegmentedDownloader, 'download_verify_write',
+                            download_verify_write)
+        results = BatchUpdater(updates).run()
+        assert all(results.values())
+        # Batch workers cap the number of requests
+        assert segments == [1, 1]
+        for update in updates.values():
+            assert update.progress_hooks is client.progress_hooks
+            assert update.download_segments == settings.DOWNLOAD_SEGMENTS
+        assert client.progress_hooks == [events.append]
+        assert events[-1]['status'] == 'finished'
+
+    def test_bytes_in_flight(self, update_server, libs, monkeypatch):
+        client = update_server.client(MAX_BYTES_IN_FLIGHT=1024 * 100)
+        update_server.server.delay = 0.1
+        peak = []
+        budget_acquire = ByteBudget.acquire
+
+        def acquire(budget, size):
+            taken = budget_acquire(budget, size)
+            peak.append(budget.in_flight)
+            return taken
+
+        monkeypatch.setattr(ByteBudget, 'acquire', acquire)
+        updates, results = client.update_all({'liba': '1.0.0',
+                                              'libb': '1.0.0',
+                                              'libc': '1.0.0'})
+        assert all(results.values())
+        # liba & libb don't fit together
+        assert max(peak) <= 1024 * 100
+
+    def test_download_saves_mirror_stats(self, update_server, libs):
+        client = update_server.client()
+        stats_file = os.path.join(client.data_dir,
+                                  settings.MIRROR_STATS_FILE)
+        # Saved by refresh from the version file download
+        assert os.path.exists(stats_file)
+        os.remove(stats_file)
+        update = client.update_check('liba', '1.0.0')
+        assert update.download() is True
+        with open(stats_file, 'r') as f:
+            stats = json.load(f)
+        assert stats[update_server.url]['latency'] is not None
+
+    def test_batch_busy_update(self, update_server, libs):
+        client = update_server.client()
+        update = client.update_check('liba', '1.0.0')
+        # Already downloading somewhere else
+        update._start_download()
+        assert BatchUpdater({'liba': update}).run() == {'liba': False}
+
+    def test_byte_budget(self):
+        budget = ByteBudget(100)
+        assert budget.acquire(60) == 60
+        started = []
+        t = threading.Thread(target=lambda: started.append(
+            budget.acquire(60)))
+        t.start()
+        time.sleep(0.2)
+        assert started == []
+        budget.release(60)
+        t.join(2)
+        assert started == [60]
+        # Bigger than the whole budget runs alone
+        budget.release(60)
+        assert budget.acquire(500) == 100
+        assert ByteBudget().acquire(500) == 0
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestPatchUpdate(object):
+
+    @pytest.fixture
+    def patch_chain(self, update_server):
+        # lib 1.0.0 to 1.0.3 with a patch to each version
+        data = os.urandom(1024 * 100)
+        files = []
+        updates = {}
+        previous = None
+        for i in range(4):
+            if previous is not None:
+                data = data[:i * 1000] + os.urandom(100) + \
+                    data[i * 1000 + 100:]
+            filename = 'lib-mac-1.0.{}.zip'.format(i)
+            with open(os.path.join(update_server.server.root, filename),
+                      'wb') as f:
+                f.write(data)
+            info = {'filename': filename,
+                    'file_hash': hashlib.sha256(data).hexdigest()}
+            if previous is not None:
+                patch = bsdiff4.diff(previous, data)
+                info['patch_name'] = 'lib-mac-{}'.format(i)
+                info['patch_hash'] = hashlib.sha256(patch).hexdigest()
+                with open(os.path.join(update_server.server.root,
+                                       info['patch_name']), 'wb') as f:
+                    f.write(patch)
+            updates['1.0.{}.2.0'.format(i)] = {'mac': info}
+            files.append((filename, data))
+            previous = data
+        self.updates = updates
+        update_server.publish({'updates': {'lib': updates},
+                               'latest': {'lib': {'mac': '1.0.3.2.0'}}})
+        return files
+
+    def _install(self, client, files):
+        filename, data = files[0]
+        with open(os.path.join(client.update_folder, filename), 'wb') as f:
+            f.write(data)
+
+    def test_patch_chain(self, update_server, patch_chain):
+        client = update_server.client()
+        self._install(client, patch_chain)
+        update = client.update_check('lib', '1.0.0')
+        assert update.download() is True
+        filename, data = patch_chain[-1]
+        with open(os.path.join(client.update_folder, filename), 'rb') as f:
+            assert f.read() == data
+        paths = [r[0] for r in update_server.server.requests]
+        assert '/' + filename not in paths
+        assert ['/lib-mac-1', '/lib-mac-2', '/lib-mac-3'] == \
+            sorted(p for p in paths if p.startswith('/lib-mac-')
+                   and not p.endswith('.zip'))
+        # Patches & patched binaries are cleaned up
+        assert sorted(os.listdir(client.update_folder)) == \
+            [patch_chain[0][0], filename]
+
+    def test_patch_client_platform(self, update_server, patch_chain,
+                                   monkeypatch):
+        # The version file only has mac patches. Patches are looked up
+        # for the platform of the client, not of the system
+        monkeypatch.setattr('pyupdater.client.patcher._platform', 'win')
+        client = update_server.client()
+        self._install(client, patch_chain)
+        update = client.update_check('lib', '1.0.0')
+        assert update.download() is True
+        paths = [r[0] for r in update_server.server.requests]
+        assert '/' + patch_chain[-1][0] not in paths
+        assert '/lib-mac-3' in paths
+
+    def test_batch_patch_budget(self, update_server, patch_chain,
+                                monkeypatch):
+        sizes = []
+        for version in sorted(self.updates)[1:]:
+            info = self.updates[version]['mac']
+            path = os.path.join(update_server.server.root,
+                                info['patch_name'])
+            info['patch_size'] = os.path.getsize(path)
+            sizes.append(info['patch_size'])
+        update_server.publish({'updates': {'lib': self.updates},
+                               'latest': {'lib': {'mac': '1.0.3.2.0'}}})
+        client = update_server.client(MAX_BYTES_IN_FLIGHT=1024 * 1024)
+        self._install(client, patch_chain)
+        taken = []
+        budget_acquire = ByteBudget.acquire
+
+        def acquire(budget, size):
+            taken.append(size)
+            return budget_acquire(budget, size)
+
+        monkeypatch.setattr(ByteBudget, 'acquire', acquire)
+        updates, results = client.update_all({'lib': '1.0.0'})
+        assert results == {'lib': True}
+        # Each patch takes its own size, not the size of the archive
+        assert taken == sizes
+
+    def test_apply_while_downloading(self, update_server, patch_chain,
+                                     monkeypatch):
+        client = update_server.client(MAX_CONCURRENT_DOWNLOADS=1)
+        self._install(client, patch_chain)
+        update = client.update_check('lib', '1.0.0')
+        update_server.server.delay = 0.2
+        applied = []
+        apply_patch = Patcher._apply_patch
+
+        def record(patcher, source, patch_path, index):
+            patches = [r for r in update_server.server.requests
+                       if r[0].startswith('/lib-mac-') and
+                       not r[0].endswith('.zip')]
+            applied.append(len(patches))
+            return apply_patch(patcher, source, patch_path, index)
+
+        monkeypatch.setattr(Patcher, '_apply_patch', record)
+        assert update.download() is True
+        assert len(applied) == 3
+        # First patch was applied before the last one was downloaded
+        assert applied[0] < 3
+
+    def test_resume_patch(self, update_server, patch_chain):
+        client = update_server.client()
+        self._install(client, patch_chain)
+        update = client.update_check('lib', '1.0.0')
+        # Left behind by an update that was interrupted while
+        # downloading patches
+        folder = get_patch_folder(client.update_folder, 'lib')
+        os.makedirs(folder)
+        with open(os.path.join(update_server.server.root, 'lib-mac-1'),
+                  'rb') as f:
+            patch = f.read()
+        with open(os.path.join(folder, 'lib-mac-1'), 'wb') as f:
+            f.write(patch)
+        with open(os.path.join(update_server.server.root, 'lib-mac-2'),
+                  'rb') as f:
+            patch = f.read()
+        temp = os.path.join(folder, 'lib-mac-2' + settings.DOWNLOAD_TEMP_EXT)
+        with open(temp, 'wb') as f:
+            f.write(patch[:100])
+        with open(temp + settings.DOWNLOAD_INFO_EXT, 'w') as f:
+            json.dump({'url': update_server.url, 'offset': 100,
+                       'file_hash': self.updates['1.0.2.2.0']['mac'][
+                           'patch_hash']}, f)
+
+        assert update.download() is True
+        filename, data = patch_chain[-1]
+        with open(os.path.join(client.update_folder, filename), 'rb') as f:
+            assert f.read() == data
+        requests = dict((r[0], r[1].get('range'))
+                        for r in update_server.server.requests)
+        # Downloaded patch is reused & the partial one resumed
+        assert '/lib-mac-1' not in requests
+        assert requests['/lib-mac-2'] == 'bytes=100-'
+        assert requests['/lib-mac-3'] is None
+        assert sorted(os.listdir(client.update_folder)) == \
+            [patch_chain[0][0], filename]
+
+    def test_failed_patch_stops_downloads(self, update_server, patch_chain,
+                                          monkeypatch):
+        # Patch 1 fails its hash check while patch 2 is still
+        # downloading
+        with open(os.path.join(update_server.server.root, 'lib-mac-1'),
+                  'ab') as f:
+            f.write(b'bad')
+        update_server.server.delays['/lib-mac-2'] = 0.5
+        client = update_server.client(MAX_CONCURRENT_DOWNLOADS=3)
+        self._install(client, patch_chain)
+        update = client.update_check('lib', '1.0.0')
+        downloads = {}
+        returned = []
+        download_patch = Patcher._download_patch
+        start = Patcher.start
+
+        def record_download(patcher, patch):
+            path = download_patch(patcher, patch)
+            downloads[patch['patch_name']] = (path, time.time())
+            return path
+
+        def record_start(patcher):
+            result = start(patcher)
+            returned.append((result, time.time(), patcher.work_dir))
+            return result
+
+        monkeypatch.setattr(Patcher, '_download_patch', record_download)
+        monkeypatch.setattr(Patcher, 'start', record_start)
+        assert update.download() is True
+        result, end, work_dir = returned[0]
+        assert result is False
+        # Every download finished before the patch dir was removed
+        assert sorted(downloads) == ['lib-mac-1', 'lib-mac-2', 'lib-mac-3']
+        assert max(t for _, t in downloads.values()) <= end
+        assert os.path.exists(work_dir) is False
+        # Patch 2 was cancelled
+        assert downloads['lib-mac-1'][0] is None
+        assert downloads['lib-mac-2'][0] is None
+
+    def test_bad_patch_full_update(self, update_server, patch_chain):
+        path = os.path.join(update_server.server.root, 'lib-mac-2')
+        with open(path, 'rb') as f:
+            patch = f.read()
+        # Patch that can't be applied but passes the hash check
+        patch = patch[:40] + b'bad' + patch[43:]
+        with open(path, 'wb') as f:
+            f.write(patch)
+        self.updates['1.0.2.2.0']['mac']['patch_hash'] = \
+            hashlib.sha256(patch).hexdigest()
+        update_server.publish({'updates': {'lib': self.updates},
+                               'latest': {'lib': {'mac': '1.0.3.2.0'}}})
+        client = update_server.client()
+        self._install(client, patch_chain)
+        update = client.update_check('lib', '1.0.0')
+        assert update.download() is True
+        filename, data = patch_chain[-1]
+        with open(os.path.join(client.update_folder, filename), 'rb') as f:
+            assert f.read() == data
+        assert '/' + filename in [r[0] for r in
+                                  update_server.server.requests]
+        assert sorted(os.listdir(client.update_folder)) == \
+            [patch_chain[0][0], filename]
+
+    def test_sizes_choose_full_update(self, update_server, patch_chain):
+        # Patches bigger than the archive they make
+        for version, platforms in self.updates.items():
+            info = platforms['mac']
+            info['file_size'] = 1000
+            if 'patch_name' in info:
+                info['patch_size'] = 600
+        update_server.publish({'updates': {'lib': self.updates},
+                               'latest': {'lib': {'mac': '1.0.3.2.0'}}})
+        client = update_server.client()
+        self._install(client, patch_chain)
+        update = client.update_check('lib', '1.0.0')
+        assert update.download() is True
+        filename, data = patch_chain[-1]
+        paths = [r[0] for r in update_server.server.requests]
+        assert '/' + filename in paths
+        assert [p for p in paths if p.startswith('/lib-mac-')
+                and not p.endswith('.zip')] == []
+
+    def _add_skip_patch(self, update_server, files, base, size=None):
+        # Direct patch from files[base] to the last version
+        patch = bsdiff4.diff(files[base][1], files[-1][1])
+        patch_name = 'lib-mac-3-from-{}'.format(base)
+        with open(os.path.join(update_server.server.root, patch_name),
+                  'wb') as f:
+            f.write(patch)
+        info = self.updates['1.0.3.2.0']['mac']
+        info.setdefault('skip_patches', {})['1.0.{}.2.0'.format(base)] = {
+            'patch_name': patch_name,
+            'patch_hash': hashlib.sha256(patch).hexdigest(),
+            'patch_size': size or len(patch)}
+        update_server.publish({'updates': {'lib': self.updates},
+                               'latest': {'lib': {'mac': '1.0.3.2.0'}}})
+        return '/' + patch_name
+
+    def _patch_requests(self, update_server):
+        return sorted(r[0] for r in update_server.server.requests
+                      if r[0].startswith('/lib-mac-') and
+                      not r[0].endswith('.zip'))
+
+    def test_skip_ahead_patch(self, update_server, patch_chain):
+        path = self._add_skip_patch(update_server, patch_chain, 0)
+        client = update_server.client()
+        self._install(client, patch_chain)
+        update = client.update_check('lib', '1.0.0')
+        assert update.download() is True
+        filename, data = patch_chain[-1]
+        with open(os.path.join(client.update_folder, filename), 'rb') as f:
+            assert f.read() == data
+        assert self._patch_requests(update_server) == [path]
+
+    def test_skip_ahead_patch_cheapest_path(self, update_server,
+                                            patch_chain):
+        for version, platforms in self.updates.items():
+            info = platforms['mac']
+            info['file_size'] = 100000
+            if 'patch_name' in info:
+                info['patch_size'] = 500
+        # Skips the whole chain but costs more than it
+        self._add_skip_patch(update_server, patch_chain, 0, size=50000)
+        path = self._add_skip_patch(update_server, patch_chain, 1)
+        client = update_server.client()
+        self._install(client, patch_chain)
+        update = client.update_check('lib', '1.0.0')
+        assert update.download() is True
+        assert self._patch_requests(update_server) == ['/lib-mac-1', path]
+
+
+    def test_patch_format(self, update_server, patch_chain):
+        # Chain remade with block-delta patches
+        engine = get_engine('block-delta')
+        for i in range(1, 4):
+            patch = engine.diff(patch_chain[i - 1][1], patch_chain[i][1])
+            info = self.updates['1.0.{}.2.0'.format(i)]['mac']
+            info['patch_hash'] = hashlib.sha256(patch).hexdigest()
+            info['patch_format'] = 'block-delta'
+            with open(os.path.join(update_server.server.root,
+                                   info['patch_name']), 'wb') as f:
+                f.write(patch)
+        update_server.publish({'updates': {'lib': self.updates},
+                               'latest': {'lib': {'mac': '1.0.3.2.0'}}})
+        client = update_server.client()
+        self._install(client, patch_chain)
+        update = client.update_check('lib', '1.0.0')
+        assert update.download() is True
+        filename, data = patch_chain[-1]
+        with open(os.path.join(client.update_folder, filename), 'rb') as f:
+            assert f.read() == data
+        assert len(self._patch_requests(update_server)) == 3
+
+    def test_unknown_patch_format(self, update_server, patch_chain):
+        self.updates['1.0.2.2.0']['mac']['patch_format'] = 'unknown'
+        update_server.publish({'updates': {'lib': self.updates},
+                               'latest': {'lib': {'mac': '1.0.3.2.0'}}})
+        client = update_server.client()
+        self._install(client, patch_chain)
+        update = client.update_check('lib', '1.0.0')
+        assert update.download() is True
+        filename, data = patch_chain[-1]
+        assert '/' + filename in [r[0] for r in
+                                  update_server.server.requests]
+        assert self._patch_requests(update_server) == []
+
+
+class TestPlanner(object):
+
+    def test_no_sizes(self):
+        assert choose_patch_update('lib', None, [10, 10]) is True
+        assert choose_patch_update('lib', 1000, [10, None]) is True
+
+    def test_small_patches(self):
+        assert choose_patch_update('lib', 1000, [10, 20, 30]) is True
+
+    def test_big_patches(self):
+        assert choose_patch_update('lib', 1000, [500, 600]) is False
+
+    def test_patch_cost(self):
+        assert patch_cost(100, 1000, apply_cost=0.1) == 200
+        # Chains are compared with the cost the patcher picks them by
+        assert choose_patch_update('lib', 1000, [100] * 4,
+                                   apply_cost=0.1) is True
+        assert choose_patch_update('lib', 1000, [100] * 5,
+                                   apply_cost=0.1) is False
+
+    def test_apply_cost(self):
+        # 3 * 100 bytes of patches + 3 * 250 to apply them
+        assert choose_patch_update('lib', 1000, [100] * 3,
+                                   apply_cost=0) is True
+        assert choose_patch_update('lib', 1000, [100] * 3,
+                                   apply_cost=0.25) is False
+
+    def test_long_chain_tiny_patches(self):
+        full_size = 100 * 1024 * 1024
+        assert choose_patch_update('lib', full_size, [1000] * 30) is True
+        assert choose_patch_update('lib', full_size, [1000] * 100,
+                                   patch_formats=['block-delta'] *
+                                   100) is True
+        # Every patch makes the whole archive again
+        assert choose_patch_update('lib', full_size, [1000] * 60) is False
+
+    def test_measured_apply_cost(self, monkeypatch):
+        speed = settings.PATCH_DOWNLOAD_SPEED
+        assert get_apply_cost('bsdiff4') == \
+            float(speed) / get_engine('bsdiff4').apply_speed
+        assert get_apply_cost('block-delta') < get_apply_cost('bsdiff4')
+        assert get_apply_cost('bsdiff4', apply_cost=0.5) == 0.5
+        # Pure python patcher is slower
+        c_cost = get_apply_cost('bsdiff4')
+        monkeypatch.setattr(diff_engines, 'bsdiff4', None)
+        assert get_apply_cost('bsdiff4') > c_cost
+        assert patch_cost(100, 1000, patch_format='block-delta') == \
+            100 + int(1000 * get_apply_cost('block-delta'))
@@ -0,0 +1,275 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import io
+import json
+import mmap
+import os
+import struct
+import tarfile
+import time
+import zipfile
+import zlib
+
+import pytest
+
+from pyupdater.utils import diff_engines
+from pyupdater.utils.diff_engines import (ArchiveDeltaEngine,
+                                          BlockDeltaEngine,
+                                          DiffEngine,
+                                          get_engine,
+                                          get_patch_formats,
+                                          register_engine)
+from pyupdater.utils.parallel_gzip import ParallelGzipWriter
+
+FORMATS = ['bsdiff4', 'bsdiff4-lzma', 'block-delta', 'archive-delta']
+
+
+def make_release(size=20000):
+    source = os.urandom(size)
+    target = source[:1000] + os.urandom(300) + source[1000:size // 2] + \
+        source[size // 2 + 500:] + b'new' * 100
+    return source, target
+
+
+def make_archive(kind, files):
+    data = io.BytesIO()
+    if kind == 'zip':
+        with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name in sorted(files):
+                zf.writestr(name, files[name])
+            zf.writestr(zipfile.ZipInfo('stored'), b'stored' * 100)
+    elif kind == 'pgztar':
+        with ParallelGzipWriter(data, block_size=16 * 1024) as gz:
+            add_files(tarfile.open(fileobj=gz, mode='w'), files)
+    else:
+        add_files(tarfile.open(fileobj=data, mode='w:gz'), files)
+    return data.getvalue()
+
+
+def add_files(tar, files):
+    with tar:
+        for name in sorted(files):
+            info = tarfile.TarInfo(name)
+            info.size = len(files[name])
+            info.mtime = len(files)
+            tar.addfile(info, io.BytesIO(files[name]))
+
+
+def make_archives(kind):
+    # Members are random so they don't compress
+    files = dict(('lib/mod{}.so'.format(i), os.urandom(20000))
+                 for i in range(10))
+    old = make_archive(kind, files)
+    files['lib/mod3.so'] = files['lib/mod3.so'][:5000] + b'changed' + \
+        files['lib/mod3.so'][5000:]
+    files['lib/new.so'] = b'new' * 100
+    del files['lib/mod5.so']
+    return old, make_archive(kind, files)
+
+
+def patch_info(patch):
+    size = struct.unpack(str('<I'), patch[8:12])[0]
+    return json.loads(patch[20:20 + size].decode('utf-8'))
+
+
+def get_diff_engine(name):
+    engine = get_engine(name)
+    if engine.can_diff() is False:
+        pytest.skip('Cannot make {} patches here'.format(name))
+    return engine
+
+
+class _SliceRecorder(object):
+    # Bytes that keep the size of every slice taken
+
+    def __init__(self, data):
+        self.data = data
+        self.slices = []
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        data = self.data[key]
+        self.slices.append(len(data))
+        return data
+
+    def find(self, sub, start=0):
+        return self.data.find(sub, start)
+
+
+class TestDiffEngines(object):
+
+    @pytest.mark.parametrize('name', FORMATS)
+    def test_round_trip(self, name):
+        engine = get_diff_engine(name)
+        source, target = make_release()
+        patch = engine.diff(source, target)
+        assert engine.patch(source, patch) == target
+        assert engine.patch(target, engine.diff(target, b'')) == b''
+
+    @pytest.mark.parametrize('name', FORMATS)
+    def test_file_diff(self, name, tmpdir):
+        engine = get_diff_engine(name)
+        source, target = make_release()
+        paths = [str(tmpdir.join(n)) for n in ['src', 'dst', 'patch']]
+        for path, data in zip(paths, [source, target]):
+            with open(path, 'wb') as f:
+                f.write(data)
+        engine.file_diff(*paths)
+        with open(paths[2], 'rb') as f:
+            assert engine.patch(source, f.read()) == target
+
+    @pytest.mark.parametrize('name', FORMATS)
+    def test_patch_into_mmap(self, name, tmpdir):
+        engine = get_diff_engine(name)
+        source, target = make_release()
+        paths = [str(tmpdir.join(n)) for n in ['src', 'patch']]
+        for path, data in zip(paths, [source, engine.diff(source, target)]):
+            with open(path, 'wb') as f:
+                f.write(data)
+        maps = []
+        try:
+            for path in paths:
+                with open(path, 'rb') as f:
+                    maps.append(mmap.mmap(f.fileno(), 0,
+                                          access=mmap.ACCESS_READ))
+            output = io.BytesIO()
+            engine.patch_into(maps[0], maps[1], output)
+            assert output.getvalue() == target
+        finally:
+            for m in maps:
+                m.close()
+
+    @pytest.mark.parametrize('name', FORMATS)
+    def test_corrupt_patch(self, name):
+        engine = get_diff_engine(name)
+        source, target = make_release()
+        patch = engine.diff(source, target)
+        with pytest.raises(ValueError):
+            engine.patch(source, b'BADMAGIC' + patch[8:])
+
+    def test_block_delta_finds_moved_blocks(self):
+        engine = BlockDeltaEngine(block_size=512)
+        source = os.urandom(100000)
+        # Blocks moved to offsets that aren't multiples of block_size
+        target = b'x' + source[50000:] + b'yy' + source[:50000]
+        patch = engine.diff(source, target)
+        assert len(patch) < 1000
+        assert engine.patch(source, patch) == target
+
+    def test_block_delta_new_data_speed(self):
+        # New data is skipped over instead of looked up at every byte.
+        # Looking up every byte took 5 to 8 seconds
+        engine = get_engine('block-delta')
+        source = os.urandom(16 * 1024 * 1024)
+        target = os.urandom(16 * 1024 * 1024) + source[:1024 * 1024]
+        start = time.time()
+        patch = engine.diff(source, target)
+        assert time.time() - start < 3
+        assert engine.patch(source, patch) == target
+
+    def test_block_delta_cut_off(self):
+        engine = get_engine('block-delta')
+        source, target = make_release()
+        patch = engine.diff(source, target)
+        with pytest.raises(ValueError):
+            engine.patch(source, patch[:-20])
+        with pytest.raises(ValueError):
+            engine.patch(source[:5000], patch)
+
+    def test_formats(self):
+        formats = get_patch_formats()
+        assert 'bsdiff4' in formats
+        assert 'block-delta' in formats
+        assert get_engine('unknown') is None
+
+    def test_register(self):
+
+        class Reverse(DiffEngine):
+            name = 'test-reverse'
+
+            def diff(self, source, target):
+                return target[::-1]
+
+            def patch(self, source, patch):
+                return patch[::-1]
+
+        register_engine(Reverse())
+        assert 'test-reverse' in get_patch_formats()
+        engine = get_engine('test-reverse')
+        assert engine.patch(b'', engine.diff(b'', b'abc')) == b'abc'
+
+
+class TestArchiveDelta(object):
+
+    @pytest.mark.parametrize('kind', ['gztar', 'pgztar', 'zip'])
+    def test_members(self, kind):
+        engine = get_diff_engine('archive-delta')
+        old, new = make_archives(kind)
+        patch = engine.diff(old, new)
+        assert engine.patch(old, patch) == new
+        assert patch_info(patch)['container'] in ('gzip', 'zip')
+        # Only the changed & added members are in the patch
+        assert len(patch) < 2000
+
+    def test_smaller_than_compressed_diff(self):
+        engine = get_diff_engine('archive-delta')
+        old, new = make_archives('gztar')
+        bsdiff_patch = get_engine('bsdiff4').diff(old, new)
+        assert len(engine.diff(old, new)) * 20 < len(bsdiff_patch)
+
+    def test_not_reproducible(self):
+        engine = get_diff_engine('archive-delta')
+        old, new = make_archives('gztar')
+        # Compression settings the patcher doesn't try
+        raw = zlib.decompress(new, 16 + zlib.MAX_WBITS)
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                      8, zlib.Z_HUFFMAN_ONLY)
+        deflated = compressor.compress(raw) + compressor.flush()
+        new = new[:10] + deflated + new[-8:]
+        patch = engine.diff(old, new)
+        assert patch_info(patch)['container'] == 'raw'
+        assert engine.patch(old, patch) == new
+
+    def test_member_engine(self):
+        engine = ArchiveDeltaEngine(engine='block-delta')
+        old, new = make_archives('zip')
+        patch = engine.diff(old, new)
+        assert patch_info(patch)['engine'] == 'block-delta'
+        assert get_engine('archive-delta').patch(old, patch) == new
+
+    @pytest.mark.parametrize('kind', ['gztar', 'pgztar', 'zip'])
+    def test_patch_streams_source(self, kind, monkeypatch):
+        engine = get_diff_engine('archive-delta')
+        old, new = make_archives(kind)
+        patch = engine.diff(old, new)
+        monkeypatch.setattr(diff_engines, '_PATCH_CHUNK_SIZE', 4096)
+        source = _SliceRecorder(old)
+        output = io.BytesIO()
+        engine.patch_into(source, patch, output)
+        assert output.getvalue() == new
+        # The old archive is read a chunk at a time
+        assert 0 < max(source.slices) <= 4096
+
+    def test_wrong_source(self):
+        engine = get_diff_engine('archive-delta')
+        old, new = make_archives('gztar')
+        patch = engine.diff(old, new)
+        with pytest.raises(ValueError):
+            engine.patch(b'not an archive', patch)
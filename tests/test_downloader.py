@@ -15,9 +15,21 @@
 # --------------------------------------------------------------------------
 from __future__ import unicode_literals
 
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+
 import pytest
 
-from pyupdater.client.downloader import FileDownloader
+from pyupdater import settings
+from pyupdater.client.downloader import (FileDownloader,
+                                         get_http_pool,
+                                         SegmentedDownloader)
+from pyupdater.client.retry import CircuitBreaker, RetryPolicy
+from pyupdater.client.throttle import ByteBudget, RateLimiter
 
 
 FILENAME = 'dont+delete+pyu+test.txt'
@@ -73,3 +85,544 @@ class TestContentLength(object):
         fd = FileDownloader(FILENAME, URL, FILE_HASH)
         fd.download_verify_return()
         assert fd.content_length == 60000
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestStreaming(object):
+
+    def test_write(self, http_server, served_file):
+        file_hash, data = served_file
+        fd = FileDownloader('app.tar.gz', http_server.url, file_hash)
+        assert fd.download_verify_write() is True
+        with open('app.tar.gz', 'rb') as f:
+            assert f.read() == data
+        assert os.listdir(os.getcwd()) == ['app.tar.gz']
+
+    def test_write_directory(self, http_server, served_file):
+        file_hash, data = served_file
+        os.mkdir('update')
+        fd = FileDownloader('app.tar.gz', http_server.url, file_hash,
+                            directory='update')
+        assert fd.download_verify_write() is True
+        with open(os.path.join('update', 'app.tar.gz'), 'rb') as f:
+            assert f.read() == data
+        assert os.listdir(os.getcwd()) == ['update']
+
+    def test_write_bad_hash(self, http_server, served_file):
+        fd = FileDownloader('app.tar.gz', http_server.url, 'bad hash')
+        assert fd.download_verify_write() is False
+        assert os.listdir(os.getcwd()) == []
+
+    def test_progress_events(self, http_server, served_file):
+        file_hash, data = served_file
+        events = []
+
+        class SmallBlockDownloader(FileDownloader):
+            @staticmethod
+            def _best_block_size(elapsed_time, bytes):
+                return 1024
+
+        fd = SmallBlockDownloader('app.tar.gz', http_server.url, file_hash,
+                                  progress_hooks=[events.append])
+        assert fd.download_verify_write() is True
+        # One event per block would be 300 events
+        assert len(events) < 20
+        assert events[-1]['status'] == 'finished'
+        assert events[-1]['downloaded'] == len(data)
+        assert events[-1]['bytes_per_sec'] > 0
+
+    def test_block_reader(self):
+        class FakeResponse(object):
+            def __init__(self, data, headers={}):
+                self.headers = headers
+                self._fp = io.BytesIO(data)
+
+            def read(self, size):
+                return self._fp.read(size)
+
+        read = FileDownloader._block_reader(FakeResponse(b'a' * 60 +
+                                                         b'b' * 40))
+        first = read(60)
+        assert first.tobytes() == b'a' * 60
+        second = read(60)
+        assert second.tobytes() == b'b' * 40
+        # Blocks share one buffer
+        assert first[:40].tobytes() == b'b' * 40
+        assert len(read(60)) == 0
+
+        # Encoded bodies need urllib3 to decode them
+        response = FakeResponse(b'data', {'content-encoding': 'gzip'})
+        assert FileDownloader._block_reader(response) == response.read
+
+    def test_write_missing_file(self, http_server):
+        fd = FileDownloader('missing.tar.gz', 'bad url', None)
+        assert fd.download_verify_write() is False
+        assert os.listdir(os.getcwd()) == []
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestResume(object):
+
+    @pytest.fixture
+    def partial_file(self, http_server, served_file):
+        file_hash, data = served_file
+        temp_filename = 'app.tar.gz' + settings.DOWNLOAD_TEMP_EXT
+        with open(temp_filename, 'wb') as f:
+            f.write(data[:1000])
+        info = {'url': http_server.url, 'file_hash': file_hash,
+                'offset': 1000}
+        with open(temp_filename + settings.DOWNLOAD_INFO_EXT, 'w') as f:
+            f.write(json.dumps(info))
+        return file_hash, data
+
+    def test_resume(self, http_server, partial_file):
+        file_hash, data = partial_file
+        fd = FileDownloader('app.tar.gz', http_server.url, file_hash)
+        assert fd.download_verify_write() is True
+        assert http_server.requests[0][1]['range'] == 'bytes=1000-'
+        with open('app.tar.gz', 'rb') as f:
+            assert f.read() == data
+        assert os.listdir(os.getcwd()) == ['app.tar.gz']
+
+    def test_resume_ranges_not_supported(self, http_server, partial_file):
+        http_server.ranges = False
+        file_hash, data = partial_file
+        fd = FileDownloader('app.tar.gz', http_server.url, file_hash)
+        assert fd.download_verify_write() is True
+        with open('app.tar.gz', 'rb') as f:
+            assert f.read() == data
+
+    def test_resume_different_file(self, http_server, partial_file):
+        file_hash, data = partial_file
+        with open(os.path.join(http_server.root, 'app.tar.gz'), 'wb') as f:
+            f.write(data[:2000])
+        new_hash = hashlib.sha256(data[:2000]).hexdigest()
+        fd = FileDownloader('app.tar.gz', http_server.url, new_hash)
+        assert fd.download_verify_write() is True
+        assert 'range' not in http_server.requests[0][1]
+
+    def test_interrupted_download_resumes(self, http_server, partial_file):
+        file_hash, data = partial_file
+        temp_filename = 'app.tar.gz' + settings.DOWNLOAD_TEMP_EXT
+        os.remove(temp_filename)
+
+        class FlakyDownloader(FileDownloader):
+            def _call_progress_hooks(self, status):
+                if status['status'] == 'downloading':
+                    raise IOError('Connection dropped')
+
+        fd = FlakyDownloader('app.tar.gz', http_server.url, file_hash)
+        assert fd.download_verify_write() is False
+        assert os.path.exists(temp_filename)
+        with open(temp_filename + settings.DOWNLOAD_INFO_EXT, 'r') as f:
+            offset = json.load(f)['offset']
+        assert offset == os.path.getsize(temp_filename) > 0
+
+        fd = FileDownloader('app.tar.gz', http_server.url, file_hash)
+        assert fd.download_verify_write() is True
+        assert http_server.requests[-1][1]['range'] == \
+            'bytes={}-'.format(offset)
+        with open('app.tar.gz', 'rb') as f:
+            assert f.read() == data
+
+    def _resume_info(self):
+        temp_filename = 'app.tar.gz' + settings.DOWNLOAD_TEMP_EXT
+        with open(temp_filename + settings.DOWNLOAD_INFO_EXT, 'r') as f:
+            return os.path.getsize(temp_filename), json.load(f)
+
+    def test_offline_keeps_partial_file(self, http_server, partial_file):
+        file_hash, data = partial_file
+        fd = FileDownloader('app.tar.gz', 'http://127.0.0.1:1/', file_hash,
+                            retry_policy=RetryPolicy(0))
+        assert fd.download_verify_write() is False
+        size, info = self._resume_info()
+        assert size == info['offset'] == 1000
+        assert info['url'] == http_server.url
+
+        fd = FileDownloader('app.tar.gz', http_server.url, file_hash)
+        assert fd.download_verify_write() is True
+        assert http_server.requests[0][1]['range'] == 'bytes=1000-'
+
+    def test_closed_early_keeps_partial_file(self, http_server,
+                                             partial_file):
+        file_hash, data = partial_file
+        http_server.cuts = [100000]
+        fd = FileDownloader('app.tar.gz', http_server.url, file_hash,
+                            retry_policy=RetryPolicy(0))
+        assert fd.download_verify_write() is False
+        size, info = self._resume_info()
+        assert size == info['offset'] == 101000
+
+        fd = FileDownloader('app.tar.gz', http_server.url, file_hash)
+        assert fd.download_verify_write() is True
+        assert http_server.requests[-1][1]['range'] == 'bytes=101000-'
+        with open('app.tar.gz', 'rb') as f:
+            assert f.read() == data
+        assert os.listdir(os.getcwd()) == ['app.tar.gz']
+
+    def test_cancel_keeps_partial_file(self, http_server, partial_file):
+        file_hash, data = partial_file
+        cancel = threading.Event()
+
+        def hook(status):
+            if status['status'] == 'downloading':
+                cancel.set()
+
+        fd = FileDownloader('app.tar.gz', http_server.url, file_hash,
+                            progress_hooks=[hook], cancel=cancel)
+        assert fd.download_verify_write() is False
+        size, info = self._resume_info()
+        assert 1000 < size == info['offset'] < len(data)
+        assert len(http_server.requests) == 1
+
+
+class _RecordingBudget(ByteBudget):
+    # Keeps the size of every download that took from the budget
+
+    def __init__(self, max_bytes=None):
+        super(_RecordingBudget, self).__init__(max_bytes)
+        self.taken = []
+
+    def acquire(self, size):
+        self.taken.append(size)
+        return super(_RecordingBudget, self).acquire(size)
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestSegmented(object):
+
+    @pytest.fixture
+    def mirrored_file(self, http_server, served_file, monkeypatch):
+        monkeypatch.setattr(settings, 'SEGMENTED_DOWNLOAD_MIN_SIZE', 1024)
+        urls = [http_server.url,
+                http_server.url.replace('127.0.0.1', 'localhost')]
+        return (urls,) + served_file
+
+    def test_segmented(self, http_server, mirrored_file):
+        urls, file_hash, data = mirrored_file
+        fd = SegmentedDownloader('app.tar.gz', urls, file_hash, segments=4)
+        assert fd.download_verify_write() is True
+        with open('app.tar.gz', 'rb') as f:
+            assert f.read() == data
+        assert os.listdir(os.getcwd()) == ['app.tar.gz']
+        hosts = set([r[1]['host'] for r in http_server.requests])
+        assert len(hosts) == 2
+        assert len(http_server.requests) > 4
+
+    def test_segmented_directory(self, mirrored_file):
+        urls, file_hash, data = mirrored_file
+        os.mkdir('update')
+        fd = SegmentedDownloader('app.tar.gz', urls, file_hash, segments=4,
+                                 directory='update')
+        assert fd.download_verify_write() is True
+        assert os.listdir('update') == ['app.tar.gz']
+        assert os.listdir(os.getcwd()) == ['update']
+
+    def test_segment_size(self, http_server, mirrored_file, monkeypatch):
+        urls, file_hash, data = mirrored_file
+        monkeypatch.setattr(settings, 'SEGMENTED_DOWNLOAD_MIN_SIZE',
+                            len(data))
+        fd = SegmentedDownloader('app.tar.gz', urls, file_hash, segments=2)
+        assert fd.download_verify_write() is True
+        # Size request & segments no smaller than the min size split
+        # over the segments asked for
+        assert len(http_server.requests) == 3
+
+    def test_segmented_byte_budget(self, mirrored_file):
+        urls, file_hash, data = mirrored_file
+        budget = _RecordingBudget(1024 * 1024)
+        fd = SegmentedDownloader('app.tar.gz', urls, file_hash, segments=4,
+                                 byte_budget=budget)
+        assert fd.download_verify_write() is True
+        # Each segment takes its own size
+        assert len(budget.taken) > 1
+        assert sum(budget.taken) == len(data)
+        assert budget.in_flight == 0
+
+    def test_whole_byte_budget(self, http_server, mirrored_file):
+        urls, file_hash, data = mirrored_file
+        budget = _RecordingBudget(1024 * 1024)
+        fd = SegmentedDownloader('app.tar.gz', urls, file_hash, segments=1,
+                                 byte_budget=budget)
+        assert fd.download_verify_write() is True
+        # Size of the file is asked from the server
+        assert budget.taken == [len(data)]
+        assert http_server.requests[0][1]['range'] == 'bytes=0-0'
+        os.remove('app.tar.gz')
+        budget = _RecordingBudget(1024 * 1024)
+        fd = SegmentedDownloader('app.tar.gz', urls, file_hash, segments=1,
+                                 byte_budget=budget, file_size=10)
+        assert fd.download_verify_write() is True
+        assert budget.taken == [10]
+        assert budget.in_flight == 0
+
+    def test_segmented_dead_mirror(self, http_server, mirrored_file):
+        urls, file_hash, data = mirrored_file
+        urls.append('http://127.0.0.1:1/')
+        fd = SegmentedDownloader('app.tar.gz', urls, file_hash, segments=3)
+        assert fd.download_verify_write() is True
+        with open('app.tar.gz', 'rb') as f:
+            assert f.read() == data
+
+    def test_segmented_resume_segment(self, http_server, mirrored_file):
+        urls, file_hash, data = mirrored_file
+        # First request is for the total size
+        http_server.cuts = [1, 1000]
+        fd = SegmentedDownloader('app.tar.gz', urls, file_hash, segments=2,
+                                 retry_policy=RetryPolicy(backoff=0.01))
+        assert fd.download_verify_write() is True
+        with open('app.tar.gz', 'rb') as f:
+            assert f.read() == data
+        assert fd.retries == 1
+        starts = [int(r[1]['range'].split('=')[1].split('-')[0])
+                  for r in http_server.requests]
+        # Only the rest of the cut segment was asked for again
+        assert len([s for s in starts if s % 19200 == 1000]) == 1
+
+    def test_segmented_keeps_segments(self, http_server, mirrored_file):
+        urls, file_hash, data = mirrored_file
+        # Size request & two whole segments then one cut short
+        http_server.cuts = [1, 19200, 19200, 1000]
+        fd = SegmentedDownloader('app.tar.gz', urls, file_hash, segments=2,
+                                 retry_policy=RetryPolicy(0))
+        assert fd.download_verify_write() is False
+        temp_filename = 'app.tar.gz' + settings.DOWNLOAD_TEMP_EXT
+        with open(temp_filename + settings.DOWNLOAD_INFO_EXT, 'r') as f:
+            info = json.load(f)
+        assert info['total'] == len(data)
+        missing = sum(e - s + 1 for s, e in info['segments'])
+        assert missing <= len(data) - 19200 * 2
+
+        http_server.requests[:] = []
+        fd = SegmentedDownloader('app.tar.gz', urls, file_hash, segments=2)
+        assert fd.download_verify_write() is True
+        with open('app.tar.gz', 'rb') as f:
+            assert f.read() == data
+        assert os.listdir(os.getcwd()) == ['app.tar.gz']
+        # Only the missing segments were asked for again
+        requested = 0
+        for r in http_server.requests[1:]:
+            start, end = r[1]['range'].split('=')[1].split('-')
+            requested += int(end) - int(start) + 1
+        assert requested == missing
+
+    def test_segmented_nothing_received(self, http_server, mirrored_file):
+        urls, file_hash, data = mirrored_file
+        http_server.cuts = [1] + [0] * 10
+        fd = SegmentedDownloader('app.tar.gz', urls, file_hash, segments=2,
+                                 retry_policy=RetryPolicy(0))
+        assert fd.download_verify_write() is False
+        assert os.listdir(os.getcwd()) == []
+
+    def test_segmented_resume_single_stream(self, http_server,
+                                            mirrored_file):
+        urls, file_hash, data = mirrored_file
+        temp_filename = 'app.tar.gz' + settings.DOWNLOAD_TEMP_EXT
+        with open(temp_filename, 'wb') as f:
+            f.write(data[:1000] + b'\0' * (len(data) - 1000))
+        info = {'url': urls[0], 'file_hash': file_hash, 'offset': 1000,
+                'total': len(data), 'segments': [[1000, len(data) - 1]]}
+        with open(temp_filename + settings.DOWNLOAD_INFO_EXT, 'w') as f:
+            f.write(json.dumps(info))
+        # A regular download resumes from the bytes at the start
+        fd = FileDownloader('app.tar.gz', urls, file_hash)
+        assert fd.download_verify_write() is True
+        assert http_server.requests[0][1]['range'] == 'bytes=1000-'
+        with open('app.tar.gz', 'rb') as f:
+            assert f.read() == data
+
+    def test_segmented_all_urls_skipped(self, mirrored_file):
+        urls, file_hash, data = mirrored_file
+        fd = SegmentedDownloader('app.tar.gz', urls, file_hash, segments=2)
+        fd.circuit_breaker.filter = lambda urls: []
+        assert fd._next_url('http://127.0.0.1:1/') == urls[0]
+        assert fd.download_verify_write() is True
+
+    def test_segmented_bad_hash(self, mirrored_file):
+        urls, file_hash, data = mirrored_file
+        fd = SegmentedDownloader('app.tar.gz', urls, 'bad hash', segments=4)
+        assert fd.download_verify_write() is False
+        assert os.listdir(os.getcwd()) == []
+
+    def test_segmented_no_ranges(self, http_server, mirrored_file):
+        http_server.ranges = False
+        urls, file_hash, data = mirrored_file
+        fd = SegmentedDownloader('app.tar.gz', urls, file_hash, segments=4)
+        assert fd.download_verify_write() is True
+        with open('app.tar.gz', 'rb') as f:
+            assert f.read() == data
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestRetry(object):
+
+    def test_resume_after_drop(self, http_server, served_file):
+        file_hash, data = served_file
+        http_server.cuts = [100000]
+        events = []
+        fd = FileDownloader('app.tar.gz', http_server.url, file_hash,
+                            progress_hooks=[events.append],
+                            retry_policy=RetryPolicy(backoff=0.01))
+        assert fd.download_verify_write() is True
+        with open('app.tar.gz', 'rb') as f:
+            assert f.read() == data
+        assert http_server.requests[1][1]['range'] == 'bytes=100000-'
+        assert events[-1]['retries'] == 1
+        assert events[-1]['wasted_bytes'] == 0
+
+    def test_restart_wasted_bytes(self, http_server, served_file):
+        file_hash, data = served_file
+        http_server.ranges = False
+        http_server.cuts = [100000]
+        events = []
+        fd = FileDownloader('app.tar.gz', http_server.url, file_hash,
+                            progress_hooks=[events.append],
+                            retry_policy=RetryPolicy(backoff=0.01))
+        assert fd.download_verify_return() == data
+        assert events[-1]['retries'] == 1
+        assert events[-1]['wasted_bytes'] == 100000
+
+    def test_retry_status(self, http_server, served_file):
+        file_hash, data = served_file
+        http_server.errors = [503, 503]
+        fd = FileDownloader('app.tar.gz', http_server.url, file_hash,
+                            retry_policy=RetryPolicy(backoff=0.01))
+        assert fd.download_verify_return() == data
+        assert fd.retries == 2
+
+    def test_out_of_retries(self, http_server, served_file):
+        file_hash, data = served_file
+        http_server.errors = [503] * 3
+        fd = FileDownloader('app.tar.gz', http_server.url, file_hash,
+                            retry_policy=RetryPolicy(1, backoff=0.01))
+        assert fd.download_verify_return() is None
+        assert len(http_server.requests) == 2
+
+    def test_backoff(self):
+        policy = RetryPolicy(backoff=1, max_backoff=5, jitter=False)
+        assert [policy.delay(a) for a in range(1, 6)] == [1, 2, 4, 5, 5]
+        policy = RetryPolicy(backoff=1, max_backoff=5)
+        for _ in range(20):
+            assert 0 <= policy.delay(3) <= 4
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(threshold=2, cool_down=0.2)
+        breaker.record_failure('a')
+        assert breaker.allow('a') is True
+        breaker.record_failure('a')
+        assert breaker.allow('a') is False
+        assert breaker.filter(['a', 'b']) == ['b']
+        # Trying something beats failing right away
+        assert breaker.filter(['a']) == ['a']
+        time.sleep(0.25)
+        # One trial request after the cool down
+        assert breaker.allow('a') is True
+        assert breaker.allow('a') is False
+        breaker.record_success('a')
+        assert breaker.allow('a') is True
+
+    def test_skip_failing_mirror(self, http_server, http_server2,
+                                 served_file):
+        file_hash, data = served_file
+        http_server2.errors = [503] * 10
+        urls = [http_server2.url, http_server.url]
+        breaker = CircuitBreaker(threshold=1)
+        for _ in range(3):
+            fd = FileDownloader('app.tar.gz', urls, file_hash,
+                                circuit_breaker=breaker)
+            assert fd.download_verify_return() == data
+        assert len(http_server2.requests) == 1
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestHttpPool(object):
+
+    def test_shared_pool(self, http_server):
+        with open(os.path.join(http_server.root, 'patch'), 'wb') as f:
+            f.write(b'patch data' * 1000)
+        http_pool = get_http_pool(verify=False)
+        for _ in range(5):
+            fd = FileDownloader('patch', http_server.url,
+                                http_pool=http_pool)
+            assert fd.http_pool is http_pool
+            assert fd.download_verify_return() is not None
+        assert http_server.connections == 1
+
+    def test_unread_body_not_reused(self, http_server):
+        http_server.ranges = False
+        data = os.urandom(1024 * 1024)
+        with open(os.path.join(http_server.root, 'app.tar.gz'), 'wb') as f:
+            f.write(data)
+        file_hash = hashlib.sha256(data).hexdigest()
+        http_pool = get_http_pool(verify=False)
+        fd = SegmentedDownloader('app.tar.gz', http_server.url, file_hash,
+                                 http_pool=http_pool)
+        # Server ignores the range & starts sending the whole file
+        assert fd._get_total_size() is None
+        fd = FileDownloader('app.tar.gz', http_server.url, file_hash,
+                            http_pool=http_pool)
+        assert fd.download_verify_return() == data
+
+    def test_unread_small_body_drained(self, http_server):
+        http_server.ranges = False
+        data = os.urandom(1024)
+        with open(os.path.join(http_server.root, 'patch'), 'wb') as f:
+            f.write(data)
+        http_pool = get_http_pool(verify=False)
+        fd = SegmentedDownloader('patch', http_server.url,
+                                 http_pool=http_pool)
+        assert fd._get_total_size() is None
+        fd = FileDownloader('patch', http_server.url, http_pool=http_pool)
+        assert fd.download_verify_return() == data
+        # Rest of the body was read so the connection was reused
+        assert http_server.connections == 1
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestRateLimit(object):
+
+    def test_no_limit(self):
+        limiter = RateLimiter()
+        start = time.time()
+        limiter.consume(10 * 1024 * 1024)
+        assert time.time() - start < 0.1
+        assert limiter.block_size(4096) == 4096
+
+    def test_shared_limit(self):
+        limiter = RateLimiter(100000)
+        assert limiter.block_size(1024 * 1024) == 100000
+
+        def reader():
+            for _ in range(5):
+                limiter.consume(10000)
+
+        start = time.time()
+        threads = [threading.Thread(target=reader) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # 150000 bytes combined at 100000 bytes a second
+        assert time.time() - start >= 1.3
+
+    def test_change_rate(self):
+        limiter = RateLimiter(1000)
+        t = threading.Thread(target=limiter.consume, args=(100000,))
+        t.start()
+        time.sleep(0.2)
+        # Would take ~100 seconds at the old rate
+        limiter.set_rate(None)
+        t.join(2)
+        assert t.is_alive() is False
+
+    def test_download_limit(self, http_server):
+        data = os.urandom(200000)
+        with open(os.path.join(http_server.root, 'app.tar.gz'), 'wb') as f:
+            f.write(data)
+        file_hash = hashlib.sha256(data).hexdigest()
+        limiter = RateLimiter(200000)
+        start = time.time()
+        fd = FileDownloader('app.tar.gz', http_server.url, file_hash,
+                            rate_limiter=limiter)
+        assert fd.download_verify_write() is True
+        assert time.time() - start >= 0.9
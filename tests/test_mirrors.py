@@ -0,0 +1,114 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import json
+import os
+
+import pytest
+
+from pyupdater import settings
+from pyupdater.client.downloader import FileDownloader, SegmentedDownloader
+from pyupdater.client.mirrors import MirrorSelector
+
+DEAD_URL = 'http://127.0.0.1:1/'
+
+
+@pytest.mark.usefixtures('cleandir')
+class TestMirrors(object):
+
+    @pytest.fixture
+    def mirrors(self, http_server, http_server2):
+        for s in [http_server, http_server2]:
+            with open(os.path.join(s.root, settings.VERSION_FILE), 'wb') as f:
+                f.write(b'version data')
+        http_server.delay = 0.3
+        return [DEAD_URL, http_server.url, http_server2.url]
+
+    def test_rank(self, mirrors):
+        m = MirrorSelector(mirrors, os.getcwd())
+        ranked = m.rank()
+        assert ranked == [mirrors[2], mirrors[1], DEAD_URL]
+
+    def test_stats_saved(self, mirrors):
+        MirrorSelector(mirrors, os.getcwd()).rank()
+        with open(settings.MIRROR_STATS_FILE, 'r') as f:
+            stats = json.load(f)
+        assert stats[DEAD_URL]['errors'] == 1
+        assert stats[mirrors[1]]['latency'] > stats[mirrors[2]]['latency']
+
+        # Ranking is known before probing on next run
+        m = MirrorSelector(mirrors, os.getcwd())
+        assert m.ranked_urls() == [mirrors[2], mirrors[1], DEAD_URL]
+
+    def test_errors_decay(self):
+        urls = ['http://a/', 'http://b/']
+        m = MirrorSelector(urls, os.getcwd())
+        m.record_success(urls[0], 0.5)
+        m.record_success(urls[1], 0.1)
+        m.record_failure(urls[1])
+        assert m.ranked_urls() == urls
+        for _ in range(10):
+            m.record_success(urls[1], 0.1)
+        assert m.ranked_urls() == [urls[1], urls[0]]
+
+    def test_no_stats_keeps_order(self):
+        urls = ['http://b/', 'http://a/']
+        m = MirrorSelector(urls, os.getcwd())
+        assert m.ranked_urls() == urls
+
+    def test_probe_rate_limited(self, mirrors, http_server2, monkeypatch):
+        MirrorSelector(mirrors, os.getcwd()).rank()
+        probes = len(http_server2.requests)
+        # Saved stats are recent enough
+        m = MirrorSelector(mirrors, os.getcwd())
+        assert m.rank() == [mirrors[2], mirrors[1], DEAD_URL]
+        assert len(http_server2.requests) == probes
+        monkeypatch.setattr(settings, 'MIRROR_PROBE_INTERVAL', 0)
+        m.rank()
+        assert len(http_server2.requests) == probes + 1
+
+    def test_download_outcomes(self, http_server, served_file):
+        file_hash, data = served_file
+        urls = [DEAD_URL, http_server.url]
+        m = MirrorSelector(urls, os.getcwd())
+        fd = FileDownloader('app.tar.gz', urls, file_hash, mirrors=m)
+        assert fd.download_verify_write() is True
+        assert m.stats[DEAD_URL]['errors'] == 1
+        assert m.stats[http_server.url]['latency'] is not None
+        assert m.ranked_urls() == [http_server.url, DEAD_URL]
+        # Urls that aren't ranked are left out
+        m.record_failure('http://other/')
+        assert 'http://other/' not in m.stats
+
+    def test_segment_outcomes(self, http_server, served_file, monkeypatch):
+        monkeypatch.setattr(settings, 'SEGMENTED_DOWNLOAD_MIN_SIZE', 1024)
+        file_hash, data = served_file
+        urls = [http_server.url]
+        m = MirrorSelector(urls, os.getcwd())
+        latencies = []
+        record_success = m.record_success
+
+        def record(url, latency):
+            latencies.append(latency)
+            record_success(url, latency)
+
+        m.record_success = record
+        fd = SegmentedDownloader('app.tar.gz', urls, file_hash, segments=4,
+                                 mirrors=m)
+        assert fd.download_verify_write() is True
+        # Size request & every segment
+        assert len(latencies) == len(http_server.requests)
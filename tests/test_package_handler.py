@@ -17,10 +17,12 @@ from __future__ import unicode_literals
 
 import os
 
+import bsdiff4
 import pytest
 
 from pyupdater import settings
 from pyupdater.package_handler import PackageHandler
+from pyupdater.utils.diff_engines import get_engine
 from pyupdater.utils.config import TransistionDict
 from pyupdater.utils.exceptions import PackageHandlerError
 from tconfig import TConfig
@@ -65,6 +67,62 @@ class TestExecution(object):
         p = PackageHandler(config, db)
         p.process_packages()
 
+    def test_skip_ahead_patches(self, db):
+        data_dir = os.getcwd()
+        t_config = TConfig()
+        t_config.DATA_DIR = data_dir
+        t_config.SKIP_AHEAD_PATCHES = 2
+        config = TransistionDict()
+        config.from_object(t_config)
+        p = PackageHandler(config, db)
+        archives = {}
+        data = os.urandom(10000)
+        for i in range(5):
+            data = data[:i * 100] + os.urandom(50) + data[i * 100 + 50:]
+            filename = 'myapp-mac-0.1.{}.zip'.format(i)
+            with open(os.path.join(p.new_dir, filename), 'wb') as f:
+                f.write(data)
+            archives['0.1.{}.2.0'.format(i)] = data
+            p.process_packages()
+
+        info = p.json_data['updates']['myapp']['0.1.4.2.0']['mac']
+        assert 'patch_name' in info
+        assert sorted(info['skip_patches'].keys()) == ['0.1.1.2.0',
+                                                       '0.1.2.2.0']
+        for base, skip in info['skip_patches'].items():
+            with open(os.path.join(p.deploy_dir,
+                                   skip['patch_name']), 'rb') as f:
+                patch = f.read()
+            assert len(patch) == skip['patch_size']
+            assert bsdiff4.patch(archives[base], patch) == \
+                archives['0.1.4.2.0']
+        # Only archives needed for the next skip-ahead patches are kept
+        assert sorted(os.listdir(p.files_dir)) == \
+            ['myapp-mac-0.1.2.zip', 'myapp-mac-0.1.3.zip',
+             'myapp-mac-0.1.4.zip']
+
+    def test_patch_format(self, db):
+        data_dir = os.getcwd()
+        t_config = TConfig()
+        t_config.DATA_DIR = data_dir
+        t_config.PATCH_FORMAT = 'block-delta'
+        config = TransistionDict()
+        config.from_object(t_config)
+        p = PackageHandler(config, db)
+        source = os.urandom(10000)
+        target = source[:5000] + os.urandom(100) + source[5000:]
+        for i, data in enumerate([source, target]):
+            filename = 'myapp-mac-0.1.{}.zip'.format(i)
+            with open(os.path.join(p.new_dir, filename), 'wb') as f:
+                f.write(data)
+            p.process_packages()
+
+        info = p.json_data['updates']['myapp']['0.1.1.2.0']['mac']
+        assert info['patch_format'] == 'block-delta'
+        with open(os.path.join(p.deploy_dir, info['patch_name']), 'rb') as f:
+            patch = f.read()
+        assert get_engine('block-delta').patch(source, patch) == target
+
     def test_process_packages_fail(self, db):
         with pytest.raises(PackageHandlerError):
             p = PackageHandler()
@@ -62,6 +62,26 @@ class TestUtils(object):
         mu.init()
         mu.upload()
 
+    def test_plugin_progress(self):
+        class MyUploader(BaseUploader):
+
+            def init(self, **kwargs):
+                self.file_list = ['test']
+
+            def upload_file(self, filename):
+                for i in range(1000):
+                    self.progress.update(i * 10)
+                return True
+
+        events = []
+        mu = MyUploader()
+        mu.init()
+        mu.add_progress_hook(events.append)
+        assert mu.upload() is True
+        assert len(events) < 10
+        assert events[-1]['status'] == 'finished'
+        assert events[-1]['uploaded'] == 9990
+
 
 @pytest.mark.usefixtures('cleandir')
 class TestExecution(object):
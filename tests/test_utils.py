@@ -15,23 +15,49 @@
 # --------------------------------------------------------------------------
 from __future__ import unicode_literals
 
+import gzip
+import io
+import mmap
+import multiprocessing
 import os
+import sys
+import tarfile
+import threading
+import time
+import zipfile
 
 from jms_utils.paths import ChDir
 import pytest
 
-from pyupdater.utils import (check_repo,
+from pyupdater.utils import (_add_bytes_int,
+                             _add_bytes_numpy,
+                             _bsdiff4_patch,
+                             bsdiff4_py,
+                             check_repo,
                              convert_to_list,
                              EasyAccessDict,
                              get_hash,
                              get_mac_dot_app_dir,
                              get_package_hashes,
+                             gzip_decompress,
+                             GzipDecompressor,
+                             make_reproducible_tar_gz,
+                             make_reproducible_zip,
                              parse_platform,
                              remove_dot_files,
                              Version
                              )
 from pyupdater.utils.exceptions import UtilsError, VersionError
+from pyupdater.utils.filelock import FileLock
 from pyupdater.utils.package import Patch, Package
+from pyupdater.utils.parallel_gzip import (BlockCompressor,
+                                           CAN_PRIME,
+                                           get_block_info,
+                                           open_gzip_writer,
+                                           ParallelGzipWriter)
+from pyupdater.utils.progress import (call_progress_hooks,
+                                      format_eta,
+                                      ProgressDispatcher)
 
 
 TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), 'test data',
@@ -196,3 +222,339 @@ class TestUtils(object):
         info['package'] = None
         p = Patch(info)
         assert p.ready is False
+
+
+class TestProgress(object):
+
+    def test_coalesce(self):
+        events = []
+        progress = ProgressDispatcher(events.append, rate=10)
+        progress.start(1000)
+        for i in range(1, 1001):
+            progress.update(i)
+        progress.finish(1000)
+        # First update & finish are always sent
+        assert len(events) == 2
+        assert events[0]['downloaded'] == 1
+        assert events[-1]['status'] == 'finished'
+        assert events[-1]['downloaded'] == 1000
+        assert events[-1]['eta'] == 0.0
+
+    def test_numbers(self):
+        events = []
+        progress = ProgressDispatcher(events.append, rate=0,
+                                      done_key='uploaded')
+        progress.start(2000, offset=1000)
+        time.sleep(0.1)
+        progress.update(1500)
+        status = events[0]
+        assert status['uploaded'] == 1500
+        assert 0 < status['bytes_per_sec'] <= 5000
+        assert status['eta'] > 0
+        assert status['percent_complete'] == '75.0'
+
+    def test_finish_last_update(self):
+        events = []
+        progress = ProgressDispatcher(events.append)
+        progress.start()
+        progress.update(10)
+        progress.finish(status='failed')
+        assert events[-1]['downloaded'] == 10
+        assert events[-1]['eta'] is None
+
+    def test_bad_hook(self):
+        events = []
+
+        def bad_hook(status):
+            raise ValueError('Bad hook')
+        call_progress_hooks([bad_hook, events.append], {'status': 'ok'})
+        assert events == [{'status': 'ok'}]
+
+    def test_format_eta(self):
+        assert format_eta(None) == '--:--'
+        assert format_eta(61.5) == '01:01'
+        assert format_eta(100 * 60) == '--:--'
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestFileLock(object):
+
+    def test_exclusive(self):
+        held = []
+
+        def worker():
+            for _ in range(20):
+                with FileLock('test.lock'):
+                    held.append(1)
+                    assert len(held) == 1
+                    time.sleep(0.001)
+                    held.pop()
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert held == []
+
+    def test_timeout(self):
+        lock = FileLock('test.lock')
+        with lock:
+            # Separate instance acts like another process
+            with pytest.raises(UtilsError):
+                FileLock('test.lock', timeout=0.2).acquire()
+        with FileLock('test.lock', timeout=0.2):
+            pass
+
+
+class TestGzip(object):
+
+    def _gzip(self, data):
+        f = io.BytesIO()
+        with gzip.GzipFile(fileobj=f, mode='wb') as g:
+            g.write(data)
+        return f.getvalue()
+
+    def test_decompress(self):
+        data = os.urandom(1024) * 100
+        assert gzip_decompress(self._gzip(data)) == data
+
+    def test_streamed(self):
+        data = os.urandom(1024) * 100
+        compressed = self._gzip(data)
+        d = GzipDecompressor()
+        for i in range(0, len(compressed), 7):
+            d.write(compressed[i:i + 7])
+        assert d.getvalue() == data
+        # Kept exactly as written
+        assert d.get_compressed() == compressed
+
+    def test_members(self):
+        compressed = self._gzip(b'first ') + self._gzip(b'second')
+        d = GzipDecompressor(keep_compressed=False)
+        d.write(compressed[:len(compressed) // 2])
+        d.write(compressed[len(compressed) // 2:])
+        assert d.getvalue() == b'first second'
+        assert d.get_compressed() == b''
+
+    def test_restart(self):
+        compressed = self._gzip(b'data')
+        d = GzipDecompressor()
+        d.write(compressed[:10])
+        d.seek(0)
+        d.truncate()
+        d.write(compressed)
+        assert d.getvalue() == b'data'
+
+    def test_bad_data(self):
+        with pytest.raises(IOError):
+            gzip_decompress(b'not gzip data')
+        with pytest.raises(IOError):
+            GzipDecompressor().getvalue()
+
+    @pytest.mark.skipif(sys.version_info[0] < 3,
+                        reason='Needs decompressobj.eof')
+    def test_cut_off(self):
+        compressed = self._gzip(os.urandom(1024))
+        with pytest.raises(IOError):
+            gzip_decompress(compressed[:-10])
+
+
+@pytest.mark.usefixtures('cleandir')
+class TestReproducibleArchive(object):
+
+    def _make_app(self, mode=0o644):
+        os.makedirs(os.path.join('app', 'lib'))
+        for name in ['app', 'lib/b.so', 'lib/a.so']:
+            path = os.path.join('app', name)
+            with open(path, 'wb') as f:
+                f.write(name.encode('utf-8') * 100)
+            os.chmod(path, mode)
+        os.chmod(os.path.join('app', 'app'), 0o700)
+
+    def _rebuild(self):
+        # Same files, made later with another umask
+        time.sleep(1.1)
+        os.rename('app', 'old-app')
+        self._make_app(mode=0o600)
+
+    def test_same_hash_any_workers(self, monkeypatch):
+        self._make_app()
+        make_reproducible_tar_gz('first', 'app', workers=2)
+        make_reproducible_tar_gz('second', 'app', workers=4)
+        assert get_package_hashes('first') == get_package_hashes('second')
+        # Machines with one cpu make the same archive by default
+        monkeypatch.setattr(multiprocessing, 'cpu_count', lambda: 1)
+        make_reproducible_tar_gz('third', 'app')
+        assert get_package_hashes('first') == get_package_hashes('third')
+
+    def test_one_worker_gzip_module(self):
+        self._make_app()
+        make_reproducible_tar_gz('first', 'app', workers=1)
+        with open('first', 'rb') as f:
+            assert get_block_info(f.read(21)) is None
+        self._rebuild()
+        make_reproducible_tar_gz('second', 'app', workers=1)
+        assert get_package_hashes('first') == get_package_hashes('second')
+
+    @pytest.mark.parametrize('make', [make_reproducible_tar_gz,
+                                      make_reproducible_zip])
+    def test_same_hash(self, make):
+        self._make_app()
+        make('first', 'app')
+        self._rebuild()
+        make('second', 'app')
+        assert get_package_hashes('first') == get_package_hashes('second')
+
+    def test_tar_gz(self):
+        self._make_app()
+        make_reproducible_tar_gz('app.tar.gz', 'app', 1)
+        with tarfile.open('app.tar.gz', 'r:gz') as tar:
+            members = tar.getmembers()
+            assert [m.name for m in members] == ['app', 'app/app', 'app/lib',
+                                                 'app/lib/a.so',
+                                                 'app/lib/b.so']
+            assert set(m.mtime for m in members) == set([0])
+            assert set(m.uid for m in members) == set([0])
+            assert members[1].mode == 0o755
+            assert members[3].mode == 0o644
+            assert tar.extractfile('app/lib/a.so').read() == b'lib/a.so' * 100
+
+    def test_zip(self):
+        self._make_app()
+        make_reproducible_zip('app.zip', 'app')
+        with zipfile.ZipFile('app.zip') as zf:
+            assert zf.namelist() == ['app/', 'app/app', 'app/lib/',
+                                     'app/lib/a.so', 'app/lib/b.so']
+            assert zf.getinfo('app/app').external_attr >> 16 == 0o100755
+            assert zf.read('app/lib/b.so') == b'lib/b.so' * 100
+
+
+class TestParallelGzip(object):
+
+    def _gzip(self, data, workers=3, block_size=1024, chunk=700):
+        f = io.BytesIO()
+        with ParallelGzipWriter(f, 6, workers, block_size, mtime=0) as gz:
+            for i in range(0, len(data), chunk):
+                gz.write(data[i:i + chunk])
+        return f.getvalue()
+
+    @pytest.mark.parametrize('size', [0, 1, 1024, 3072, 5000])
+    def test_decompress(self, size):
+        data = (os.urandom(100) * 30)[:size]
+        compressed = self._gzip(data)
+        assert gzip.GzipFile(fileobj=io.BytesIO(compressed)).read() == data
+
+    def test_workers(self):
+        data = os.urandom(200) * 100
+        compressed = self._gzip(data, workers=1)
+        assert self._gzip(data, workers=4, chunk=5000) == compressed
+        if CAN_PRIME:
+            # Primed blocks find repeats in the block before them
+            assert len(compressed) < 1000
+
+    @pytest.mark.parametrize('size', [0, 1024, 3072, 5000])
+    def test_block_compressor(self, size):
+        data = (os.urandom(100) * 30)[:size]
+        compressed = self._gzip(data)
+        # 12 byte header & 9 byte extra field
+        block_size, primed = get_block_info(compressed[:21])
+        assert block_size == 1024
+        compressor = BlockCompressor(6, block_size, primed)
+        deflated = b''.join([compressor.compress(data[:500]),
+                             compressor.compress(data[500:]),
+                             compressor.flush()])
+        assert compressed[21:-8] == deflated
+
+    def test_open_one_worker(self):
+        data = os.urandom(200) * 100
+        for workers in [1, 2]:
+            f = io.BytesIO()
+            with open_gzip_writer(f, 6, workers, mtime=0) as gz:
+                gz.write(data)
+            compressed = f.getvalue()
+            assert gzip.GzipFile(fileobj=io.BytesIO(compressed)).read() == \
+                data
+            # Only many workers compress in blocks
+            assert (get_block_info(compressed[:21]) is None) is \
+                (workers == 1)
+
+    def test_block_info(self):
+        f = io.BytesIO()
+        with gzip.GzipFile(fileobj=f, mode='wb') as g:
+            g.write(b'data')
+        assert get_block_info(f.getvalue()) is None
+
+    def test_tar(self):
+        f = io.BytesIO()
+        with ParallelGzipWriter(f, block_size=1024) as gz:
+            with tarfile.open(fileobj=gz, mode='w') as tar:
+                info = tarfile.TarInfo('app')
+                data = os.urandom(5000)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        f.seek(0)
+        with tarfile.open(fileobj=f, mode='r:gz') as tar:
+            assert tar.extractfile('app').read() == data
+
+
+class TestBsdiff4Py(object):
+
+    @pytest.fixture
+    def release(self):
+        bsdiff4 = pytest.importorskip('bsdiff4')
+        source = bytearray(os.urandom(10000))
+        target = bytearray(source)
+        for i in range(0, len(target), 97):
+            target[i] = (target[i] + i) % 256
+        target = bytes(target[:5000]) + os.urandom(500) + \
+            bytes(target[4000:])
+        source = bytes(source)
+        patch = bsdiff4.diff(source, target)
+        assert bsdiff4.patch(source, patch) == target
+        return source, patch, target
+
+    def test_patch(self, release):
+        source, patch, target = release
+        assert bsdiff4_py.patch(source, patch) == target
+
+    def test_blocks(self, release, monkeypatch):
+        monkeypatch.setattr('pyupdater.utils.BSDIFF_BLOCK_SIZE', 7)
+        source, patch, target = release
+        assert _bsdiff4_patch(source, patch, _add_bytes_int) == target
+
+    def test_numpy(self, release):
+        pytest.importorskip('numpy')
+        source, patch, target = release
+        assert _bsdiff4_patch(source, patch, _add_bytes_numpy) == target
+
+    def test_mmap_source(self, release, tmpdir):
+        source, patch, target = release
+        path = str(tmpdir.join('source'))
+        with open(path, 'wb') as f:
+            f.write(source)
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                assert bsdiff4_py.patch(data, patch) == target
+                output = io.BytesIO()
+                _bsdiff4_patch(data, patch, _add_bytes_int, output)
+                assert output.getvalue() == target
+            finally:
+                data.close()
+
+    def test_add_bytes(self):
+        a = bytes(bytearray(range(256)))
+        b = bytes(bytearray([255] * 256))
+        expected = bytes(bytearray([255] + list(range(255))))
+        assert _add_bytes_int(a, b) == expected
+        assert _add_bytes_int(a[:1], b[:1]) == b'\xff'
+
+    def test_corrupt_patch(self, release):
+        source, patch, target = release
+        with pytest.raises(ValueError):
+            bsdiff4_py.patch(source, b'NOTBSDIFF' + patch[9:])
+        # Header claims a bigger output than the patch makes
+        with pytest.raises(ValueError):
+            bsdiff4_py.patch(source, patch[:24] + b'\xff\xff' +
+                             patch[26:])